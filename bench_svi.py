@@ -0,0 +1,127 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import functools
+import logging
+from timeit import default_timer
+
+import pyro
+import torch
+from pyro import poutine
+from pyro.infer import SVI, JitTrace_ELBO, Trace_ELBO
+from pyro.optim import ClippedAdam
+
+from pyrocov import mutrans
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
+
+MODEL_TYPE = "sparse-skip-reparam"
+
+
+def prepare(dataset, loss_type):
+    # Mirrors the dataset preparation of mutrans.fit_svi().
+    dataset = dataset.copy()
+    dataset.pop("cells", None)
+    if loss_type == "jit" and dataset["features"].is_sparse:
+        dataset["features"] = dataset["features"].to_dense()
+    counts = dataset["weekly_strains"]
+    if counts.is_sparse or loss_type == "fused":
+        if not counts.is_sparse:
+            counts = counts.to_sparse()
+        dataset["observed_cells"] = mutrans.observed_cells(counts)
+    return dataset
+
+
+def bench(args, dataset, cond_data, loss_type):
+    """
+    Runs SVI steps with one loss, returning losses and seconds per step.
+    """
+    dataset = prepare(dataset, loss_type)
+    pyro.set_rng_seed(args.seed)
+    pyro.clear_param_store()
+    model = poutine.condition(mutrans.model, cond_data)
+    guide = mutrans.Guide(
+        model, mutrans.InitLocFn(dataset), init_scale=0.01, rank=args.rank
+    )
+    guide(dataset, MODEL_TYPE)
+    if loss_type == "trace":
+        loss = Trace_ELBO(max_plate_nesting=3)
+    elif loss_type == "jit":
+        loss = JitTrace_ELBO(max_plate_nesting=3, ignore_jit_warnings=True)
+    else:
+        loss = functools.partial(mutrans.fused_elbo_loss, cond_data=cond_data)
+    optim = ClippedAdam({"lr": args.learning_rate, "clip_norm": args.clip_norm})
+    svi = SVI(model, guide, optim, loss)
+    losses = []
+    for step in range(args.num_warmup):
+        losses.append(svi.step(dataset=dataset, model_type=MODEL_TYPE))
+    start_time = default_timer()
+    for step in range(args.num_steps):
+        losses.append(svi.step(dataset=dataset, model_type=MODEL_TYPE))
+    return losses, (default_timer() - start_time) / args.num_steps
+
+
+def main(args):
+    torch.set_default_dtype(torch.double if args.double else torch.float)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    cond_data = [kv.split("=") for kv in args.cond_data.split(",") if kv]
+    cond_data = {k: torch.tensor(float(v)) for k, v in cond_data}
+    dataset = mutrans.load_gisaid_data(
+        gisaid_columns_filename=args.gisaid_columns_file_in,
+        gisaid_cube_filename=args.gisaid_cube_file_in,
+        nextclade_features_filename=args.nextclade_features_file_in,
+        sparse_strains=args.sparse_strains,
+    )
+    logger.info(
+        "Benchmarking {} places x {} strains x {} features".format(
+            len(dataset["location_id"]), *dataset["features"].shape
+        )
+    )
+
+    results = {}
+    for loss_type in args.loss_types.split(","):
+        logger.info(f"Running {loss_type}")
+        results[loss_type] = bench(args, dataset, cond_data, loss_type)
+
+    baseline, baseline_time = results.get("trace", next(iter(results.values())))
+    baseline = torch.tensor(baseline)
+    lines = ["loss\tms/step\tspeedup\tmax rel loss error"]
+    for loss_type, (losses, step_time) in results.items():
+        error = (torch.tensor(losses) - baseline).abs().div(baseline.abs()).max()
+        lines.append(
+            f"{loss_type}\t{1000 * step_time:0.2f}\t"
+            f"{baseline_time / step_time:0.2f}\t{error:0.3g}"
+        )
+    logger.info("\n".join(lines))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark SVI losses for the default mutrans model and guide"
+    )
+    parser.add_argument("--gisaid-columns-file-in", default="results/gisaid.columns")
+    parser.add_argument("--gisaid-cube-file-in", default="results/gisaid.cube.pkl")
+    parser.add_argument(
+        "--nextclade-features-file-in", default="results/nextclade.features.pt"
+    )
+    parser.add_argument("--sparse-strains", action="store_true")
+    parser.add_argument("--loss-types", default="trace,jit,fused")
+    parser.add_argument("-cd", "--cond-data", default="coef_scale=0.5")
+    parser.add_argument("-n", "--num-steps", default=100, type=int)
+    parser.add_argument("--num-warmup", default=10, type=int)
+    parser.add_argument("-lr", "--learning-rate", default=0.05, type=float)
+    parser.add_argument("-cn", "--clip-norm", default=10.0, type=float)
+    parser.add_argument("-r", "--rank", default=200, type=int)
+    parser.add_argument("-fp64", "--double", action="store_true")
+    parser.add_argument("-fp32", "--float", action="store_false", dest="double")
+    parser.add_argument("--num-threads", type=int)
+    parser.add_argument("--seed", default=20210319, type=int)
+    args = parser.parse_args()
+    if args.num_steps <= 0:
+        parser.error("--num-steps must be positive")
+    if args.num_warmup < 0:
+        parser.error("--num-warmup must be nonnegative")
+    main(args)
@@ -0,0 +1,32 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import logging
+
+from pyrocov.columnar import convert_pickle, export_pickle
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
+
+
+def main(args):
+    if args.export:
+        export_pickle(args.columns_dir, args.columns_file)
+    else:
+        convert_pickle(args.columns_file, args.columns_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert between gisaid.columns.pkl and a columnar store"
+    )
+    parser.add_argument("--columns-file", default="results/gisaid.columns.pkl")
+    parser.add_argument("--columns-dir", default="results/gisaid.columns")
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="export the columnar store to a pickle, rather than converting",
+    )
+    args = parser.parse_args()
+    main(args)
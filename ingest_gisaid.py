@@ -0,0 +1,116 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import logging
+import math
+import os
+import pickle
+
+from pyrocov import columnar, gisaid
+from pyrocov.fasta import DIGESTS, Minimap2Backend, NextcladeBackend, NextcladeDB
+from pyrocov.mutrans import START_DATE
+from pyrocov.nextclade import MutationCounter, save_features
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
+
+
+def main(args):
+    logger.info(f"Ingesting {args.gisaid_file_in}")
+    if not os.path.exists(args.gisaid_file_in):
+        raise OSError(f"Missing {args.gisaid_file_in}; you may need to request a feed")
+    os.makedirs("results", exist_ok=True)
+
+    # Parse each row once, both collating metadata and scheduling its sequence
+    # for alignment. Alignment is batched and cached under the hood.
+    counter = MutationCounter()
+    if args.aligner == "minimap2":
+        backend = Minimap2Backend(num_workers=args.nextclade_workers)
+    else:
+        backend = NextcladeBackend(args.nextclade)
+    db = NextcladeDB(
+        num_workers=args.nextclade_workers, backend=backend, digest=args.digest
+    )
+
+    def on_sequence(lineage, sequence, key):
+        db.schedule(sequence, counter.add_row, lineage, key=key)
+
+    columns, stats, fingerprints, _ = gisaid.process_feed(
+        args, on_sequence=on_sequence, digest=db.digest
+    )
+
+    logger.info(f"saving {args.columns_dir_out}")
+    columnar.save_columns(columns, args.columns_dir_out)
+    logger.info(f"saving {args.cube_file_out}")
+    cube = columnar.count_cells(columns)
+    columnar.save_cube(cube, args.cube_file_out, args.columns_dir_out)
+    if args.columns_file_out:
+        logger.info(f"saving {args.columns_file_out}")
+        with open(args.columns_file_out, "wb") as f:
+            pickle.dump(dict(columns), f)
+    logger.info(f"saving {args.stats_file_out}")
+    with open(args.stats_file_out, "wb") as f:
+        pickle.dump(dict(stats), f)
+    del columns, stats
+
+    # Allow a later preprocess_gisaid.py --incremental run to continue from
+    # these columns.
+    checkpoint = {
+        "accession_ids": fingerprints,
+        "fingerprints": set(fingerprints.values()),
+    }
+    gisaid.update_checkpoint(args, checkpoint)
+    del checkpoint, fingerprints
+
+    db.wait(log_every=args.log_every)
+    save_features(args, counter)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Preprocess GISAID data and featurize nextclade mutations "
+        "in a single pass"
+    )
+    parser.add_argument("--gisaid-file-in", default="results/gisaid.json.xz")
+    parser.add_argument("--columns-dir-out", default="results/gisaid.columns")
+    parser.add_argument(
+        "--columns-file-out",
+        default="results/gisaid.columns.pkl",
+        help="optional pickle export of columns, or empty to skip",
+    )
+    parser.add_argument("--cube-file-out", default="results/gisaid.cube.pkl")
+    parser.add_argument("--stats-file-out", default="results/gisaid.stats.pkl")
+    parser.add_argument("--checkpoint-file", default="results/gisaid.checkpoint.pkl")
+    parser.add_argument("--features-file-out", default="results/nextclade.features.pt")
+    parser.add_argument("--counts-file-out", default="results/nextclade.counts.pkl")
+    parser.add_argument("--start-date", default=START_DATE)
+    parser.add_argument("--min-nchars", default=29000, type=int)
+    parser.add_argument("--max-nchars", default=31000, type=int)
+    parser.add_argument("--min-good-samples", default=5, type=float)
+    parser.add_argument(
+        "--aligner",
+        default="nextclade",
+        choices=["nextclade", "minimap2"],
+        help="alignment backend; minimap2 requires mappy but not nextclade",
+    )
+    parser.add_argument("--nextclade", default="./nextclade")
+    parser.add_argument(
+        "--nextclade-workers",
+        default=1,
+        type=int,
+        help="number of alignment batches to run concurrently",
+    )
+    parser.add_argument(
+        "--digest",
+        choices=sorted(DIGESTS),
+        help="sequence digest of a new database, defaults to sha1",
+    )
+    parser.add_argument("-l", "--log-every", default=1000, type=int)
+    parser.add_argument("--truncate", default=math.inf, type=int)
+    parser.add_argument(
+        "-j", "--num-workers", default=1, type=int, help="number of worker processes"
+    )
+    args = parser.parse_args()
+    args.start_date = gisaid.parse_date(args.start_date)
+    main(args)
@@ -5,23 +5,50 @@ import argparse
 import functools
 import gc
 import logging
+import math
 import os
 import re
-from typing import Callable, Union
+from typing import Callable, Optional, Union
 
 import pyro
 import torch
 
-from pyrocov import mutrans, pangolin, sarscov2
+from pyrocov import columnar, gisaid, mutrans, pangolin, sarscov2
+from pyrocov.cache import ArtifactCache, code_fingerprint, file_fingerprint, fingerprint
 from pyrocov.util import torch_map
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
 
 
-def cached(filename: Union[str, Callable]):
+# Inputs of load_data(), whose changes invalidate cached results.
+INPUT_FILENAMES = [
+    "results/gisaid.columns",
+    "results/gisaid.cube.pkl",
+    "results/nextclade.features.pt",
+]
+
+
+@functools.lru_cache(maxsize=None)
+def get_cache(max_gb: float) -> ArtifactCache:
+    return ArtifactCache("results/mutrans.cache.json", max_bytes=max_gb * 2**30)
+
+
+@functools.lru_cache(maxsize=None)
+def code_version() -> str:
+    return code_fingerprint(mutrans, columnar, gisaid, sarscov2)
+
+
+@functools.lru_cache(maxsize=None)
+def input_fingerprints(by_content: bool) -> tuple:
+    return tuple(file_fingerprint(f, content=by_content) for f in INPUT_FILENAMES)
+
+
+def cached(filename: Union[str, Callable], key: Optional[Callable] = None):
     """
-    Simple utiltity to cache results based on filename.
+    Utility to cache results based on filename. Results are reused only if
+    ``key(*args, **kwargs)`` matches the key they were saved with, and are
+    evicted least recently used first; see :class:`~pyrocov.cache.ArtifactCache`.
     """
 
     def decorator(fn):
@@ -31,15 +58,19 @@ def cached(filename: Union[str, Callable]):
             if base_args.no_cache:
                 return fn(*args, **kwargs)
             f = filename(*args, **kwargs) if callable(filename) else filename
-            if os.path.exists(f) and not base_args.force:
-                logger.info(f"loading cached {f}")
-                return torch.load(f, map_location=torch.empty(()).device)
+            k = key(*args, **kwargs) if key is not None else None
+            cache = get_cache(base_args.cache_max_gb)
+            if not base_args.force:
+                found, result = cache.get(f, k)
+                if found:
+                    logger.info(f"loading cached {f}")
+                    return result
             if base_args.no_new:
                 raise ValueError(f"Missing {f}")
             result = fn(*args, **kwargs)
             if not args[0].test:
                 logger.info(f"saving {f}")
-                torch.save(result, f)
+                cache.put(f, k, result)
             return result
 
         return cached_fn
@@ -63,33 +94,87 @@ def hashable_to_holdout(holdout):
 
 def _load_data_filename(args, **kwargs):
     parts = ["data", "double" if args.double else "single"]
+    if args.include_pairs:
+        parts.append("pairs")
+    if args.sparse_strains:
+        parts.append("sparse")
     for k, v in sorted(kwargs.get("include", {}).items()):
         parts.append(f"I{k}={_safe_str(v)}")
     for k, v in sorted(kwargs.get("exclude", {}).items()):
         parts.append(f"E{k}={_safe_str(v)}")
     parts.append(str(kwargs.get("end_day")))
+    if kwargs.get("keep_cells"):
+        parts.append("cells")
     return "results/mutrans.{}.pt".format(".".join(parts))
 
 
-@cached(_load_data_filename)
+def _load_data_key(args, **kwargs):
+    return fingerprint(
+        "data",
+        args.double,
+        args.include_pairs,
+        args.sparse_strains,
+        kwargs,
+        input_fingerprints(args.cache_by_content),
+        code_version(),
+    )
+
+
+@cached(_load_data_filename, _load_data_key)
 def load_data(args, **kwargs):
     """
     Cached wrapper to load GISAID data.
     """
-    return mutrans.load_gisaid_data(device=args.device, **kwargs)
+    return mutrans.load_gisaid_data(
+        device=args.device,
+        include_pairs=args.include_pairs,
+        sparse_strains=args.sparse_strains,
+        **kwargs,
+    )
 
 
-def _fit_filename(name, *args):
+def _fit_filename(name, *args, warm_start=None):
     strs = [name]
     for arg in args[2:]:
         if isinstance(arg, tuple):
             strs.append("-".join(f"{k}={_safe_str(v)}" for k, v in arg))
         else:
             strs.append(str(arg))
+    if args[0].place_subsample_size:
+        strs.append(f"sub={args[0].place_subsample_size}")
+    if args[0].patience:
+        strs.append(f"patience={args[0].patience}")
+    if warm_start is not None:
+        strs.append("warm")
     return "results/mutrans.{}.pt".format(".".join(strs))
 
 
-@cached(lambda *args: _fit_filename("svi", *args))
+def _fit_key(name, args, dataset, *config, warm_start=None):
+    # Each dataset is determined by the inputs of load_data() together with
+    # the end_day and holdout in config, so fits are keyed by those rather
+    # than by hashing the dataset.
+    return fingerprint(
+        name,
+        args.seed,
+        args.num_samples,
+        args.double,
+        args.jit,
+        args.fused,
+        args.place_subsample_size,
+        args.patience,
+        args.loss_tol,
+        args.param_tol,
+        _load_data_key(args),
+        config,
+        warm_start,
+        code_version(),
+    )
+
+
+@cached(
+    lambda *args, **kwargs: _fit_filename("svi", *args, **kwargs),
+    lambda *args, **kwargs: _fit_key("svi", *args, **kwargs),
+)
 def fit_svi(
     args,
     dataset,
@@ -104,16 +189,29 @@ def fit_svi(
     f=6,
     end_day=None,
     holdout=(),
+    *,
+    warm_start=None,
 ):
     """
-    Cached wrapper to fit a model via SVI.
+    Cached wrapper to fit a model via SVI, optionally warm started from the
+    ``"guide_state"`` of a previous result.
     """
+    checkpoint_filename = checkpoint_key = None
+    if args.checkpoint_every:
+        config = (cond_data, model_type, guide_type, n, lr, lrd, cn, r, f)
+        config += (end_day, holdout)
+        checkpoint_filename = _fit_filename(
+            "svi", args, dataset, *config, warm_start=warm_start
+        )
+        checkpoint_filename = checkpoint_filename[: -len(".pt")] + ".checkpoint.pt"
+        checkpoint_key = _fit_key("svi", args, dataset, *config, warm_start=warm_start)
     cond_data = [kv.split("=") for kv in cond_data.split(",") if kv]
     cond_data = {k: float(v) for k, v in cond_data}
     holdout = hashable_to_holdout(holdout)
 
-    result = mutrans.fit_svi(
+    result = mutrans.fit_svi_distributed(
         dataset,
+        num_workers=args.num_workers,
         cond_data=cond_data,
         model_type=model_type,
         guide_type=guide_type,
@@ -127,7 +225,19 @@ def fit_svi(
         seed=args.seed,
         jit=args.jit,
         num_samples=args.num_samples,
+        place_subsample_size=args.place_subsample_size,
+        fused=args.fused,
+        patience=args.patience,
+        loss_tol=args.loss_tol,
+        param_tol=args.param_tol,
+        checkpoint_filename=checkpoint_filename,
+        checkpoint_every=args.checkpoint_every,
+        checkpoint_key=checkpoint_key,
+        resume=args.resume,
+        warm_start=warm_start,
     )
+    if checkpoint_filename is not None and os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
 
     if "lineage" in holdout.get("exclude", {}):
         # Save only what's needed to evaluate loo predictions.
@@ -136,12 +246,63 @@ def fit_svi(
                 "coef": result["median"]["coef"].float(),  # [F]
                 "rate_loc": result["median"]["rate_loc"].float(),  # [S]
             },
+            "stop_reason": result["stop_reason"],
+            "num_steps": result["num_steps"],
         }
 
     result["args"] = args
     return result
 
 
+def _fit_loo_filename(args, dataset, configs, masks, warm_start=None):
+    # Names a batch by the holdouts of its first and last configs.
+    config = configs[0][:-1] + (configs[0][-1], configs[-1][-1])
+    return _fit_filename("svi_loo", args, dataset, *config, warm_start=warm_start)
+
+
+def _fit_loo_key(args, dataset, configs, masks, warm_start=None):
+    return _fit_key("svi_loo", args, dataset, *configs, warm_start=warm_start)
+
+
+@cached(_fit_loo_filename, _fit_loo_key)
+def fit_svi_loo(args, dataset, configs, masks, warm_start=None):
+    """
+    Cached wrapper to fit a batch of leave-one-lineage-out configs at once,
+    where ``masks[k]`` zeros out the lineages held out by ``configs[k]``.
+    Configs may differ only in their holdout.
+    """
+    cond_data, model_type, guide_type, n, lr, lrd, cn, r, *_ = configs[0]
+    cond_data = [kv.split("=") for kv in cond_data.split(",") if kv]
+    cond_data = {k: float(v) for k, v in cond_data}
+
+    results = mutrans.fit_svi_loo(
+        dataset,
+        masks,
+        model_type=model_type,
+        cond_data=cond_data,
+        learning_rate=lr,
+        learning_rate_decay=lrd,
+        num_steps=n,
+        clip_norm=cn,
+        rank=r,
+        log_every=args.log_every,
+        seed=args.seed,
+        warm_start=warm_start,
+    )
+
+    # Save only what's needed to evaluate loo predictions.
+    return {
+        config: {
+            "median": {
+                "coef": result["median"]["coef"].float(),  # [F]
+                "rate_loc": result["median"]["rate_loc"].float(),  # [S]
+            },
+            "args": args,
+        }
+        for config, result in zip(configs, results)
+    }
+
+
 def backtesting(args, default_config):
     configs = []
     empty_holdout = ()
@@ -162,8 +323,14 @@ def backtesting(args, default_config):
                 empty_holdout,
             )
         )
+    if args.backtesting_slice:
+        # Load data once at the latest end_day, then slice it for each config.
+        end_day = max(config[-2] for config in configs)
+        full_dataset = load_data(args, end_day=end_day, keep_cells=True)
+
     # Sequentially fit models.
     results = {}
+    warm_start = None
     for config in configs:
         logger.info(f"Config: {config}")
 
@@ -173,11 +340,16 @@ def backtesting(args, default_config):
         end_day = config[-2]
 
         # load dataset
-        dataset = load_data(args, end_day=end_day, **holdout)
+        if args.backtesting_slice:
+            dataset = mutrans.slice_gisaid_data(full_dataset, end_day)
+        else:
+            dataset = load_data(args, end_day=end_day, **holdout)
 
-        # Run SVI
-        result = fit_svi(args, dataset, *config)
+        # Run SVI, optionally warm starting from the previous end_day.
+        result = fit_svi(args, dataset, *config, warm_start=warm_start)
         mutrans.log_stats(dataset, result)
+        if args.warm_start:
+            warm_start = result["guide_state"]
 
         # Save the results for this config
 
@@ -187,6 +359,8 @@ def backtesting(args, default_config):
         # Generate results
         result["mutations"] = dataset["mutations"]
         result["weekly_strains"] = dataset["weekly_strains"]
+        if result["weekly_strains"].is_sparse:
+            result["weekly_strains"] = result["weekly_strains"].to_dense()
         result["weekly_cases"] = dataset["weekly_cases"]
         result["weekly_strains_shape"] = tuple(dataset["weekly_strains"].shape)
         result["location_id"] = dataset["location_id"]
@@ -247,31 +421,63 @@ def vary_leaves(args, default_config):
         )
     )
 
-    # Run inference for each lineage. This is very expensive.
-    results = {}
-    for lineage in lineages:
-        config = make_config(exclude={"lineage": "^" + lineage + "$"})
-        logger.info(f"Config: {config}")
-
-        # Construct a leave-one-out dataset by zeroing out a subclade.
+    def make_mask(lineage):
+        # Zero out a subclade.
         clade = [lineage_id[lineage]]
         for descendent in descendents[lineage]:
             clade.append(lineage_id[descendent])
-        loo_dataset = dataset.copy()
-        loo_dataset["weekly_strains"] = dataset["weekly_strains"].clone()
-        loo_dataset["weekly_strains"][:, :, clade] = 0
-
-        # Run SVI
-        result = fit_svi(args, loo_dataset, *config)
-        result["mutations"] = dataset["mutations"]
-        result["location_id"] = dataset["location_id"]
-        result["lineage_id_inv"] = dataset["lineage_id_inv"]
-        results[config] = result
+        mask = torch.ones(len(lineage_id), device=args.device)
+        mask[clade] = 0
+        return mask
 
-        # Cleanup
-        del result
-        pyro.clear_param_store()
-        gc.collect()
+    # Optionally warm start each leave-one-out fit from the full fit.
+    warm_start = result["guide_state"] if args.warm_start else None
+    results = {}
+    if args.loo_batch_size:
+        # Run batches of lineages at once.
+        for i in range(0, len(lineages), args.loo_batch_size):
+            batch = lineages[i : i + args.loo_batch_size]
+            configs = [
+                make_config(exclude={"lineage": "^" + lineage + "$"})
+                for lineage in batch
+            ]
+            logger.info(f"Configs: {configs}")
+            masks = torch.stack([make_mask(lineage) for lineage in batch])
+            batch_results = fit_svi_loo(
+                args, dataset, configs, masks, warm_start=warm_start
+            )
+            for config, result in batch_results.items():
+                result["mutations"] = dataset["mutations"]
+                result["location_id"] = dataset["location_id"]
+                result["lineage_id_inv"] = dataset["lineage_id_inv"]
+                results[config] = result
+
+            # Cleanup
+            del batch_results, result
+            pyro.clear_param_store()
+            gc.collect()
+    else:
+        # Run inference for each lineage. This is very expensive.
+        for lineage in lineages:
+            config = make_config(exclude={"lineage": "^" + lineage + "$"})
+            logger.info(f"Config: {config}")
+
+            # Construct a leave-one-out dataset by zeroing out a subclade.
+            loo_dataset = dataset.copy()
+            mask = make_mask(lineage)
+            loo_dataset["weekly_strains"] = dataset["weekly_strains"] * mask
+
+            # Run SVI
+            result = fit_svi(args, loo_dataset, *config, warm_start=warm_start)
+            result["mutations"] = dataset["mutations"]
+            result["location_id"] = dataset["location_id"]
+            result["lineage_id_inv"] = dataset["lineage_id_inv"]
+            results[config] = result
+
+            # Cleanup
+            del result
+            pyro.clear_param_store()
+            gc.collect()
 
     if not args.test:
         logger.info("saving results/mutrans.vary_leaves.pt")
@@ -468,7 +674,7 @@ def main(args):
                 )
             )
     elif args.backtesting_max_day:
-        backtesting(args, default_config)
+        return backtesting(args, default_config)
     else:
         configs.append(default_config)
 
@@ -497,6 +703,8 @@ def main(args):
         # Generate results
         result["mutations"] = dataset["mutations"]
         result["weekly_strains"] = dataset["weekly_strains"]
+        if result["weekly_strains"].is_sparse:
+            result["weekly_strains"] = result["weekly_strains"].to_dense()
         result["weekly_cases"] = dataset["weekly_cases"]
         result["weekly_strains_shape"] = tuple(dataset["weekly_strains"].shape)
         result["location_id"] = dataset["location_id"]
@@ -531,35 +739,134 @@ if __name__ == "__main__":
     parser.add_argument(
         "--vary-leaves", type=int, help="min number of samples per held out lineage"
     )
+    parser.add_argument(
+        "--loo-batch-size",
+        type=int,
+        help="number of held out lineages to fit at once in --vary-leaves",
+    )
     parser.add_argument("--vary-gene", action="store_true")
     parser.add_argument("--vary-nsp", action="store_true")
     parser.add_argument("--only-gene")
+    parser.add_argument(
+        "--include-pairs",
+        action="store_true",
+        help="include features of pairs of mutations",
+    )
+    parser.add_argument(
+        "--sparse-strains",
+        action="store_true",
+        help="store counts as a sparse tensor and use a sparse likelihood",
+    )
     parser.add_argument("-cd", "--cond-data", default="coef_scale=0.5")
     parser.add_argument("-m", "--model-type", default="sparse-skip-reparam")
     parser.add_argument("-g", "--guide-type", default="custom")
-    parser.add_argument("-n", "--num-steps", default=10001, type=int)
+    parser.add_argument(
+        "-n",
+        "--num-steps",
+        default=10001,
+        type=int,
+        help="number of SVI steps, or the maximum number if --patience is set",
+    )
     parser.add_argument("-s", "--num-samples", default=1000, type=int)
     parser.add_argument("-lr", "--learning-rate", default=0.05, type=float)
     parser.add_argument("-lrd", "--learning-rate-decay", default=0.1, type=float)
     parser.add_argument("-cn", "--clip-norm", default=10.0, type=float)
     parser.add_argument("-r", "--rank", default=200, type=int)
     parser.add_argument("-f", "--forecast-steps", default=6, type=int)
+    parser.add_argument(
+        "--place-subsample-size",
+        type=int,
+        help="number of places to subsample in each SVI step",
+    )
+    parser.add_argument(
+        "--patience",
+        type=int,
+        help="stop SVI early if it has converged over this many steps",
+    )
+    parser.add_argument(
+        "--loss-tol",
+        default=1e-4,
+        type=float,
+        help="early stopping tolerance of smoothed loss per observation",
+    )
+    parser.add_argument(
+        "--param-tol",
+        default=1e-3,
+        type=float,
+        help="early stopping tolerance of relative parameter change",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        help="save a checkpoint of SVI every this many steps",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume SVI from a checkpoint saved by --checkpoint-every",
+    )
+    parser.add_argument(
+        "-j",
+        "--num-workers",
+        default=1,
+        type=int,
+        help="number of CPU processes over which to shard places during SVI",
+    )
     parser.add_argument("-fp64", "--double", action="store_true")
     parser.add_argument("-fp32", "--float", action="store_false", dest="double")
     parser.add_argument(
         "--cuda", action="store_true", default=torch.cuda.is_available()
     )
     parser.add_argument("-b", "--backtesting-max-day", default=None)
+    parser.add_argument(
+        "--backtesting-slice",
+        action="store_true",
+        help="load data once at the latest backtesting day and slice it",
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="start each backtesting fit from the previous fit, or each "
+        "--vary-leaves fit from the full fit, e.g. with --patience",
+    )
     parser.add_argument("--cpu", dest="cuda", action="store_false")
     parser.add_argument("--jit", action="store_true", default=False)
     parser.add_argument("--no-jit", dest="jit", action="store_false")
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="use a hand-fused ELBO for the default model and guide",
+    )
     parser.add_argument("--seed", default=20210319, type=int)
     parser.add_argument("-l", "--log-every", default=50, type=int)
     parser.add_argument("--no-new", action="store_true")
     parser.add_argument("--no-cache", action="store_true")
     parser.add_argument("--force", action="store_true")
+    parser.add_argument(
+        "--cache-max-gb",
+        default=math.inf,
+        type=float,
+        help="evict least recently used cached results above this size",
+    )
+    parser.add_argument(
+        "--cache-by-content",
+        action="store_true",
+        help="fingerprint input files by content rather than modification time",
+    )
     parser.add_argument("--test", action="store_true")
     parser.add_argument("--debug", action="store_true")
     args = parser.parse_args()
+    if args.cuda and args.num_workers > 1:
+        parser.error("--num-workers requires --cpu")
+    if args.warm_start and args.guide_type != "custom":
+        parser.error("--warm-start requires --guide-type=custom")
+    if args.loo_batch_size and args.guide_type != "custom":
+        parser.error("--loo-batch-size requires --guide-type=custom")
+    if args.loo_batch_size and args.model_type != "sparse-skip-reparam":
+        parser.error("--loo-batch-size requires --model-type=sparse-skip-reparam")
+    if args.checkpoint_every and args.num_workers > 1:
+        parser.error("--checkpoint-every does not support --num-workers")
+    if args.resume and not args.checkpoint_every:
+        parser.error("--resume requires --checkpoint-every")
     args.device = "cuda" if args.cuda else "cpu"
     main(args)
@@ -2,36 +2,37 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
-import datetime
-import json
 import logging
+import math
 import os
 import pickle
-import warnings
 from collections import Counter, defaultdict
 
-from pyrocov import pangolin
-from pyrocov.geo import gisaid_normalize
+from pyrocov import columnar, gisaid
 from pyrocov.mutrans import START_DATE
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
 
-DATE_FORMATS = {4: "%Y", 7: "%Y-%m", 10: "%Y-%m-%d"}
 
-
-def parse_date(string):
-    fmt = DATE_FORMATS.get(len(string))
-    if fmt is None:
-        # Attempt to fix poorly formated dates like 2020-09-1.
-        parts = string.split("-")
-        parts = parts[:1] + [f"{int(p):>02d}" for p in parts[1:]]
-        string = "-".join(parts)
-        fmt = DATE_FORMATS[len(string)]
-    return datetime.datetime.strptime(string, fmt)
-
-
-FIELDS = ["virus_name", "accession_id", "collection_date", "location", "add_location"]
+def remove_rows(columns, stats, accession_ids):
+    """
+    Removes rows with given ``accession_ids`` from ``columns``, and
+    decrements their contribution to ``stats``.
+    """
+    keep = [a not in accession_ids for a in columns["accession_id"]]
+    for i, k in enumerate(keep):
+        if not k:
+            stats["date"][columns["collection_date"][i]] -= 1
+            stats["location"][columns["location"][i]] -= 1
+            stats["lineage"][columns["lineage"][i]] -= 1
+    for counts in stats.values():
+        for key, count in list(counts.items()):
+            if count <= 0:
+                del counts[key]
+    for key, values in columns.items():
+        columns[key] = [v for k, v in zip(keep, values) if k]
+    return len(keep) - sum(keep)
 
 
 def main(args):
@@ -40,75 +41,78 @@ def main(args):
         raise OSError(f"Missing {args.gisaid_file_in}; you may need to request a feed")
     os.makedirs("results", exist_ok=True)
 
-    columns = defaultdict(list)
-    stats = defaultdict(Counter)
-    covv_fields = ["covv_" + key for key in FIELDS]
-
-    with open(args.gisaid_file_in) as f:
-        for i, line in enumerate(f):
-            # Optimize for faster reading.
-            line, _ = line.split(', "sequence": ', 1)
-            line += "}"
-
-            # Filter out bad data.
-            datum = json.loads(line)
-            if len(datum["covv_collection_date"]) < 7:
-                continue  # Drop rows with no month information.
-            date = parse_date(datum["covv_collection_date"])
-            if date < args.start_date:
-                date = args.start_date  # Clip rows before start date.
-            lineage = datum["covv_lineage"]
-            if lineage in (None, "None", "", "XA"):
-                continue  # Drop rows with unknown or ambiguous lineage.
-            try:
-                lineage = pangolin.compress(lineage)
-                lineage = pangolin.decompress(lineage)
-                assert lineage
-            except (ValueError, AssertionError) as e:
-                warnings.warn(str(e))
-                continue
-
-            # Fix duplicate locations.
-            datum["covv_location"] = gisaid_normalize(datum["covv_location"])
-
-            # Collate.
-            columns["lineage"].append(lineage)
-            for covv_key, key in zip(covv_fields, FIELDS):
-                columns[key].append(datum[covv_key])
-            columns["day"].append((date - args.start_date).days)
-
-            # Aggregate statistics.
-            stats["date"][datum["covv_collection_date"]] += 1
-            stats["location"][datum["covv_location"]] += 1
-            stats["lineage"][lineage] += 1
-
-            if i % args.log_every == 0:
-                print(".", end="", flush=True)
-            if i >= args.truncate:
-                break
-
-    num_dropped = i + 1 - len(columns["day"])
-    logger.info(f"dropped {num_dropped}/{i+1} = {num_dropped/(i+1)/100:0.2g}% rows")
-
-    logger.info(f"saving {args.columns_file_out}")
-    with open(args.columns_file_out, "wb") as f:
-        pickle.dump(dict(columns), f)
+    checkpoint = {"accession_ids": {}, "fingerprints": set()}
+    offset = 0
+    if args.incremental and os.path.exists(args.checkpoint_file):
+        checkpoint, offset = gisaid.load_checkpoint(args)
+    seen = frozenset(checkpoint["fingerprints"])
+
+    columns, stats, fingerprints, num_parsed = gisaid.process_feed(args, offset, seen)
+    del seen
+    num_kept = len(columns["day"])
+
+    if args.incremental and checkpoint["accession_ids"]:
+        # Replace revised rows and append new rows to the previous results.
+        old_columns = columnar.load_columns(args.columns_dir_out)
+        old_columns = defaultdict(list, {k: v.tolist() for k, v in old_columns.items()})
+        with open(args.stats_file_out, "rb") as f:
+            old_stats = defaultdict(Counter, pickle.load(f))
+        old_fingerprints = checkpoint["accession_ids"]
+        revised = {a for a in fingerprints if a in old_fingerprints}
+        for a in revised:
+            checkpoint["fingerprints"].discard(old_fingerprints[a])
+        num_revised = remove_rows(old_columns, old_stats, revised)
+        for key, values in columns.items():
+            old_columns[key].extend(values)
+        for key, counts in stats.items():
+            old_stats[key].update(counts)
+        columns, stats = old_columns, old_stats
+        logger.info(f"Replaced {num_revised} revised rows and appended {num_kept} rows")
+    checkpoint["accession_ids"].update(fingerprints)
+    checkpoint["fingerprints"].update(fingerprints.values())
+
+    logger.info(f"saving {args.columns_dir_out}")
+    columnar.save_columns(columns, args.columns_dir_out)
+    logger.info(f"saving {args.cube_file_out}")
+    cube = columnar.count_cells(columns)
+    columnar.save_cube(cube, args.cube_file_out, args.columns_dir_out)
+    if args.columns_file_out:
+        logger.info(f"saving {args.columns_file_out}")
+        with open(args.columns_file_out, "wb") as f:
+            pickle.dump(dict(columns), f)
 
     logger.info(f"saving {args.stats_file_out}")
     with open(args.stats_file_out, "wb") as f:
         pickle.dump(dict(stats), f)
 
+    gisaid.update_checkpoint(args, checkpoint)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Preprocess GISAID data")
-    parser.add_argument("--gisaid-file-in", default="results/gisaid.json")
-    parser.add_argument("--columns-file-out", default="results/gisaid.columns.pkl")
+    parser.add_argument("--gisaid-file-in", default="results/gisaid.json.xz")
+    parser.add_argument("--columns-dir-out", default="results/gisaid.columns")
+    parser.add_argument(
+        "--columns-file-out",
+        default="results/gisaid.columns.pkl",
+        help="optional pickle export of columns, or empty to skip",
+    )
+    parser.add_argument("--cube-file-out", default="results/gisaid.cube.pkl")
     parser.add_argument("--stats-file-out", default="results/gisaid.stats.pkl")
+    parser.add_argument("--checkpoint-file", default="results/gisaid.checkpoint.pkl")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="parse only rows that are new or revised since the last run",
+    )
     parser.add_argument("--subset-file-out", default="results/gisaid.subset.tsv")
     parser.add_argument("--subset-dir-out", default="results/fasta")
     parser.add_argument("--start-date", default=START_DATE)
     parser.add_argument("-l", "--log-every", default=1000, type=int)
-    parser.add_argument("--truncate", default=int(1e10), type=int)
+    parser.add_argument("--truncate", default=math.inf, type=int)
+    parser.add_argument(
+        "-j", "--num-workers", default=1, type=int, help="number of worker processes"
+    )
     args = parser.parse_args()
-    args.start_date = parse_date(args.start_date)
+    args.start_date = gisaid.parse_date(args.start_date)
     main(args)
@@ -3,24 +3,58 @@
 
 import math
 
-import mappy
+import numpy as np
+
+from .sarscov2 import GENE_TO_POSITION
 
 # Source: https://samtools.github.io/hts-specs/SAMv1.pdf
 CIGAR_CODES = "MIDNSHP=X"  # Note minimap2 uses only "MIDNSH"
 
+# The standard genetic code, with codons ordered TTT, TTC, TTA, TTG, TCT, ...
+GENETIC_CODE = dict(
+    zip(
+        (a + b + c for a in "TCAG" for b in "TCAG" for c in "TCAG"),
+        "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    )
+)
+NUCLEOTIDES = "ACGT"
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY*-"  # Including stop "*" and deletion "-".
+
+
+def _encode_nucleotides(seq):
+    # Maps A,C,G,T to 0,1,2,3 and all other characters to 4.
+    codes = np.full(256, 4, dtype=np.int64)
+    codes[np.frombuffer(NUCLEOTIDES.encode(), dtype=np.uint8)] = np.arange(4)
+    return codes[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+
+# Maps codon codes 16 * b0 + 4 * b1 + b2 to amino acid indices.
+_CODON_TO_AA = np.array(
+    [
+        AMINO_ACIDS.index(GENETIC_CODE[a + b + c])
+        for a in NUCLEOTIDES
+        for b in NUCLEOTIDES
+        for c in NUCLEOTIDES
+    ]
+)
+
 
 class Differ:
     def __init__(self, ref, lb=0, ub=math.inf, **kwargs):
+        import mappy
+
         self.ref = ref
         self.lb = lb
         self.ub = ub
         self.aligner = mappy.Aligner(seq=ref, **kwargs)
+        self._ref_array = np.frombuffer(ref.encode(), dtype=np.uint8)
 
     def diff(self, seq):
         ref = self.ref
         lb = self.lb
         ub = self.ub
         diff = []
+        seq_array = np.frombuffer(seq.encode(), dtype=np.uint8)
         for hit in self.aligner.map(seq):
             ref_pos = hit.r_st
             if ref_pos < lb:
@@ -32,15 +66,230 @@ class Differ:
             for size, code in hit.cigar:
                 if code == 0:  # M
                     if seq[seq_pos : seq_pos + size] != ref[ref_pos : ref_pos + size]:
-                        for i in range(min(size, ub - ref_pos)):
-                            s = seq[seq_pos + i]
-                            if s != "N" and s != ref[ref_pos + i]:
-                                diff.append((ref_pos + i, "X", s))
+                        n = min(size, ub - ref_pos)
+                        s = seq_array[seq_pos : seq_pos + n]
+                        r = self._ref_array[ref_pos : ref_pos + n]
+                        for i in np.flatnonzero((s != r) & (s != ord("N"))).tolist():
+                            diff.append((ref_pos + i, "X", seq[seq_pos + i]))
+                    ref_pos += size
+                    seq_pos += size
                 elif code == 1:  # I
                     diff.append((ref_pos, "I", seq[seq_pos : seq_pos + size]))
+                    seq_pos += size
                 elif code == 2:  # D
                     diff.append((ref_pos, "D", size))
-                ref_pos += size
-                seq_pos += size
+                    ref_pos += size
 
         return diff
+
+
+def diff_to_aa_mutations(ref, diff, genes=GENE_TO_POSITION):
+    """
+    Translates a nucleotide ``diff`` as returned by :meth:`Differ.diff` into
+    nextclade-style amino acid substitutions like ``"S:N501Y"`` and deletions
+    like ``"S:H69-"``.
+
+    This is approximate: insertions and frameshifts are ignored, and a codon
+    is considered deleted only if all three of its bases are deleted. See
+    :class:`CodonTranslator` for a vectorized batch version.
+
+    :param str ref: The reference sequence.
+    :param list diff: A list of ``(pos, "X"|"I"|"D", value)`` tuples.
+    :param dict genes: A dict mapping gene name to 1-based inclusive
+        ``(start, end)`` positions in the reference.
+    :returns: a pair ``(substitutions, deletions)`` of lists of strings,
+        ordered by gene then position.
+    """
+    snvs = {pos: value for pos, code, value in diff if code == "X"}
+    deleted = set()
+    for pos, code, value in diff:
+        if code == "D":
+            deleted.update(range(pos, pos + value))
+
+    substitutions = []
+    deletions = []
+    for gene, (start, end) in genes.items():
+        start -= 1  # Convert to 0-based.
+        num_codons = (end - start) // 3
+        codons = sorted(
+            {(p - start) // 3 for p in list(snvs) + list(deleted) if start <= p < end}
+        )
+        for c in codons:
+            if c >= num_codons:
+                continue
+            begin = start + 3 * c
+            bases = range(begin, begin + 3)
+            ref_aa = GENETIC_CODE.get(ref[begin : begin + 3], "X")
+            if ref_aa == "X":
+                continue
+            if all(p in deleted for p in bases):
+                deletions.append(f"{gene}:{ref_aa}{c + 1}-")
+            elif not any(p in deleted for p in bases):
+                codon = "".join(snvs.get(p, ref[p]) for p in bases)
+                aa = GENETIC_CODE.get(codon, "X")
+                if aa != ref_aa and aa != "X":
+                    substitutions.append(f"{gene}:{ref_aa}{c + 1}{aa}")
+    return substitutions, deletions
+
+
+class CodonTranslator:
+    """
+    Vectorized batch version of :func:`diff_to_aa_mutations`, translating
+    many nucleotide diffs at once and interning amino acid mutations to
+    integer ids.
+
+    Each codon of each gene is a "site". Diffs are mapped onto sites by
+    array indexing, and mutated codons are translated by table lookup, so
+    that no Python work is done per codon.
+
+    :param str ref: The reference sequence.
+    :param dict genes: A dict mapping gene name to 1-based inclusive
+        ``(start, end)`` positions in the reference.
+    """
+
+    def __init__(self, ref, genes=GENE_TO_POSITION):
+        self.ref = ref
+        self.genes = list(genes)
+        self.mutations = []
+
+        # Enumerate sites in order of gene then codon.
+        site_gene, site_codon, site_start = [], [], []
+        for g, (start, end) in enumerate(genes.values()):
+            num_codons = (end - start + 1) // 3
+            site_gene.append(np.full(num_codons, g))
+            site_codon.append(np.arange(num_codons))
+            site_start.append(start - 1 + 3 * np.arange(num_codons))
+        self._site_gene = np.concatenate(site_gene)
+        self._site_codon = np.concatenate(site_codon)
+        site_start = np.concatenate(site_start)
+        num_sites = len(site_start)
+        self._num_sites = num_sites
+
+        # Map each reference position to the sites overlapping it, e.g. in
+        # overlapping reading frames.
+        positions = (site_start[:, None] + np.arange(3)).reshape(-1)
+        sites = np.repeat(np.arange(num_sites), 3)
+        offsets = np.tile(np.arange(3), num_sites)
+        order = positions.argsort(kind="stable")
+        positions, sites, offsets = positions[order], sites[order], offsets[order]
+        counts = np.bincount(positions, minlength=len(ref))
+        first = np.cumsum(counts) - counts
+        rank = np.arange(len(positions)) - first[positions]
+        shape = (len(ref), max(1, counts.max()))
+        self._pos_site = np.full(shape, -1)
+        self._pos_site[positions, rank] = sites
+        self._pos_offset = np.zeros(shape, dtype=np.int64)
+        self._pos_offset[positions, rank] = offsets
+
+        # Translate reference codons, ignoring sites with ambiguous bases.
+        bases = _encode_nucleotides(ref)[site_start[:, None] + np.arange(3)]
+        self._site_bases = bases
+        self._ref_codon = bases[:, 0] * 16 + bases[:, 1] * 4 + bases[:, 2]
+        self._ref_valid = (bases < 4).all(-1)
+        self._ref_aa = np.where(
+            self._ref_valid, _CODON_TO_AA[self._ref_codon.clip(max=63)], -1
+        )
+
+        # Map (site, amino acid) codes to interned mutation ids.
+        self._ids = np.full(num_sites * len(AMINO_ACIDS), -1)
+
+    def _to_sites(self, rows, positions):
+        # Maps (row, position) pairs to (row, site, offset) triples.
+        ok = (0 <= positions) & (positions < len(self.ref))
+        rows, positions = rows[ok], positions[ok]
+        sites = self._pos_site[positions]
+        offsets = self._pos_offset[positions]
+        ok = sites >= 0
+        rows = np.broadcast_to(rows[:, None], sites.shape)[ok]
+        return rows, sites[ok], offsets[ok], ok.nonzero()[0]
+
+    def _intern(self, codes):
+        ids = self._ids[codes]
+        new = np.unique(codes[ids < 0])
+        if len(new):
+            self._ids[new] = np.arange(
+                len(self.mutations), len(self.mutations) + len(new)
+            )
+            for code in new.tolist():
+                site, aa = divmod(code, len(AMINO_ACIDS))
+                gene = self.genes[self._site_gene[site]]
+                ref_aa = AMINO_ACIDS[self._ref_aa[site]]
+                codon = self._site_codon[site] + 1
+                self.mutations.append(f"{gene}:{ref_aa}{codon}{AMINO_ACIDS[aa]}")
+            ids = self._ids[codes]
+        return ids
+
+    def __call__(self, diffs):
+        """
+        Translates a batch of diffs.
+
+        :param list diffs: A list of diffs, each a list of
+            ``(pos, "X"|"I"|"D", value)`` tuples as returned by
+            :meth:`Differ.diff`.
+        :returns: a pair ``(rows, ids)`` of int64 arrays, where ``rows``
+            indexes into ``diffs`` and ``ids`` indexes into
+            :attr:`mutations`, ordered by row, gene, then position.
+        """
+        num_sites = self._num_sites
+        empty = np.zeros(0, dtype=np.int64)
+        lengths = [len(diff) for diff in diffs]
+        if not sum(lengths):
+            return empty, empty
+        rows = np.repeat(np.arange(len(diffs)), lengths)
+        positions, codes, values = zip(*(t for diff in diffs for t in diff))
+        positions = np.array(positions)
+        codes = np.array(codes)
+
+        # Expand deletions to deleted positions.
+        is_del = (codes == "D").nonzero()[0]
+        sizes = np.array([values[i] for i in is_del.tolist()], dtype=np.int64)
+        del_rows = np.repeat(rows[is_del], sizes)
+        del_positions = np.repeat(positions[is_del], sizes)
+        del_positions += np.arange(len(del_positions)) - np.repeat(
+            np.cumsum(sizes) - sizes, sizes
+        )
+        del_rows, del_sites, _, _ = self._to_sites(del_rows, del_positions)
+        del_keys, del_counts = np.unique(
+            del_rows * num_sites + del_sites, return_counts=True
+        )
+
+        # Mutate reference codons.
+        is_snv = (codes == "X").nonzero()[0]
+        bases = _encode_nucleotides("".join(values[i] for i in is_snv.tolist()))
+        snv_rows, snv_sites, snv_offsets, k = self._to_sites(
+            rows[is_snv], positions[is_snv]
+        )
+        bases = bases[k] if len(bases) else empty
+        snv_keys, inverse = np.unique(
+            snv_rows * num_sites + snv_sites, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+        sites = snv_keys % num_sites
+        ref_bases = self._site_bases[snv_sites, snv_offsets]
+        delta = (bases - ref_bases) * 4 ** (2 - snv_offsets)
+        codons = self._ref_codon[sites] + np.bincount(
+            inverse, weights=delta, minlength=len(snv_keys)
+        ).astype(np.int64)
+        ambiguous = np.bincount(inverse, weights=bases == 4, minlength=len(snv_keys))
+        ok = (ambiguous == 0) & self._ref_valid[sites]
+        ok &= ~np.isin(snv_keys, del_keys)  # Skip partially deleted codons.
+        snv_keys, sites, codons = snv_keys[ok], sites[ok], codons[ok]
+        aas = _CODON_TO_AA[codons]
+        ok = aas != self._ref_aa[sites]
+        snv_keys, sites, aas = snv_keys[ok], sites[ok], aas[ok]
+
+        # Keep only fully deleted codons.
+        del_keys = del_keys[del_counts == 3]
+        del_sites = del_keys % num_sites
+        ok = self._ref_valid[del_sites]
+        del_keys, del_sites = del_keys[ok], del_sites[ok]
+
+        keys = np.concatenate([snv_keys, del_keys])
+        codes = np.concatenate(
+            [
+                sites * len(AMINO_ACIDS) + aas,
+                del_sites * len(AMINO_ACIDS) + AMINO_ACIDS.index("-"),
+            ]
+        )
+        order = keys.argsort()
+        return keys[order] // num_sites, self._intern(codes[order])
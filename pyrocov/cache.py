@@ -0,0 +1,209 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import atexit
+import hashlib
+import inspect
+import json
+import logging
+import math
+import os
+import time
+from argparse import Namespace
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def _update(hasher, obj):
+    # Feeds a type-tagged serialization of obj to hasher.
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        hasher.update(f"{type(obj).__name__}:{obj!r};".encode())
+    elif isinstance(obj, bytes):
+        hasher.update(f"bytes:{len(obj)};".encode())
+        hasher.update(obj)
+    elif isinstance(obj, (tuple, list)):
+        hasher.update(f"{type(obj).__name__}:{len(obj)};".encode())
+        for value in obj:
+            _update(hasher, value)
+    elif isinstance(obj, dict):
+        hasher.update(f"dict:{len(obj)};".encode())
+        for key, value in sorted(obj.items(), key=lambda kv: repr(kv[0])):
+            _update(hasher, key)
+            _update(hasher, value)
+    elif isinstance(obj, Namespace):
+        _update(hasher, vars(obj))
+    elif isinstance(obj, torch.Tensor):
+        if obj.is_sparse:
+            obj = obj.coalesce()
+            hasher.update(f"sparse:{tuple(obj.shape)};".encode())
+            _update(hasher, obj.indices())
+            _update(hasher, obj.values())
+            return
+        obj = obj.detach().cpu().contiguous()
+        hasher.update(f"tensor:{obj.dtype}:{tuple(obj.shape)};".encode())
+        hasher.update(obj.view(-1).view(torch.uint8).numpy().tobytes())
+    elif isinstance(obj, np.ndarray):
+        obj = np.ascontiguousarray(obj)
+        hasher.update(f"ndarray:{obj.dtype}:{obj.shape};".encode())
+        hasher.update(obj.tobytes())
+    else:
+        raise TypeError(f"Cannot fingerprint {type(obj).__name__}")
+
+
+def fingerprint(*objs):
+    """
+    Computes a stable hex digest of nested tuples, lists, dicts and
+    primitives, including tensors and arrays by content.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    _update(hasher, objs)
+    return hasher.hexdigest()
+
+
+def file_fingerprint(filename, content=False):
+    """
+    Fingerprints a file or directory, by either its sizes and modification
+    times or, if ``content`` is true, its contents. Missing files have a
+    fingerprint of None.
+    """
+    if not os.path.exists(filename):
+        return None
+    if os.path.isdir(filename):
+        filenames = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(filename)
+            for name in names
+        )
+    else:
+        filenames = [filename]
+    hasher = hashlib.blake2b(digest_size=16)
+    for name in filenames:
+        hasher.update(os.path.relpath(name, filename).encode())
+        if content:
+            with open(name, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    hasher.update(chunk)
+        else:
+            stat = os.stat(name)
+            hasher.update(f":{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return hasher.hexdigest()
+
+
+def code_fingerprint(*objs):
+    """
+    Fingerprints the source files defining modules, classes or functions, as
+    a code version.
+    """
+    return fingerprint(
+        *(file_fingerprint(inspect.getsourcefile(obj), content=True) for obj in objs)
+    )
+
+
+def torch_load(filename, map_location=None):
+    """
+    Loads a trusted file saved by :func:`torch.save`, which may pickle
+    arbitrary objects, on torch versions with or without ``weights_only``.
+    """
+    kwargs = {}
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        kwargs["weights_only"] = False
+    return torch.load(filename, map_location=map_location, **kwargs)
+
+
+class ArtifactCache:
+    """
+    A size-bounded cache of torch-serialized artifacts at human-readable
+    filenames, validated by keys that fingerprint their inputs.
+
+    A json ``manifest`` records the key, size and last access time of each
+    artifact. An artifact is reused only if its recorded key matches the
+    requested key, so artifacts whose inputs changed are recomputed while
+    others are kept. Least recently used artifacts are deleted to keep the
+    total size under ``max_bytes``. Files not in the manifest are never
+    deleted. Access times of cache hits are saved on the next :meth:`put` or
+    :meth:`flush`, and at exit.
+
+    :param str manifest: Path to the manifest file.
+    :param float max_bytes: Maximum total size of artifacts.
+    """
+
+    def __init__(self, manifest="results/cache.json", max_bytes=math.inf):
+        self.manifest = manifest
+        self.max_bytes = max_bytes
+        self._entries = {}
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                self._entries = json.load(f)
+        self._entries = {f: e for f, e in self._entries.items() if os.path.exists(f)}
+        self._dirty = False
+        atexit.register(self.flush)
+
+    def _save_manifest(self):
+        temp = self.manifest + ".temp"
+        with open(temp, "w") as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(temp, self.manifest)
+        self._dirty = False
+
+    def flush(self):
+        """
+        Saves access times updated by :meth:`get`, if any.
+        """
+        if self._dirty:
+            self._save_manifest()
+
+    def get(self, filename, key):
+        """
+        Loads a cached artifact.
+
+        :returns: a pair ``(found, value)``.
+        """
+        entry = self._entries.get(filename)
+        if entry is None:
+            if os.path.exists(filename):
+                logger.info(f"ignoring unversioned {filename}")
+            return False, None
+        if entry["key"] != key:
+            logger.info(f"ignoring stale {filename}")
+            return False, None
+        value = torch_load(filename, map_location=torch.empty(()).device)
+        entry["atime"] = time.time()
+        self._dirty = True
+        return True, value
+
+    def put(self, filename, key, value):
+        """
+        Saves an artifact, then evicts least recently used artifacts if
+        needed.
+        """
+        temp = filename + ".temp"
+        torch.save(value, temp)
+        os.replace(temp, filename)
+        self._entries[filename] = {
+            "key": key,
+            "size": os.path.getsize(filename),
+            "atime": time.time(),
+        }
+        self.evict(keep=filename)
+        self._save_manifest()
+
+    def evict(self, keep=None):
+        """
+        Deletes least recently used artifacts until the total size is under
+        ``max_bytes``.
+        """
+        total = sum(e["size"] for e in self._entries.values())
+        for filename, entry in sorted(
+            self._entries.items(), key=lambda fe: fe[1]["atime"]
+        ):
+            if total <= self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            logger.info(f"evicting {filename}")
+            os.remove(filename)
+            del self._entries[filename]
+            total -= entry["size"]
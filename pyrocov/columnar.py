@@ -0,0 +1,300 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import logging
+import os
+import pickle
+import shutil
+from collections.abc import Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class CategoricalColumn(Sequence):
+    """
+    A read-only sequence of strings stored as integer ``codes`` into a
+    ``vocab`` list. Vocabulary entries are ordered by first appearance.
+
+    :param numpy.ndarray codes: An int32 array of codes.
+    :param list vocab: A list of unique strings.
+    """
+
+    def __init__(self, codes, vocab):
+        self.codes = codes
+        self.vocab = vocab
+
+    @staticmethod
+    def encode(values):
+        index = {}
+        codes = np.array(
+            [index.setdefault(v, len(index)) for v in values], dtype=np.int32
+        )
+        return CategoricalColumn(codes, list(index))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.vocab[c] for c in self.codes[i].tolist()]
+        return self.vocab[self.codes[i]]
+
+    def __iter__(self):
+        return map(self.vocab.__getitem__, self.codes.tolist())
+
+    def tolist(self):
+        return list(self)
+
+
+class StringColumn(Sequence):
+    """
+    A read-only sequence of strings stored as concatenated utf-8 ``data`` with
+    ``offsets`` such that the ``i``th string is
+    ``data[offsets[i]:offsets[i+1]]``.
+
+    :param numpy.ndarray data: A uint8 array.
+    :param numpy.ndarray offsets: An int64 array of length one more than the
+        number of strings.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def encode(values):
+        encoded = [v.encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(v) for v in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return StringColumn(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self.data[self.offsets[i] : self.offsets[i + 1]].tobytes().decode()
+
+    def __iter__(self):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        for begin, end in zip(offsets, offsets[1:]):
+            yield data[begin:end].decode()
+
+    def tolist(self):
+        return list(self)
+
+
+def factorize(values):
+    """
+    Encodes a column as integer codes into a list of unique values, ordered
+    by first appearance. This is free for :class:`CategoricalColumn` s.
+
+    :returns: a pair ``(codes, uniques)`` where ``codes`` is an int64 numpy
+        array.
+    """
+    if not isinstance(values, CategoricalColumn):
+        values = CategoricalColumn.encode(values)
+    return np.asarray(values.codes, dtype=np.int64), values.vocab
+
+
+def save_columns(columns: dict, dirname: str) -> None:
+    """
+    Saves a dict of equal-length lists to a column store directory.
+    Any existing store at ``dirname`` is replaced by renaming it aside and
+    then renaming the new store into place, so that a crash never leaves a
+    partially written store at ``dirname``.
+
+    Integer columns are stored as int32 arrays, low-cardinality string columns
+    (e.g. location and lineage) as int32 codes plus a vocabulary, and
+    high-cardinality string columns (e.g. virus name) as concatenated utf-8
+    bytes plus offsets. All arrays are ``.npy`` files that can be memory
+    mapped by :func:`load_columns`.
+
+    :param dict columns: A dict mapping column name to a list of ints or
+        strings, as produced by ``preprocess_gisaid.py``.
+    :param str dirname: The output directory.
+    """
+    temp_dirname = dirname.rstrip("/") + ".temp"
+    old_dirname = dirname.rstrip("/") + ".old"
+    if os.path.exists(temp_dirname):
+        shutil.rmtree(temp_dirname)
+    if os.path.exists(old_dirname):
+        if os.path.exists(dirname):
+            shutil.rmtree(old_dirname)
+        else:  # Recover from a crash between renames.
+            os.rename(old_dirname, dirname)
+    os.makedirs(temp_dirname)
+
+    meta: dict = {"version": VERSION, "num_rows": None, "columns": {}}
+    for name, values in columns.items():
+        if meta["num_rows"] is None:
+            meta["num_rows"] = len(values)
+        assert len(values) == meta["num_rows"], name
+        if isinstance(values, (CategoricalColumn, StringColumn)):
+            column = values
+        elif isinstance(values, np.ndarray) or all(isinstance(v, int) for v in values):
+            column = np.asarray(values, dtype=np.int32)
+        else:
+            column = CategoricalColumn.encode(values)
+            if len(column.vocab) > len(values) // 2:
+                column = StringColumn.encode(values)
+
+        prefix = os.path.join(temp_dirname, name)
+        if isinstance(column, CategoricalColumn):
+            meta["columns"][name] = "categorical"
+            np.save(prefix + ".codes.npy", np.asarray(column.codes, dtype=np.int32))
+            with open(prefix + ".vocab.json", "w") as f:
+                json.dump(column.vocab, f)
+        elif isinstance(column, StringColumn):
+            meta["columns"][name] = "string"
+            np.save(prefix + ".data.npy", np.asarray(column.data, dtype=np.uint8))
+            np.save(prefix + ".offsets.npy", np.asarray(column.offsets, np.int64))
+        else:
+            meta["columns"][name] = "int32"
+            np.save(prefix + ".npy", column)
+
+    with open(os.path.join(temp_dirname, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+    if os.path.exists(dirname):
+        os.rename(dirname, old_dirname)
+    os.rename(temp_dirname, dirname)
+    if os.path.exists(old_dirname):
+        shutil.rmtree(old_dirname)
+
+
+def load_columns(filename: str, *, mmap: bool = True) -> dict:
+    """
+    Loads GISAID columns from either a column store directory or a legacy
+    ``.pkl`` file.
+
+    :param str filename: A column store directory or a pickle file.
+    :param bool mmap: Whether to memory map arrays rather than read them.
+    :returns: A dict mapping column name to a sequence. Columns of a store are
+        int32 numpy arrays, :class:`CategoricalColumn` s or
+        :class:`StringColumn` s; all support ``len()``, iteration, indexing
+        and ``.tolist()``.
+    """
+    if filename.endswith(".pkl"):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+
+    with open(os.path.join(filename, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["version"] != VERSION:
+        raise ValueError(f"Unsupported column store version: {meta['version']}")
+    mmap_mode = "r" if mmap else None
+
+    columns: dict = {}
+    for name, kind in meta["columns"].items():
+        prefix = os.path.join(filename, name)
+        if kind == "categorical":
+            codes = np.load(prefix + ".codes.npy", mmap_mode=mmap_mode)
+            with open(prefix + ".vocab.json") as f:
+                vocab = json.load(f)
+            columns[name] = CategoricalColumn(codes, vocab)
+        elif kind == "string":
+            data = np.load(prefix + ".data.npy", mmap_mode=mmap_mode)
+            offsets = np.load(prefix + ".offsets.npy", mmap_mode=mmap_mode)
+            columns[name] = StringColumn(data, offsets)
+        else:
+            columns[name] = np.load(prefix + ".npy", mmap_mode=mmap_mode)
+    return columns
+
+
+def convert_pickle(pickle_filename: str, dirname: str) -> None:
+    """
+    Converts a legacy ``gisaid.columns.pkl`` file to a column store.
+    """
+    logger.info(f"loading {pickle_filename}")
+    with open(pickle_filename, "rb") as f:
+        columns = pickle.load(f)
+    logger.info(f"saving {dirname}")
+    save_columns(columns, dirname)
+
+
+def export_pickle(dirname: str, pickle_filename: str) -> None:
+    """
+    Exports a column store to a legacy ``gisaid.columns.pkl`` file of lists.
+    """
+    logger.info(f"loading {dirname}")
+    columns = load_columns(dirname)
+    columns = {name: values.tolist() for name, values in columns.items()}
+    logger.info(f"saving {pickle_filename}")
+    with open(pickle_filename, "wb") as f:
+        pickle.dump(columns, f)
+
+
+def count_cells(columns: dict) -> dict:
+    """
+    Aggregates GISAID rows into a sparse count cube over cells of unique
+    ``(day, location, lineage)`` triples, plus marginal counts.
+
+    :param dict columns: A dict of GISAID columns, either lists or as
+        returned by :func:`load_columns`.
+    :returns: A dict with vocabularies ``"locations"`` and ``"lineages"``
+        ordered by first appearance; int64 arrays ``"day"``, ``"location"``,
+        ``"lineage"``, ``"count"`` and ``"first_row"`` over cells sorted by
+        ``(day, location, lineage)``; marginal arrays ``"day_counts"``,
+        ``"location_counts"`` and ``"lineage_counts"``; and ``"num_rows"``.
+    """
+    day = np.asarray(columns["day"], dtype=np.int64)
+    location_codes, locations = factorize(columns["location"])
+    lineage_codes, lineages = factorize(columns["lineage"])
+    key = (day * len(locations) + location_codes) * len(lineages) + lineage_codes
+    key, first_row, counts = np.unique(key, return_index=True, return_counts=True)
+    cube = {
+        "locations": locations,
+        "lineages": lineages,
+        "lineage": key % len(lineages),
+        "location": key // len(lineages) % len(locations),
+        "day": key // len(lineages) // len(locations),
+        "count": counts,
+        "first_row": first_row,
+        "num_rows": len(day),
+    }
+    for name, size in [
+        ("day", int(day.max()) + 1 if len(day) else 0),
+        ("location", len(locations)),
+        ("lineage", len(lineages)),
+    ]:
+        cube[name + "_counts"] = np.bincount(
+            cube[name], weights=counts, minlength=size
+        ).astype(np.int64)
+    return cube
+
+
+def save_cube(cube: dict, filename: str, columns_filename: str) -> None:
+    """
+    Saves a count cube computed from ``columns_filename``, recording the
+    columns' modification time so that stale cubes can be detected.
+    """
+    cube = dict(cube, columns_mtime_ns=os.stat(columns_filename).st_mtime_ns)
+    with open(filename, "wb") as f:
+        pickle.dump(cube, f)
+
+
+def load_cube(filename: str, columns_filename: str):
+    """
+    Loads a count cube saved by :func:`save_cube`.
+
+    :returns: The cube, or None if it is missing or older than
+        ``columns_filename``.
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as f:
+        cube = pickle.load(f)
+    if cube.pop("columns_mtime_ns") != os.stat(columns_filename).st_mtime_ns:
+        logger.info(f"ignoring stale {filename}")
+        return None
+    return cube
@@ -1,134 +1,424 @@
 # Copyright Contributors to the Pyro-Cov project.
 # SPDX-License-Identifier: Apache-2.0
 
+import functools
 import hashlib
 import logging
+import multiprocessing
 import os
 import shutil
-from collections import defaultdict
+import sqlite3
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import check_call
 
+from pyrocov.align import CodonTranslator, Differ
+from pyrocov.sarscov2 import GENE_TO_POSITION
+
 logger = logging.getLogger(__name__)
 NEXTSTRAIN_DATA = os.path.expanduser("~/github/nextstrain/nextclade/data/sars-cov-2")
+GENES = ["E", "M", "N", "ORF1a", "ORF1b", "ORF3a", "ORF6", "ORF7a", "ORF7b"]
+GENES += ["ORF8", "ORF9b", "S"]
+
+
+DIGESTS = {
+    "sha1": hashlib.sha1,
+    "blake2b": functools.partial(hashlib.blake2b, digest_size=20),
+}
+
+
+def hash_sequence(seq, digest="sha1"):
+    """
+    Hashes a sequence, ignoring newlines.
+
+    :param seq: A str or bytes sequence.
+    :param str digest: The name of a digest in :data:`DIGESTS`. The default
+        ``"sha1"`` is compatible with databases created by older versions.
+    """
+    if isinstance(seq, str):
+        seq = seq.encode("utf-8")
+    if b"\n" in seq:
+        seq = seq.replace(b"\n", b"")
+    return DIGESTS[digest](seq).hexdigest()
+
+
+def count_nucleotides(seq):
+    """
+    Counts ``A``, ``C``, ``G`` and ``T`` characters in a str or bytes
+    sequence, in a single pass.
+    """
+    if isinstance(seq, str):
+        seq = seq.encode("utf-8")
+    return len(seq) - len(seq.translate(None, b"ACGT"))
+
+
+def read_fasta(filename):
+    """
+    Reads the first sequence of a fasta file.
+    """
+    with open(filename) as f:
+        lines = []
+        for line in f:
+            if line.startswith(">"):
+                if lines:
+                    break
+                continue
+            lines.append(line.strip())
+    return "".join(lines)
+
+
+class NextcladeBackend:
+    """
+    Alignment backend that runs a nextclade executable on each batch.
+
+    :param str nextclade: Path to the nextclade executable.
+    """
 
+    name = "nextclade"
 
-def hash_sequence(seq):
-    hasher = hashlib.sha1()
-    hasher.update(seq.replace("\n", "").encode("utf-8"))
-    return hasher.hexdigest()
+    def __init__(self, nextclade="./nextclade"):
+        self.nextclade = nextclade
+
+    def __call__(self, prefix, batch):
+        """
+        Aligns a batch of sequences.
+
+        :param str prefix: A prefix for temporary files.
+        :param list batch: A list of ``(key, sequence)`` pairs, where
+            sequences are str or bytes.
+        :returns: a pair ``(header, rows)`` where ``header`` is a list of
+            column names and ``rows`` is a list of lists of values, each
+            starting with a key.
+        """
+        with open(prefix + ".fasta", "wb") as f:
+            for key, sequence in batch:
+                if isinstance(sequence, str):
+                    sequence = sequence.encode("utf-8")
+                f.write(b">")
+                f.write(key.encode("utf-8"))
+                f.write(b"\n")
+                f.write(sequence)
+                f.write(b"\n")
+        cmd = [
+            self.nextclade,
+            f"--input-root-seq={NEXTSTRAIN_DATA}/reference.fasta",
+            "--genes=" + ",".join(GENES),
+            f"--input-gene-map={NEXTSTRAIN_DATA}/genemap.gff",
+            f"--input-tree={NEXTSTRAIN_DATA}/tree.json",
+            f"--input-qc-config={NEXTSTRAIN_DATA}/qc.json",
+            f"--input-pcr-primers={NEXTSTRAIN_DATA}/primers.csv",
+            f"--input-fasta={prefix}.fasta",
+            f"--output-tsv={prefix}.tsv",
+            f"--output-dir={prefix}",
+        ]
+        logger.info(" ".join(cmd))
+        check_call(cmd)
+        with open(prefix + ".tsv") as f:
+            header = f.readline().rstrip("\n").split("\t")
+            rows = [line.rstrip("\n").split("\t") for line in f]
+        os.remove(prefix + ".fasta")
+        os.remove(prefix + ".tsv")
+        shutil.rmtree(prefix, ignore_errors=True)
+        return header, rows
+
+    def close(self):
+        pass
+
+
+_DIFFER = None
+_TRANSLATOR = None
+
+
+def _init_minimap2(reference, genes):
+    global _DIFFER, _TRANSLATOR
+    _DIFFER = Differ(reference)
+    _TRANSLATOR = CodonTranslator(reference, genes)
+
+
+def _minimap2_rows(max_n_fraction, batch):
+    batch = [(k, s.decode() if isinstance(s, bytes) else s) for k, s in batch]
+    subs = [[] for _ in batch]
+    dels = [[] for _ in batch]
+    diffs = [_DIFFER.diff(sequence) for _, sequence in batch]
+    index, ids = _TRANSLATOR(diffs)
+    for i, m in zip(index.tolist(), ids.tolist()):
+        m = _TRANSLATOR.mutations[m]
+        (dels if m.endswith("-") else subs)[i].append(m)
+    rows = []
+    for (key, sequence), s, d in zip(batch, subs, dels):
+        good = sequence.count("N") <= max_n_fraction * len(sequence)
+        rows.append([key, "good" if good else "bad", ",".join(s), ",".join(d)])
+    return rows
+
+
+class Minimap2Backend:
+    """
+    Alignment backend that aligns each batch in-process using
+    :class:`~pyrocov.align.Differ` (minimap2 via mappy) in a process pool,
+    without writing temporary files.
+
+    Rows have nextclade's ``seqName``, ``qc.overallStatus``,
+    ``aaSubstitutions`` and ``aaDeletions`` columns. Mutations are translated
+    in batches by :class:`~pyrocov.align.CodonTranslator`, and quality control is
+    simplified to requiring few ambiguous bases.
+
+    :param str reference: Path to a reference fasta file.
+    :param int num_workers: Number of worker processes.
+    :param float max_n_fraction: Maximum fraction of ``N`` bases in a "good"
+        sequence.
+    """
+
+    name = "minimap2"
+    header = ["seqName", "qc.overallStatus", "aaSubstitutions", "aaDeletions"]
+
+    def __init__(self, reference=None, *, num_workers=1, max_n_fraction=0.05):
+        import mappy  # noqa: F401 Fail early rather than in workers.
+
+        if reference is None:
+            reference = f"{NEXTSTRAIN_DATA}/reference.fasta"
+        self.num_workers = num_workers
+        self.max_n_fraction = max_n_fraction
+        genes = {g: GENE_TO_POSITION[g] for g in GENES}
+        self._pool = multiprocessing.Pool(
+            num_workers, _init_minimap2, (read_fasta(reference), genes)
+        )
+
+    def __call__(self, prefix, batch):
+        """
+        Aligns a batch of sequences, as in :meth:`NextcladeBackend.__call__`.
+        """
+        size = -(-len(batch) // (4 * self.num_workers))
+        chunks = [batch[i : i + size] for i in range(0, len(batch), size)]
+        fn = functools.partial(_minimap2_rows, self.max_n_fraction)
+        rows = []
+        for chunk in self._pool.map(fn, chunks):
+            rows.extend(chunk)
+        return self.header, rows
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
 
 
 class NextcladeDB:
     """
     Database to store nextclade results through time, so that only new samples
     need to be sequenced.
+
+    Rows are stored in an sqlite database keyed by sequence hash. Legacy
+    ``.header.tsv`` and ``.rows.tsv`` files are imported on first use.
+    The digest used for hashing is fixed when a database is created.
+
+    Alignment is delegated to a ``backend``, which is a callable mapping a
+    batch of ``(key, sequence)`` pairs to a header and rows, as in
+    :meth:`NextcladeBackend.__call__`. Each database stores results of a
+    single backend.
+
+    :param str fileprefix: Prefix of the database and temporary files.
+        Defaults to ``"results/{backend.name}db"``.
+    :param int max_fasta_count: Number of sequences per batch.
+    :param int num_workers: Number of batches to align concurrently.
+        Batches are aligned in the background, and their results are merged
+        into the database as they complete.
+    :param str nextclade: Path to the nextclade executable, used if no
+        ``backend`` is specified.
+    :param backend: An alignment backend, defaulting to a
+        :class:`NextcladeBackend`.
+    :param str digest: The digest of a new database, defaulting to
+        ``"sha1"``. If specified, this must match the digest of an existing
+        database.
     """
 
-    def __init__(self, fileprefix="results/nextcladedb", max_fasta_count=4000):
+    def __init__(
+        self,
+        fileprefix=None,
+        max_fasta_count=4000,
+        *,
+        num_workers=1,
+        nextclade="./nextclade",
+        backend=None,
+        digest=None,
+    ):
+        if backend is None:
+            backend = NextcladeBackend(nextclade)
+        if fileprefix is None:
+            fileprefix = f"results/{backend.name}db"
         fileprefix = os.path.realpath(fileprefix)
+        self.fileprefix = fileprefix
+        self.db_filename = fileprefix + ".sqlite"
         self.header_filename = fileprefix + ".header.tsv"
         self.rows_filename = fileprefix + ".rows.tsv"
-        self.rows_temp_filename = fileprefix + "rows.temp.tsv"
-        self.fasta_filename = fileprefix + ".temp.fasta"
-        self.tsv_filename = fileprefix + ".temp.tsv"
-        self.output_dir = os.path.dirname(self.tsv_filename)
 
-        # Load hashes of already-aligned sequences.
-        self._already_aligned = set()
-        if os.path.exists(self.rows_filename):
-            with open(self.rows_filename) as f:
-                for line in f:
-                    key = line.split("\t", 1)[0]
-                    self._already_aligned.add(key)
+        self._db = sqlite3.connect(self.db_filename)
+        self._create_tables()
+        meta = dict(self._db.execute("SELECT name, value FROM meta"))
+        if "backend" not in meta:
+            # This is a new database, or its first run was interrupted.
+            if digest not in (None, "sha1") and os.path.exists(self.rows_filename):
+                self._db.close()
+                raise ValueError(f"{self.rows_filename} requires digest sha1")
+            self._initialize(backend.name, digest or "sha1")
+            meta = dict(self._db.execute("SELECT name, value FROM meta"))
+        name = meta.get("backend", "nextclade")
+        self.digest = meta.get("digest", "sha1")
+        if name != backend.name:
+            self._db.close()
+            raise ValueError(
+                f"{self.db_filename} stores {name} results, "
+                f"but the backend is {backend.name}"
+            )
+        if digest not in (None, self.digest):
+            self._db.close()
+            raise ValueError(
+                f"{self.db_filename} uses digest {self.digest}, not {digest}"
+            )
 
         self.max_fasta_count = max_fasta_count
-        self._fasta_file = open(self.fasta_filename, "wt")
+        self.num_workers = num_workers
+        self.backend = backend
+        self._batch = []
         self._pending = set()
+        self._batch_count = 0
+        self._executor = None
+        self._running = deque()
 
         self._tasks = defaultdict(list)
 
-    def schedule(self, sequence, *fn_args):
+    def _create_tables(self):
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name PRIMARY KEY, value)"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS rows (key PRIMARY KEY, row)")
+
+    def _initialize(self, backend_name, digest):
+        if os.path.exists(self.rows_filename):
+            logger.info(f"Importing {self.rows_filename}")
+            with open(self.header_filename) as f:
+                header = f.readline().rstrip("\n").split("\t")
+            with open(self.rows_filename) as f:
+                self._save_rows(header, (line.rstrip("\n").split("\t") for line in f))
+        # Record the backend last, so that an interrupted import is retried.
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("backend", backend_name), ("digest", digest)],
+            )
+
+    def _save_rows(self, header, rows):
+        # Insert all rows in a single transaction.
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('header', ?)",
+                ("\t".join(header),),
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO rows VALUES (?, ?)",
+                ((row[0], "\t".join(row)) for row in rows),
+            )
+
+    def _is_aligned(self, key):
+        cursor = self._db.execute("SELECT 1 FROM rows WHERE key = ?", (key,))
+        return cursor.fetchone() is not None
+
+    def hash_sequence(self, sequence):
+        """
+        Hashes a sequence with this database's digest.
+        """
+        return hash_sequence(sequence, self.digest)
+
+    def schedule(self, sequence, *fn_args, key=None):
         """
         Schedule a task for a given input ``sequence``.
+
+        :param str key: An optional precomputed
+            :meth:`hash_sequence` of ``sequence``.
         """
-        key = hash_sequence(sequence)
-        if key not in self._already_aligned:
-            self._schedule_alignment(key, sequence)
+        if key is None:
+            key = self.hash_sequence(sequence)
+        if key not in self._tasks and key not in self._pending:
+            if not self._is_aligned(key):
+                self._schedule_alignment(key, sequence)
         self._tasks[key].append(fn_args)
 
-    def maybe_schedule(self, sequence, *fn_args):
+    def maybe_schedule(self, sequence, *fn_args, key=None):
         """
         Schedule a task iff no new alignment work is required.
         Tasks requiring new alignment work will be silently dropped.
         """
-        key = hash_sequence(sequence)
-        if key in self._already_aligned:
+        if key is None:
+            key = self.hash_sequence(sequence)
+        if key in self._tasks or self._is_aligned(key):
             self._tasks[key].append(fn_args)
 
-    def wait(self, log_every=1000):
+    def wait(self, log_every=1000, batch_size=500):
         """
         Wait for all scheduled or maybe_scheduled tasks to complete.
         """
         self._flush()
-        with open(self.header_filename) as f:
-            header = f.read().strip().split("\t")
-        with open(self.rows_filename) as f:
-            for i, row in enumerate(f):
-                row = row.strip().split("\t")
-                key = row[0]
-                row = dict(zip(header, row))
-                for fn_args in self._tasks.pop(key, []):
+        while self._running:
+            self._merge()
+        query = "SELECT value FROM meta WHERE name = 'header'"
+        header = self._db.execute(query).fetchone()
+        header = header[0].split("\t") if header else []
+        keys = list(self._tasks)
+        i = 0
+        for begin in range(0, len(keys), batch_size):
+            batch = keys[begin : begin + batch_size]
+            query = "SELECT key, row FROM rows WHERE key IN ({})".format(
+                ",".join("?" * len(batch))
+            )
+            rows = dict(self._db.execute(query, batch))
+            for key in batch:
+                row = rows.get(key)
+                fn_args_list = self._tasks.pop(key)
+                if row is None:
+                    continue
+                row = dict(zip(header, row.split("\t")))
+                for fn_args in fn_args_list:
                     fn, args = fn_args[0], fn_args[1:]
                     fn(*args, row)
                 if log_every and i % log_every == 0:
                     print(".", end="", flush=True)
+                i += 1
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.backend.close()
+        self._db.close()
 
     def _schedule_alignment(self, key, sequence):
-        self._fasta_file.write(">")
-        self._fasta_file.write(key)
-        self._fasta_file.write("\n")
-        self._fasta_file.write(sequence)
-        self._fasta_file.write("\n")
+        self._batch.append((key, sequence))
         self._pending.add(key)
         if len(self._pending) >= self.max_fasta_count:
             self._flush()
 
     def _flush(self):
+        # Start aligning the current batch in the background, while the caller
+        # continues collecting the next batch.
         if not self._pending:
             return
-        self._fasta_file.close()
-        cmd = [
-            "./nextclade",
-            f"--input-root-seq={NEXTSTRAIN_DATA}/reference.fasta",
-            "--genes=E,M,N,ORF1a,ORF1b,ORF3a,ORF6,ORF7a,ORF7b,ORF8,ORF9b,S",
-            f"--input-gene-map={NEXTSTRAIN_DATA}/genemap.gff",
-            f"--input-tree={NEXTSTRAIN_DATA}/tree.json",
-            f"--input-qc-config={NEXTSTRAIN_DATA}/qc.json",
-            f"--input-pcr-primers={NEXTSTRAIN_DATA}/primers.csv",
-            f"--input-fasta={self.fasta_filename}",
-            f"--output-tsv={self.tsv_filename}",
-            f"--output-dir={self.output_dir}",
-        ]
-        logger.info(" ".join(cmd))
-        check_call(cmd)
-
-        # Append to a copy to ensure atomicity.
-        if os.path.exists(self.rows_filename):
-            shutil.copyfile(self.rows_filename, self.rows_temp_filename)
-        with open(self.tsv_filename) as f:
-            with open(self.rows_temp_filename, "a") as frows:
-                for i, line in enumerate(f):
-                    if i:
-                        frows.write(line)
-                    else:
-                        with open(self.header_filename, "w") as fheader:
-                            fheader.write(line)
-        os.rename(self.rows_temp_filename, self.rows_filename)
-        os.remove(self.fasta_filename)
-        os.remove(self.tsv_filename)
-        self._fasta_file = open(self.fasta_filename, "w")
-        self._already_aligned.update(self._pending)
+        prefix = f"{self.fileprefix}.temp.{self._batch_count}"
+        batch = self._batch
+        self._batch = []
+        self._batch_count += 1
         self._pending.clear()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.num_workers)
+        self._running.append(self._executor.submit(self.backend, prefix, batch))
+
+        # Block until at most num_workers batches are running.
+        while len(self._running) > self.num_workers:
+            self._merge()
+        while self._running and self._running[0].done():
+            self._merge()
+
+    def _merge(self):
+        # Wait for the oldest running batch, and save its results.
+        header, rows = self._running.popleft().result()
+        self._save_rows(header, rows)
 
 
 class ShardedFastaWriter:
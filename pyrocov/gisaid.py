@@ -0,0 +1,420 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+import warnings
+from collections import Counter, defaultdict, deque
+
+from pyrocov import pangolin
+from pyrocov.fasta import count_nucleotides, hash_sequence
+from pyrocov.geo import gisaid_normalize
+from pyrocov.io import is_compressed, read_lines
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMATS = {4: "%Y", 7: "%Y-%m", 10: "%Y-%m-%d"}
+
+
+def parse_date(string):
+    fmt = DATE_FORMATS.get(len(string))
+    if fmt is None:
+        # Attempt to fix poorly formated dates like 2020-09-1.
+        parts = string.split("-")
+        parts = parts[:1] + [f"{int(p):>02d}" for p in parts[1:]]
+        string = "-".join(parts)
+        fmt = DATE_FORMATS[len(string)]
+    return datetime.datetime.strptime(string, fmt)
+
+
+FIELDS = ["virus_name", "accession_id", "collection_date", "location", "add_location"]
+
+
+def get_shards(filename, num_shards, start=0):
+    """
+    Splits a file into at most ``num_shards`` byte ranges ``(start, end)``,
+    each aligned to line boundaries.
+    """
+    size = os.path.getsize(filename)
+    offsets = [start]
+    with open(filename, "rb") as f:
+        for i in range(1, num_shards):
+            pos = start + (size - start) * i // num_shards
+            if pos <= offsets[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()  # Advance to the start of the next line.
+            offsets.append(f.tell())
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+
+def read_shard(filename, start, end):
+    """
+    Iterates over lines starting within the byte range ``[start, end)``.
+    """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line
+
+
+def strip_sequence(line):
+    """
+    Strips the trailing ``"sequence"`` field from a raw json line.
+    """
+    return line.split(b', "sequence": ', 1)[0]
+
+
+def process_lines(args, lines, seen=frozenset(), on_sequence=None, digest="sha1"):
+    """
+    Filters and normalizes raw json lines of a GISAID feed. Lines whose
+    metadata fingerprint is in ``seen`` are skipped without being parsed.
+
+    :param callable on_sequence: An optional callback
+        ``on_sequence(lineage, sequence, key)`` called on each kept row whose
+        sequence has between ``args.min_nchars`` and ``args.max_nchars``
+        nucleotides, where ``sequence`` is bytes without newlines and ``key``
+        is its :func:`~pyrocov.fasta.hash_sequence`. If None, sequences are
+        stripped and never parsed.
+    :param str digest: The digest used for hashing.
+    :returns: a tuple ``(columns, stats, fingerprints, num_parsed)`` where
+        ``fingerprints`` maps each parsed accession id to its fingerprint.
+    """
+    columns = defaultdict(list)
+    stats = defaultdict(Counter)
+    fingerprints = {}
+    covv_fields = ["covv_" + key for key in FIELDS]
+    num_parsed = 0
+
+    for i, line in enumerate(lines):
+        if i % args.log_every == 0:
+            print(".", end="", flush=True)
+
+        # Optimize for faster reading.
+        metadata = strip_sequence(line)
+        fingerprint = hashlib.blake2b(metadata, digest_size=16).digest()
+        if fingerprint in seen:
+            continue  # Skip rows that are unchanged since the last run.
+        if on_sequence is None:
+            line = metadata + b"}"
+        num_parsed += 1
+
+        # Filter out bad data.
+        datum = json.loads(line)
+        fingerprints[datum["covv_accession_id"]] = fingerprint
+        if len(datum["covv_collection_date"]) < 7:
+            continue  # Drop rows with no month information.
+        date = parse_date(datum["covv_collection_date"])
+        if date < args.start_date:
+            date = args.start_date  # Clip rows before start date.
+        lineage = datum["covv_lineage"]
+        if lineage in (None, "None", "", "XA"):
+            continue  # Drop rows with unknown or ambiguous lineage.
+        try:
+            lineage = pangolin.compress(lineage)
+            lineage = pangolin.decompress(lineage)
+            assert lineage
+        except (ValueError, AssertionError) as e:
+            warnings.warn(str(e))
+            continue
+
+        # Fix duplicate locations.
+        datum["covv_location"] = gisaid_normalize(datum["covv_location"])
+
+        # Collate.
+        columns["lineage"].append(lineage)
+        for covv_key, key in zip(covv_fields, FIELDS):
+            columns[key].append(datum[covv_key])
+        columns["day"].append((date - args.start_date).days)
+
+        # Aggregate statistics.
+        stats["date"][datum["covv_collection_date"]] += 1
+        stats["location"][datum["covv_location"]] += 1
+        stats["lineage"][lineage] += 1
+
+        # Filter to sequences with sufficient data.
+        if on_sequence is not None:
+            seq = _sequence_bytes(datum)
+            nchars = count_nucleotides(seq)
+            if args.min_nchars <= nchars <= args.max_nchars:
+                on_sequence(lineage, seq, hash_sequence(seq, digest))
+
+    return columns, stats, fingerprints, num_parsed
+
+
+def _sequence_bytes(datum):
+    # Encodes a sequence, stripping newlines with at most one more copy.
+    seq = datum["sequence"].encode("utf-8")
+    if b"\n" in seq:
+        seq = seq.replace(b"\n", b"")
+    return seq
+
+
+def filter_lines(args, lines, ids=None, digest="sha1"):
+    """
+    Parses raw json lines of a GISAID feed, filtering to sequences with
+    between ``args.min_nchars`` and ``args.max_nchars`` nucleotides and
+    hashing them as in :func:`~pyrocov.fasta.hash_sequence`.
+
+    :param set ids: An optional set of accession ids to keep.
+    :param str digest: The digest used for hashing.
+    :returns: a list of ``(accession_id, key, sequence)`` triples, where
+        ``sequence`` is bytes without newlines.
+    """
+    result = []
+    for line in lines:
+        datum = json.loads(line)
+        accession_id = datum["covv_accession_id"]
+        if ids is not None and accession_id not in ids:
+            continue
+        seq = _sequence_bytes(datum)
+        nchars = count_nucleotides(seq)
+        if args.min_nchars <= nchars <= args.max_nchars:
+            result.append((accession_id, hash_sequence(seq, digest), seq))
+    return result
+
+
+def process_shard(args, start, end, seen=frozenset(), on_sequence=None):
+    """
+    Filters and normalizes lines starting within the byte range
+    ``[start, end)`` of ``args.gisaid_file_in``.
+    """
+    lines = read_shard(args.gisaid_file_in, start, end)
+    return process_lines(args, lines, seen, on_sequence)
+
+
+def chunk_lines(lines, chunk_size=10000, strip=True):
+    """
+    Groups lines into lists of lines, for sending to workers. If ``strip``,
+    sequences are stripped before sending.
+    """
+    chunk = []
+    for line in lines:
+        chunk.append(strip_sequence(line) if strip else line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+_SEEN: frozenset = frozenset()
+_IDS = None
+
+
+def _init_worker(seen, ids=None):
+    global _SEEN, _IDS
+    _SEEN = seen
+    _IDS = ids
+
+
+def _process_shard(args_start_end):
+    return process_shard(*args_start_end, seen=_SEEN)
+
+
+def _process_lines(args_lines):
+    return process_lines(*args_lines, seen=_SEEN)
+
+
+def _process_lines_and_sequences(args_lines_digest):
+    args, lines, digest = args_lines_digest
+    sequences = []
+    result = process_lines(
+        args, lines, _SEEN, lambda *x: sequences.append(x), digest=digest
+    )
+    return result + (sequences,)
+
+
+def _filter_lines(args_lines_digest):
+    args, lines, digest = args_lines_digest
+    return filter_lines(args, lines, _IDS, digest)
+
+
+def _imap_bounded(pool, fn, tasks, max_pending):
+    # Like pool.imap, but with at most max_pending results held in memory.
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(fn, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def filter_sequences(args, lines, ids=None, digest="sha1"):
+    """
+    Like :func:`filter_lines`, but batched over ``args.num_workers``
+    processes.
+
+    :returns: an iterator over ``(accession_id, key, sequence)`` triples, in
+        file order.
+    """
+    if args.num_workers <= 1:
+        for chunk in chunk_lines(lines, chunk_size=1000, strip=False):
+            yield from filter_lines(args, chunk, ids, digest)
+        return
+    chunks = chunk_lines(lines, chunk_size=1000, strip=False)
+    tasks = ((args, chunk, digest) for chunk in chunks)
+    with multiprocessing.Pool(
+        args.num_workers, _init_worker, (frozenset(), ids)
+    ) as pool:
+        results = _imap_bounded(pool, _filter_lines, tasks, 2 * args.num_workers)
+        for result in results:
+            yield from result
+
+
+def process_feed(args, offset=0, seen=frozenset(), on_sequence=None, digest="sha1"):
+    """
+    Filters and normalizes ``args.gisaid_file_in``, optionally in parallel
+    over ``args.num_workers`` processes. Results are merged in file order,
+    so that outputs do not depend on the number of workers.
+
+    :param int offset: A byte offset at which to start reading an
+        uncompressed file.
+    :param frozenset seen: A set of metadata fingerprints to skip.
+    :param callable on_sequence: An optional callback as in
+        :func:`process_lines`. This is always called in the main process,
+        but sequences are hashed in worker processes.
+    :param str digest: The digest used for hashing sequences.
+    :returns: a tuple ``(columns, stats, fingerprints, num_parsed)`` as in
+        :func:`process_lines`.
+    """
+    compressed = is_compressed(args.gisaid_file_in)
+    if args.num_workers <= 1 or args.truncate < math.inf:
+        # Process the whole file in this process.
+        if compressed:
+            lines = read_lines(args.gisaid_file_in)
+        else:
+            size = os.path.getsize(args.gisaid_file_in)
+            lines = read_shard(args.gisaid_file_in, offset, size)
+        if args.truncate < math.inf:
+            lines = itertools.islice(lines, args.truncate)
+        result = process_lines(args, lines, seen, on_sequence, digest)
+        columns, stats, fingerprints, num_parsed = result
+    else:
+        if on_sequence is not None:
+            # Process small chunks of full lines, since these include sequences.
+            logger.info(f"Processing chunks on {args.num_workers} workers")
+            if compressed:
+                lines = read_lines(args.gisaid_file_in)
+            else:
+                size = os.path.getsize(args.gisaid_file_in)
+                lines = read_shard(args.gisaid_file_in, offset, size)
+            chunks = chunk_lines(lines, chunk_size=1000, strip=False)
+            tasks = ((args, chunk, digest) for chunk in chunks)
+            process = _process_lines_and_sequences
+        elif compressed:
+            # Process chunks of the decompressed stream in parallel.
+            logger.info(f"Processing chunks on {args.num_workers} workers")
+            chunks = chunk_lines(read_lines(args.gisaid_file_in))
+            tasks = ((args, chunk) for chunk in chunks)
+            process = _process_lines
+        else:
+            # Process byte ranges in parallel, oversharding for load balance.
+            shards = get_shards(args.gisaid_file_in, 4 * args.num_workers, offset)
+            logger.info(
+                f"Processing {len(shards)} shards on {args.num_workers} workers"
+            )
+            tasks = ((args,) + shard for shard in shards)
+            process = _process_shard
+        columns = defaultdict(list)
+        stats = defaultdict(Counter)
+        fingerprints = {}
+        num_parsed = 0
+        with multiprocessing.Pool(args.num_workers, _init_worker, (seen,)) as pool:
+            # Merge results in order.
+            results = _imap_bounded(pool, process, tasks, 2 * args.num_workers)
+            for result in results:
+                shard_columns, shard_stats, shard_fingerprints, shard_num = result[:4]
+                for key, values in shard_columns.items():
+                    columns[key].extend(values)
+                for key, counts in shard_stats.items():
+                    stats[key].update(counts)
+                fingerprints.update(shard_fingerprints)
+                num_parsed += shard_num
+                if on_sequence is not None:
+                    for lineage, sequence, key in result[4]:
+                        on_sequence(lineage, sequence, key)
+
+    num_kept = len(columns["day"])
+    num_dropped = num_parsed - num_kept
+    percent = 100 * num_dropped / max(1, num_parsed)
+    logger.info(f"dropped {num_dropped}/{num_parsed} = {percent:0.2g}% rows")
+    return columns, stats, fingerprints, num_parsed
+
+
+def _digest_range(filename, start, end):
+    with open(filename, "rb") as f:
+        f.seek(start)
+        return hashlib.blake2b(f.read(end - start), digest_size=16).digest()
+
+
+def load_checkpoint(args):
+    """
+    Loads the checkpoint of a previous run and determines where this run can
+    start reading. If the feed has only been appended to since the last run,
+    reading starts at the previous end of file, otherwise the whole file is
+    rescanned, skipping rows whose metadata fingerprint is unchanged.
+    """
+    with open(args.checkpoint_file, "rb") as f:
+        checkpoint = pickle.load(f)
+    if is_compressed(args.gisaid_file_in):
+        return checkpoint, 0
+    size = os.path.getsize(args.gisaid_file_in)
+    old_size = checkpoint["size"]
+    offset = 0
+    if size >= old_size:
+        head = _digest_range(args.gisaid_file_in, 0, min(old_size, 1 << 20))
+        tail = _digest_range(
+            args.gisaid_file_in, max(0, old_size - (1 << 20)), old_size
+        )
+        if (head, tail) == (checkpoint["head"], checkpoint["tail"]):
+            offset = old_size
+    if offset:
+        logger.info(f"Feed is append-only; reading from byte {offset}")
+    else:
+        logger.info("Feed was rewritten; rescanning for new or revised rows")
+    return checkpoint, offset
+
+
+def save_checkpoint(args, checkpoint):
+    """
+    Saves a checkpoint of columns parsed from ``args.gisaid_file_in``, for
+    :func:`load_checkpoint`.
+    """
+    size = os.path.getsize(args.gisaid_file_in)
+    checkpoint["size"] = size
+    checkpoint["head"] = _digest_range(args.gisaid_file_in, 0, min(size, 1 << 20))
+    checkpoint["tail"] = _digest_range(
+        args.gisaid_file_in, max(0, size - (1 << 20)), size
+    )
+    logger.info(f"saving {args.checkpoint_file}")
+    with open(args.checkpoint_file + ".temp", "wb") as f:
+        pickle.dump(checkpoint, f)
+    os.replace(args.checkpoint_file + ".temp", args.checkpoint_file)
+
+
+def update_checkpoint(args, checkpoint):
+    """
+    Saves a checkpoint after columns have been saved, or removes any stale
+    checkpoint if the feed was truncated.
+    """
+    if args.truncate == math.inf:
+        save_checkpoint(args, checkpoint)
+    elif os.path.exists(args.checkpoint_file):
+        # Truncated columns do not match any checkpoint, so force the next
+        # --incremental run to start from scratch.
+        logger.info(f"removing stale {args.checkpoint_file}")
+        os.remove(args.checkpoint_file)
@@ -2,11 +2,18 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import functools
+import gzip
 import io
 import logging
+import lzma
 import math
+import os
+import queue
 import re
+import shutil
+import subprocess
 import sys
+import threading
 
 import torch
 import torch.multiprocessing as mp
@@ -309,3 +316,131 @@ def _get_codebook():
     assert values.sum(-1).sub(1).abs().le(1e-6).all()
     codes[keys] = values
     return codes
+
+
+# Maps file extension to candidate decompression commands and a fallback
+# python module name.
+DECOMPRESSORS = {
+    ".xz": ([["xz", "-dc", "-T0"]], "lzma"),
+    ".gz": ([["pigz", "-dc"], ["gzip", "-dc"]], "gzip"),
+    ".zst": ([["zstd", "-dc"]], "zstandard"),
+}
+
+
+def is_compressed(filename):
+    """
+    Returns whether ``filename`` has a known compressed file extension.
+    """
+    return os.path.splitext(filename)[1] in DECOMPRESSORS
+
+
+def read_lines(filename, *, backend=None, chunk_size=1 << 22):
+    """
+    Iterates over lines of a possibly compressed file as ``bytes``, including
+    trailing newlines.
+
+    Files ending in ``.xz``, ``.gz`` or ``.zst`` are decompressed in the
+    background so that decompression overlaps with consumption of lines:
+    either in a separate process running a command line tool (``xz``,
+    ``pigz``, ``gzip`` or ``zstd``), or in a thread running a python
+    decompressor.
+
+    :param str filename: Name of input file.
+    :param str backend: Optional decompression backend, either "process" or
+        "thread". Defaults to "process" if a command line tool is available.
+    :param int chunk_size: Size of decompressed chunks in the "thread"
+        backend.
+    """
+    ext = os.path.splitext(filename)[1]
+    if ext not in DECOMPRESSORS:
+        with open(filename, "rb") as f:
+            yield from f
+        return
+    commands, module = DECOMPRESSORS[ext]
+    if backend is None:
+        backend = "thread"
+        for cmd in commands:
+            if shutil.which(cmd[0]):
+                backend = "process"
+                break
+    if backend == "process":
+        cmd = next((cmd for cmd in commands if shutil.which(cmd[0])), None)
+        if cmd is None:
+            names = " or ".join(cmd[0] for cmd in commands)
+            raise OSError(f"backend='process' requires {names} to read {filename}")
+        yield from _read_lines_process(cmd + [filename])
+    elif backend == "thread":
+        yield from _read_lines_thread(_open_decompressed(filename, module), chunk_size)
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+
+def _open_decompressed(filename, module):
+    if module == "lzma":
+        return lzma.open(filename, "rb")
+    if module == "gzip":
+        return gzip.open(filename, "rb")
+    if module == "zstandard":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(
+                "Reading .zst files requires either zstd or zstandard"
+            ) from e
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"))
+    raise ValueError(f"Unknown module: {module}")
+
+
+def _read_lines_process(cmd):
+    logger.debug(" ".join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 20)
+    done = False
+    try:
+        yield from proc.stdout
+        done = True
+    finally:
+        proc.stdout.close()
+        if not done:
+            proc.kill()  # The consumer stopped early.
+        if proc.wait() and done:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def _read_lines_thread(f, chunk_size, max_chunks=16):
+    chunks: queue.Queue = queue.Queue(max_chunks)
+    stop = threading.Event()
+
+    def decompress():
+        try:
+            with f:
+                while not stop.is_set():
+                    chunk = f.read(chunk_size)
+                    chunks.put(chunk)
+                    if not chunk:
+                        break
+        except BaseException as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=decompress, daemon=True)
+    thread.start()
+    try:
+        partial = b""
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not chunk:
+                break
+            lines = (partial + chunk).split(b"\n")
+            partial = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+        if partial:
+            yield partial
+    finally:
+        stop.set()
+        while thread.is_alive():  # Unblock the thread if the queue is full.
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
@@ -5,8 +5,9 @@ import datetime
 import functools
 import logging
 import math
-import pickle
+import os
 import re
+import tempfile
 import warnings
 from collections import Counter, OrderedDict, defaultdict
 from timeit import default_timer
@@ -17,6 +18,7 @@ import pyro
 import pyro.distributions as dist
 import torch
 from pyro import poutine
+from pyro.distributions.util import sum_rightmost
 from pyro.infer import SVI, JitTrace_ELBO, Trace_ELBO
 from pyro.infer.autoguide import (
     AutoDelta,
@@ -30,11 +32,14 @@ from pyro.nn.module import PyroModule, PyroParam
 from pyro.ops.streaming import CountMeanVarianceStats, StatsOfDict
 from pyro.optim import ClippedAdam
 from pyro.poutine.util import site_is_subsample
-from torch.distributions import constraints
+from pyro.util import get_rng_state, set_rng_state
+from torch.distributions import biject_to, constraints, transform_to
 
 import pyrocov.geo
 
 from . import pangolin, sarscov2
+from .cache import torch_load
+from .columnar import count_cells, factorize, load_columns, load_cube
 from .util import pearson_correlation
 
 # Requires https://github.com/pyro-ppl/pyro/pull/2953
@@ -59,24 +64,196 @@ def date_range(stop):
     return np.array([start + step * t for t in range(stop)])
 
 
+def _location_parts(location):
+    parts = location.split("/")
+    if len(parts) < 2:
+        return None
+    return tuple(p.strip() for p in parts[:3])
+
+
 def get_fine_regions(columns, min_samples=50):
     """
     Select regions that have at least ``min_samples`` samples.
     Remaining regions will be coarsely aggregated up to country level.
     """
+    codes, locations = factorize(columns["location"])
+    location_counts = np.bincount(codes, minlength=len(locations))
+    return _get_fine_regions(locations, location_counts, min_samples)
+
+
+def _get_fine_regions(locations, location_counts, min_samples=50):
     # Count number of samples in each subregion.
     counts = Counter()
-    for location in columns["location"]:
-        parts = location.split("/")
-        if len(parts) < 2:
-            continue
-        parts = tuple(p.strip() for p in parts[:3])
-        counts[parts] += 1
+    for location, count in zip(locations, location_counts.tolist()):
+        parts = _location_parts(location)
+        if parts is not None:
+            counts[parts] += count
 
     # Select fine countries.
     return frozenset(parts for parts, count in counts.items() if count >= min_samples)
 
 
+class GisaidIndex:
+    """
+    An inverted index of GISAID rows by cells of unique
+    ``(day, location, lineage)`` triples, each with a row count and first row.
+
+    Datasets for different ``include``, ``exclude`` and ``end_day`` filters
+    can then be assembled by array indexing over cells, rather than by
+    rescanning rows. Regexes are evaluated once per unique value and cached.
+    Filters on other columns like ``virus_name`` fall back to row masks,
+    which are aggregated back to cells.
+
+    :param dict cube: A count cube as returned by
+        :func:`~pyrocov.columnar.count_cells`.
+    :param columns: GISAID columns as returned by
+        :func:`~pyrocov.columnar.load_columns`, or a filename from which to
+        lazily load them for filters on other columns.
+    """
+
+    def __init__(self, cube, columns):
+        self.cube = cube
+        self._columns = columns
+        self.num_rows = cube["num_rows"]
+        self.max_day = int(cube["day"].max())
+        self.lineages = list(map(pangolin.compress, cube["lineages"]))
+        self.locations = cube["locations"]
+        self.cell_day = cube["day"]
+        self.cell_location = cube["location"]
+        self.cell_lineage = cube["lineage"]
+        self.cell_counts = cube["count"]
+        self.cell_first_row = cube["first_row"]
+
+        # Filter regions to at least 50 sample and aggregate rest to country
+        # level, computing a location id for each unique location.
+        fine_regions = _get_fine_regions(self.locations, cube["location_counts"])
+        location_id: dict = {}
+        location_ids = []
+        for location in self.locations:
+            parts = _location_parts(location)
+            if parts is None:
+                location_ids.append(-1)
+                continue
+            if len(parts) == 3 and parts not in fine_regions:
+                parts = parts[:2]
+            location = " / ".join(parts)
+            location_ids.append(location_id.setdefault(location, len(location_id)))
+        self.location_names = list(location_id)
+        self.location_ids = np.array(location_ids, dtype=np.int64)
+
+        self._values = {"lineage": self.lineages, "location": self.locations}
+        self._factors: dict = {}
+        self._matches: dict = {}
+        self._row_cell = None
+
+    @property
+    def columns(self):
+        """
+        GISAID columns, loaded on first access.
+        """
+        if isinstance(self._columns, str):
+            logger.info(f"Loading {self._columns}")
+            self._columns = load_columns(self._columns)
+        return self._columns
+
+    def search(self, key, pattern):
+        """
+        Evaluates a regex over unique values of a column.
+
+        :returns: a boolean array over unique values of ``key``. These index
+            cells for the ``"lineage"`` and ``"location"`` columns, and
+            otherwise rows via :meth:`factorize`.
+        """
+        if (key, pattern) not in self._matches:
+            if key in self._values:
+                values = self._values[key]
+            else:
+                values = self.factorize(key)[1]
+            found = [bool(re.search(pattern, value)) for value in values]
+            self._matches[key, pattern] = np.array(found, dtype=bool)
+        return self._matches[key, pattern]
+
+    def factorize(self, key):
+        """
+        Factorizes a column, caching the result.
+        """
+        if key not in self._factors:
+            self._factors[key] = factorize(self.columns[key])
+        return self._factors[key]
+
+    def row_cell(self):
+        """
+        Computes the cell of each row, caching the result.
+        """
+        if self._row_cell is None:
+            num_locations = len(self.locations)
+            num_lineages = len(self.lineages)
+            cell_key = self.cell_day * num_locations + self.cell_location
+            cell_key = cell_key * num_lineages + self.cell_lineage
+            day = np.asarray(self.columns["day"], dtype=np.int64)
+            row_key = day * num_locations + self.factorize("location")[0]
+            row_key = row_key * num_lineages + self.factorize("lineage")[0]
+            self._row_cell = np.searchsorted(cell_key, row_key)
+        return self._row_cell
+
+    def select(self, include={}, exclude={}, end_day=None):
+        """
+        Selects cells matching filters.
+
+        :returns: a pair ``(counts, first_row)`` of arrays over cells, with
+            the number of matching rows in each cell and the first matching
+            row of each nonempty cell.
+        """
+        cell_mask = np.ones(len(self.cell_counts), dtype=bool)
+        row_mask = None
+        for filters, positive in [(include, True), (exclude, False)]:
+            for key, pattern in filters.items():
+                match = self.search(key, pattern)
+                if key == "lineage":
+                    cell_mask &= match[self.cell_lineage] == positive
+                elif key == "location":
+                    cell_mask &= match[self.cell_location] == positive
+                else:
+                    match = match[self.factorize(key)[0]] == positive
+                    row_mask = match if row_mask is None else row_mask & match
+        if end_day is not None:
+            cell_mask &= self.cell_day <= end_day
+
+        if row_mask is None:
+            counts = np.where(cell_mask, self.cell_counts, 0)
+            return counts, self.cell_first_row
+        rows = row_mask.nonzero()[0]
+        cells = self.row_cell()[rows]
+        counts = np.bincount(cells, minlength=len(cell_mask)) * cell_mask
+        first_row = np.full(len(cell_mask), self.num_rows)
+        unique_cells, first = np.unique(cells, return_index=True)
+        first_row[unique_cells] = rows[first]
+        return counts, first_row
+
+
+@functools.lru_cache(maxsize=4)
+def _load_gisaid_index(filename, mtime, cube_filename):
+    cube = None
+    if cube_filename is not None:
+        cube = load_cube(cube_filename, filename)
+    if cube is not None:
+        logger.info(f"Loaded count cube {cube_filename}")
+        return GisaidIndex(cube, filename)
+    columns = load_columns(filename)
+    return GisaidIndex(count_cells(columns), columns)
+
+
+def load_gisaid_index(filename, cube_filename=None):
+    """
+    Loads a cached :class:`GisaidIndex` of a column store, rebuilding it if
+    the store has changed. If an up-to-date count cube exists at
+    ``cube_filename``, rows are loaded only if needed for filtering.
+    """
+    filename = os.path.realpath(filename)
+    mtime = os.stat(filename).st_mtime_ns
+    return _load_gisaid_index(filename, mtime, cube_filename)
+
+
 def rank_loo_lineages(
     full_dataset: dict,
     full_result: dict,
@@ -96,7 +273,7 @@ def rank_loo_lineages(
 
     # Filter to often-observed lineages.
     weekly_strains = full_dataset["weekly_strains"]  # [T, P, S]
-    lineage_counts = weekly_strains.sum([0, 1])  # [S]
+    lineage_counts = sum_counts(weekly_strains, [0, 1])  # [S]
     lineages = []
     for c, child in enumerate(lineage_id_inv):
         if child in ("A", "B", "B.1"):
@@ -129,8 +306,12 @@ def load_gisaid_data(
     include={},
     exclude={},
     end_day=None,
-    gisaid_columns_filename="results/gisaid.columns.pkl",
+    gisaid_columns_filename="results/gisaid.columns",
+    gisaid_cube_filename="results/gisaid.cube.pkl",
     nextclade_features_filename="results/nextclade.features.pt",
+    include_pairs=False,
+    keep_cells=False,
+    sparse_strains=False,
 ) -> dict:
     """
     Loads the two files gisaid_columns_filename and nextclade_features_filename,
@@ -142,8 +323,19 @@ def load_gisaid_data(
     include --
     exclude --
     end_day -- last day to include
-    gisaid_columns_filename --
+    gisaid_columns_filename -- a column store directory or legacy .pkl file
+    gisaid_cube_filename -- an optional count cube of gisaid_columns_filename,
+        used if it is up to date
     nextclade_features_filename --
+    include_pairs -- whether to keep features of pairs of mutations
+    keep_cells -- whether to keep daily counts as ``dataset["cells"]``, so
+        that the dataset can be truncated by :func:`slice_gisaid_data`
+    sparse_strains -- whether to return ``weekly_strains`` as a sparse COO
+        tensor, which :func:`model` observes via
+        :func:`sparse_multinomial_log_prob`
+
+    The returned ``features`` are a sparse COO tensor; use
+    :func:`features_matmul` to multiply by coefficients.
     """
     logger.info("Loading data")
     include = include.copy()
@@ -152,23 +344,22 @@ def load_gisaid_data(
     if end_day:
         logger.info(f"Load gisaid data end_day: {end_day}")
 
-    # Load ``gisaid_columns_filename``
-    with open(gisaid_columns_filename, "rb") as f:
-        columns = pickle.load(f)
+    # Load an index of ``gisaid_columns_filename``
+    index = load_gisaid_index(gisaid_columns_filename, gisaid_cube_filename)
 
-    logger.info("Training on {} rows with columns:".format(len(columns["day"])))
-    logger.info(", ".join(columns.keys()))
-
-    # Filter regions to at least 50 sample and aggregate rest to country level
-    fine_regions = get_fine_regions(columns)
+    logger.info("Training on {} rows".format(index.num_rows))
 
     # Filter features into numbers of mutations and possibly genes.
     aa_features = torch.load(nextclade_features_filename)
     mutations = aa_features["mutations"]
-    features = aa_features["features"].to(
-        device=device, dtype=torch.get_default_dtype()
-    )
-    keep = [m.count(",") == 0 for m in mutations]  # restrict to single mutations
+    features = aa_features["features"]
+    if not features.is_sparse:
+        features = features.to_sparse()  # Support legacy dense features.
+    features = features.to(device=device, dtype=torch.get_default_dtype())
+    if include_pairs:
+        keep = [True] * len(mutations)
+    else:
+        keep = [m.count(",") == 0 for m in mutations]  # restrict to single mutations
     if include.get("gene"):
         re_gene = re.compile(include.pop("gene"))
         keep = [k and bool(re_gene.search(m)) for k, m in zip(keep, mutations)]
@@ -190,110 +381,166 @@ def load_gisaid_data(
                 keep[i] = False
     mutations = [m for k, m in zip(keep, mutations) if k]
     if mutations:
-        features = features[:, keep]
+        ids = torch.tensor([i for i, k in enumerate(keep) if k], device=device)
+        features = features.index_select(1, ids).coalesce()
     else:
         warnings.warn("No mutations selected; using empty features")
         mutations = ["S:D614G"]  # bogus
-        features = features[:, :1] * 0
+        features = torch.sparse_coo_tensor(
+            torch.zeros(2, 0, dtype=torch.long),
+            torch.zeros(0),
+            (features.size(0), 1),
+            device=device,
+        ).coalesce()
     logger.info("Loaded {} feature matrix".format(" x ".join(map(str, features.shape))))
 
-    # Aggregate regions
-
     # Get lineages
-    lineages = list(map(pangolin.compress, columns["lineage"]))
     lineage_id_inv = list(map(pangolin.compress, aa_features["lineages"]))
     lineage_id = {k: i for i, k in enumerate(lineage_id_inv)}
-
-    sparse_data: dict = Counter()
-    location_id: dict = OrderedDict()
+    lineage_ids = np.array(
+        [lineage_id.get(k, -1) for k in index.lineages], dtype=np.int64
+    )
 
     # Set of lineages that are skipped
     skipped = set()
+    for lineage in index.lineages:
+        if lineage not in lineage_id and lineage not in skipped:
+            skipped.add(lineage)
+            logger.warning(f"WARNING skipping unsampled lineage {lineage}")
+
+    # Filter by include/exclude and day, via the index.
+    counts, first_row = index.select(include, exclude, end_day)
+    p = index.location_ids[index.cell_location]
+    s = lineage_ids[index.cell_lineage]
+    kept = ((counts > 0) & (p >= 0) & (s >= 0)).nonzero()[0]
+    cells = {
+        "day": index.cell_day[kept],
+        "location": p[kept],
+        "lineage": s[kept],
+        "count": counts[kept],
+        "first_row": first_row[kept],
+        "location_names": index.location_names,
+        "end_day": end_day,
+    }
+    num_kept = int(cells["count"].sum())
+    logger.info(
+        f"Keeping {num_kept}/{index.num_rows} rows "
+        f"(dropped {index.num_rows - num_kept})"
+    )
+    last_day = index.max_day if end_day is None else end_day
+    cells, location_id, weekly_strains, local_time = _aggregate_cells(
+        cells, last_day, len(lineage_id), sparse_strains
+    )
 
-    # Generate sparse_data
-    for virus_name, day, location, lineage in zip(
-        columns["virus_name"], columns["day"], columns["location"], lineages
-    ):
-        if lineage not in lineage_id:
-            if lineage not in skipped:
-                skipped.add(lineage)
-                logger.warning(f"WARNING skipping unsampled lineage {lineage}")
-            continue
-
-        # Filter by include/exclude
-        row = {
-            "virus_name": virus_name,
-            "location": location,
-            "day": day,
-            "lineage": pangolin.compress(lineage),
-        }
-        if not all(re.search(v, row[k]) for k, v in include.items()):
-            continue
-        if any(re.search(v, row[k]) for k, v in exclude.items()):
-            continue
+    dataset = {
+        "location_id": location_id,
+        "mutations": mutations,
+        "weekly_strains": weekly_strains,
+        "features": features,
+        "lineage_id": lineage_id,
+        "lineage_id_inv": lineage_id_inv,
+        "local_time": local_time,
+    }
+    if keep_cells:
+        dataset["cells"] = cells
+    return dataset
 
-        # Filter by day
-        if end_day is not None:
-            if day > end_day:
-                continue
 
-        # preprocess parts
-        parts = location.split("/")
-        if len(parts) < 2:
-            continue
-        parts = tuple(p.strip() for p in parts[:3])
-        if len(parts) == 3 and parts not in fine_regions:
-            parts = parts[:2]
-        location = " / ".join(parts)
-
-        p = location_id.setdefault(location, len(location_id))
-        s = lineage_id[lineage]
-        t = day // TIMESTEP
-        sparse_data[t, p, s] += 1
-
-    # Generate weekly_strains tensor from sparse_data
-    if end_day is not None:
-        T = 1 + end_day // TIMESTEP
-    else:
-        T = 1 + max(columns["day"]) // TIMESTEP
+def _aggregate_cells(cells, last_day, num_lineages, sparse=False):
+    """
+    Aggregates nonempty (day, location, lineage) cells into a weekly_strains
+    tensor, dropping regions observed in fewer than two weeks. If ``sparse``,
+    weekly_strains is a coalesced sparse COO tensor.
 
+    :returns: a tuple ``(cells, location_id, weekly_strains, local_time)``
+        where locations of the returned cells are renumbered to the order of
+        their first row.
+    """
+    p = cells["location"]
+    t = cells["day"] // TIMESTEP
+
+    # Number locations by first appearance among kept rows.
+    order = cells["first_row"].argsort()
+    unique_p, first = np.unique(p[order], return_index=True)
+    order = unique_p[first.argsort()]
+    location_names = [cells["location_names"][i] for i in order.tolist()]
+    location_id: dict = OrderedDict(zip(location_names, range(len(order))))
+    remap = np.zeros(len(cells["location_names"]), dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    p = remap[p]
+    cells = dict(cells, location=p, location_names=location_names)
+
+    # Generate weekly_strains tensor by counting (t, p, s) triples.
+    T = 1 + last_day // TIMESTEP
     P = len(location_id)
-    S = len(lineage_id)
-    weekly_strains = torch.zeros(T, P, S)
-    for (t, p, s), n in sparse_data.items():
-        weekly_strains[t, p, s] = n
+    S = num_lineages
+    device = torch.empty(()).device
+    weights = torch.as_tensor(
+        cells["count"], dtype=torch.get_default_dtype(), device=device
+    )
+    if sparse:
+        indices = torch.as_tensor(np.stack([t, p, cells["lineage"]]), device=device)
+        weekly_strains = torch.sparse_coo_tensor(indices, weights, (T, P, S))
+        weekly_strains = weekly_strains.coalesce()
+    else:
+        weekly_strains = torch.zeros(T, P, S)
+        flat_index = torch.as_tensor((t * P + p) * S + cells["lineage"], device=device)
+        weekly_strains.view(-1).scatter_add_(0, flat_index, weights)
 
     logger.info(f"Dataset size [T x P x S] {T} x {P} x {S}")
 
-    logger.info(
-        f"Keeping {int(weekly_strains.sum())}/{len(lineages)} rows "
-        f"(dropped {len(lineages) - int(weekly_strains.sum())})"
-    )
-
     # Filter regions.
-    num_times_observed = (weekly_strains > 0).max(2).values.sum(0)
+    if sparse:
+        tp = weekly_strains.indices()[0] * P + weekly_strains.indices()[1]
+        num_times_observed = torch.bincount(tp.unique_consecutive() % P, minlength=P)
+    else:
+        num_times_observed = (weekly_strains > 0).max(2).values.sum(0)
     ok_regions = (num_times_observed >= 2).nonzero(as_tuple=True)[0]
     ok_region_set = set(ok_regions.tolist())
     logger.info(f"Keeping {len(ok_regions)}/{weekly_strains.size(1)} regions")
     weekly_strains = weekly_strains.index_select(1, ok_regions)
+    if sparse:
+        weekly_strains = weekly_strains.coalesce()
     locations = [k for k, v in location_id.items() if v in ok_region_set]
     location_id = OrderedDict(zip(locations, range(len(locations))))
 
     # Construct region-local time scales centered around observations.
-    num_obs = weekly_strains.sum(-1)
+    num_obs = sum_counts(weekly_strains, -1)
     local_time = torch.arange(float(len(num_obs))) * TIMESTEP / GENERATION_TIME
     local_time = local_time[:, None]
     local_time = local_time - (local_time * num_obs).sum(0) / num_obs.sum(0)
 
-    return {
-        "location_id": location_id,
-        "mutations": mutations,
-        "weekly_strains": weekly_strains,
-        "features": features,
-        "lineage_id": lineage_id,
-        "lineage_id_inv": lineage_id_inv,
-        "local_time": local_time,
-    }
+    return cells, location_id, weekly_strains, local_time
+
+
+def slice_gisaid_data(dataset: dict, end_day: int) -> dict:
+    """
+    Truncates a dataset loaded by :func:`load_gisaid_data` with
+    ``keep_cells=True`` to an earlier ``end_day``. This matches loading with
+    ``end_day`` directly, but avoids rescanning rows, e.g. when backtesting
+    at multiple end days.
+    """
+    if "cells" not in dataset:
+        raise ValueError("Cannot slice dataset; load it with keep_cells=True")
+    cells = dataset["cells"]
+    if cells["end_day"] is not None and end_day > cells["end_day"]:
+        raise ValueError(
+            f"Cannot slice dataset ending on day {cells['end_day']} "
+            f"at later end_day {end_day}"
+        )
+    logger.info(f"Slicing gisaid data end_day: {end_day}")
+    mask = cells["day"] <= end_day
+    cells = {k: v[mask] if isinstance(v, np.ndarray) else v for k, v in cells.items()}
+    cells["end_day"] = end_day
+    cells, location_id, weekly_strains, local_time = _aggregate_cells(
+        cells, end_day, len(dataset["lineage_id"]), dataset["weekly_strains"].is_sparse
+    )
+    new = dataset.copy()
+    new["cells"] = cells
+    new["location_id"] = location_id
+    new["weekly_strains"] = weekly_strains
+    new["local_time"] = local_time
+    return new
 
 
 def subset_gisaid_data(
@@ -307,6 +554,7 @@ def subset_gisaid_data(
     """
     old = gisaid_dataset
     new = old.copy()
+    new.pop("cells", None)  # cells would be inconsistent with the subset
 
     # Select locations.
     if location_queries is not None:
@@ -325,8 +573,7 @@ def subset_gisaid_data(
     # Select strains.
     if new["weekly_strains"].size(-1) > max_strains:
         ids = (
-            new["weekly_strains"]
-            .sum([0, 1])
+            sum_counts(new["weekly_strains"], [0, 1])
             .sort(0, descending=True)
             .indices[:max_strains]
         )
@@ -336,7 +583,10 @@ def subset_gisaid_data(
         new["lineage_id"] = {name: i for i, name in enumerate(new["lineage_id_inv"])}
 
     # Select mutations.
-    gaps = new["features"].max(0).values - new["features"].min(0).values
+    features = new["features"]
+    if features.is_sparse:
+        features = features.to_dense()
+    gaps = features.max(0).values - features.min(0).values
     ids = (gaps >= 0.5).nonzero(as_tuple=True)[0]
     new["mutations"] = [new["mutations"][i] for i in ids.tolist()]
     new["features"] = new["features"].index_select(-1, ids)
@@ -407,7 +657,124 @@ def load_jhu_data(gisaid_data: dict) -> dict:
     }
 
 
-def model(dataset, model_type, *, forecast_steps=None):
+def features_matmul(coef, features):
+    """
+    Computes ``coef @ features.T`` for dense or sparse ``features``.
+
+    :param torch.Tensor coef: A tensor of coefficients of shape
+        ``batch_shape + (F,)``.
+    :param torch.Tensor features: A dense or sparse COO tensor of shape
+        ``(S, F)``.
+    :returns: A tensor of shape ``batch_shape + (S,)``.
+    """
+    if not features.is_sparse:
+        return coef @ features.T
+    batch_shape = coef.shape[:-1]
+    coef = coef.reshape(-1, coef.size(-1)).T  # [F, B]
+    result = torch.sparse.mm(features, coef).T  # [B, S]
+    return result.reshape(batch_shape + (features.size(0),))
+
+
+def sum_counts(counts, dim):
+    """
+    Sums a possibly sparse tensor of counts, returning a dense tensor.
+    """
+    counts = counts.sum(dim)
+    return counts.to_dense() if counts.is_sparse else counts
+
+
+def observed_cells(counts):
+    """
+    Extracts dense tensors of nonzero cells of a sparse ``[T, P, S]`` tensor
+    of multinomial counts, for use in :func:`sparse_multinomial_log_prob`.
+    This is cheap, but can be precomputed since :mod:`torch.jit` cannot trace
+    sparse tensors.
+
+    :param torch.Tensor counts: A sparse COO tensor of counts.
+    :returns: A dict with ``"s"`` and ``"count"`` over nonzero cells,
+        ``"t"``, ``"p"`` and ``"total"`` over ``(t, p)`` pairs with nonzero
+        counts, and ``"row"`` mapping each cell to its pair.
+    :rtype: dict
+    """
+    counts = counts.coalesce()
+    t, p, s = counts.indices()
+    x = counts.values()
+    P = counts.size(1)
+    tp, row = (t * P + p).unique_consecutive(return_inverse=True)
+    total = x.new_zeros(tp.shape).scatter_add_(0, row, x)
+    t = torch.div(tp, P, rounding_mode="floor")
+    return {"t": t, "p": tp % P, "total": total, "row": row, "s": s, "count": x}
+
+
+def sparse_multinomial_log_prob(cells, logits_fn):
+    """
+    Computes the total log probability of a sparse ``[T, P, S]`` tensor of
+    multinomial counts over the rightmost dim. This equals
+    ``Multinomial(logits=logits).log_prob(counts.to_dense()).sum()``, but
+    evaluates logits only at ``(t, p)`` pairs with nonzero counts, as a sum
+    over nonzero cells minus count-weighted ``logsumexp()`` of each pair.
+    Logits and the ``"count"`` and ``"total"`` of cells may have leading
+    batch dims, e.g. as masked by :func:`mask_cells`.
+
+    :param dict cells: The :func:`observed_cells` of counts.
+    :param callable logits_fn: A function inputting time and place indices
+        ``t, p`` of shape ``[U]`` and returning logits of shape ``[U, S]``.
+    :returns: A log probability of shape ``batch_shape``.
+    :rtype: torch.Tensor
+    """
+    x = cells["count"]
+    n = cells["total"]
+    logits = logits_fn(cells["t"], cells["p"])  # [..., U, S]
+    return (
+        (n + 1).lgamma().sum(-1)
+        - (x + 1).lgamma().sum(-1)
+        + (x * logits[..., cells["row"], cells["s"]]).sum(-1)
+        - (n * logits.logsumexp(-1)).sum(-1)
+    )
+
+
+def mask_cells(cells, mask):
+    """
+    Masks the :func:`observed_cells` of counts by a batch of lineage masks,
+    as if each lineage's counts were multiplied by its mask.
+
+    :param dict cells: The :func:`observed_cells` of counts.
+    :param torch.Tensor mask: A ``[K, S]`` tensor of lineage masks.
+    :returns: Cells whose ``"count"`` and ``"total"`` have a leading batch dim
+        of size ``K``.
+    :rtype: dict
+    """
+    count = cells["count"] * mask[:, cells["s"]]  # [K, C]
+    total = count.new_zeros(mask.shape[:1] + cells["total"].shape)
+    total.scatter_add_(-1, cells["row"].expand_as(count), count)  # [K, U]
+    return dict(cells, count=count, total=total)
+
+
+def _subsample_cells(cells, places, num_places):
+    # Selects the observed_cells() at a subset of places, renumbering places.
+    new_place = places.new_full((num_places,), -1)
+    new_place[places] = torch.arange(len(places), device=places.device)
+    keep_row = new_place[cells["p"]] >= 0
+    new_row = keep_row.cumsum(0) - 1
+    keep = keep_row[cells["row"]]
+    return {
+        "t": cells["t"][keep_row],
+        "p": new_place[cells["p"][keep_row]],
+        "total": cells["total"][keep_row],
+        "row": new_row[cells["row"][keep]],
+        "s": cells["s"][keep],
+        "count": cells["count"][keep],
+    }
+
+
+def model(
+    dataset,
+    model_type,
+    *,
+    forecast_steps=None,
+    place_subsample_size=None,
+    place_subsample=None,
+):
     """
     Bayesian regression model of lineage portions as a function of mutation features.
 
@@ -417,6 +784,10 @@ def model(dataset, model_type, *, forecast_steps=None):
     - During prediction (after training), the likelihood statement is omitted
       and instead a ``probs`` tensor is recorded; this is the predicted lineage
       portions in each (time, regin) bin.
+
+    If ``place_subsample_size`` is given, each run observes only a random
+    subset of places, and the ``place`` plate scales their log density.
+    Alternatively ``place_subsample`` observes a fixed subset of places.
     """
     # Tensor shapes are commented at at the end of some lines.
     features = dataset["features"]
@@ -425,7 +796,8 @@ def model(dataset, model_type, *, forecast_steps=None):
     S, F = features.shape
     if forecast_steps is None:  # During inference.
         weekly_strains = dataset["weekly_strains"]
-        assert weekly_strains.shape == (T, P, S)
+        if not weekly_strains.is_sparse:  # torch.jit cannot trace sparse shapes.
+            assert weekly_strains.shape == (T, P, S)
     else:  # During prediction.
         T = T + forecast_steps
         t0 = local_time[0]
@@ -433,8 +805,17 @@ def model(dataset, model_type, *, forecast_steps=None):
         local_time = t0 + dt * torch.arange(float(T))[:, None, None]
         assert local_time.shape == (T, P, 1)
     strain_plate = pyro.plate("strain", S, dim=-1)
-    place_plate = pyro.plate("place", P, dim=-2)
+    place_plate = pyro.plate(
+        "place",
+        P,
+        dim=-2,
+        subsample_size=place_subsample_size,
+        subsample=place_subsample,
+    )
     time_plate = pyro.plate("time", T, dim=-3)
+    places = None
+    if place_subsample_size is not None or place_subsample is not None:
+        places = place_plate.indices
 
     # Configure reparametrization (which does not affect model density).
     reparam = {}
@@ -448,6 +829,8 @@ def model(dataset, model_type, *, forecast_steps=None):
         reparam["init_loc"] = LocScaleReparam()
         reparam["rate"] = LocScaleReparam()
         reparam["init"] = LocScaleReparam()
+    if places is not None:
+        local_time = local_time.index_select(1, places)
     with poutine.reparam(config=reparam):
 
         # Sample global random variables.
@@ -467,7 +850,7 @@ def model(dataset, model_type, *, forecast_steps=None):
         Dist = dist.Logistic if "sparse" in model_type else dist.Normal
         coef = pyro.sample("coef", Dist(torch.zeros(F), coef_scale).to_event(1))  # [F]
         with strain_plate:
-            rate_loc_loc = 0.01 * coef @ features.T
+            rate_loc_loc = 0.01 * features_matmul(coef, features)
             if "skip" in model_type:
                 rate_loc = pyro.deterministic("rate_loc", rate_loc_loc)  # [S]
             else:
@@ -480,6 +863,27 @@ def model(dataset, model_type, *, forecast_steps=None):
             init = pyro.sample("init", dist.Normal(init_loc, init_scale))  # [P, S]
 
         # Finally observe counts.
+        if forecast_steps is None and weekly_strains.is_sparse:
+            if "poisson" in model_type:
+                weekly_strains = weekly_strains.to_dense()
+            else:
+                # Evaluate logits only at observed (time, place) pairs.
+                def logits_fn(t, p):
+                    return init[p] + rate[p] * local_time[t, p]  # [U, S]
+
+                cells = dataset.get("observed_cells")
+                if cells is None:
+                    cells = observed_cells(weekly_strains)
+                if places is None:
+                    scale = 1.0
+                else:
+                    cells = _subsample_cells(cells, places, P)
+                    scale = P / len(places)
+                with poutine.scale(scale=scale):
+                    pyro.factor("obs", sparse_multinomial_log_prob(cells, logits_fn))
+                return
+        if forecast_steps is None and places is not None:
+            weekly_strains = weekly_strains.index_select(1, places)
         logits = init + rate * local_time  # [T, P, S]
         if forecast_steps is None:  # During inference.
             if "poisson" in model_type:
@@ -519,7 +923,7 @@ class InitLocFn:
 
     def __init__(self, dataset):
         # Initialize init.
-        init = dataset["weekly_strains"].sum(0)  # [P, S]
+        init = sum_counts(dataset["weekly_strains"], 0)  # [P, S]
         init.add_(1 / init.size(-1)).div_(init.sum(-1, True))
         init.log_().sub_(init.median(-1, True).values)
         self.init = init  # [P, S]
@@ -527,7 +931,8 @@ class InitLocFn:
         self.init_loc = init.mean(0)  # [S]
         self.init_loc_decentered = self.init_loc / 2
         assert not torch.isnan(self.init).any()
-        self.pois = dataset["weekly_strains"].sum(-1, True).clamp(min=0.1)  # [T, P, 1]
+        self.pois = sum_counts(dataset["weekly_strains"], -1)[..., None]  # [T, P, 1]
+        self.pois.clamp_(min=0.1)
         logger.info(f"init stddev = {self.init.std():0.3g}")
 
     def __call__(self, site):
@@ -535,7 +940,11 @@ class InitLocFn:
         shape = site["fn"].shape()
         if hasattr(self, name):
             result = getattr(self, name)
-            assert result.shape == shape
+            if result.shape != shape:
+                raise ValueError(
+                    f"InitLocFn expected {name} of shape {tuple(result.shape)} but "
+                    f"got {tuple(shape)}; guides must be initialized on all places"
+                )
             return result
         if name in ("coef_scale", "init_scale", "init_loc_scale"):
             return torch.ones(shape)
@@ -568,11 +977,12 @@ class Guide(AutoGuideList):
     Custom guide for large-scale inference.
 
     This combines a low-rank multivariate normal guide over small variables
-    with a mean field guide over remaining latent variables.
+    with a mean field guide over remaining latent variables. The mean field
+    part supports subsampling of plates returned by ``create_plates``.
     """
 
-    def __init__(self, model, init_loc_fn, init_scale, rank):
-        super().__init__(model)
+    def __init__(self, model, init_loc_fn, init_scale, rank, create_plates=None):
+        super().__init__(model, create_plates=create_plates)
 
         # Jointly estimate globals, mutation coefficients, and strain coefficients.
         mvn = [
@@ -602,6 +1012,235 @@ class Guide(AutoGuideList):
         self.append(AutoNormal(model, init_loc_fn=init_loc_fn, init_scale=init_scale))
 
 
+# Names of dimensions of latent variables and reparametrizer parameters, keyed
+# by site name without any "_decentered" or "_centered" suffix.
+_SITE_DIMS = {
+    "coef": ("mutation",),
+    "rate_loc": ("lineage",),
+    "init_loc": ("lineage",),
+    "rate": ("place", "lineage"),
+    "init": ("place", "lineage"),
+    "local_time": ("place", "lineage"),
+}
+
+
+def _dim_names(dataset):
+    return {
+        "place": dataset["location_id"],
+        "lineage": dataset["lineage_id"],
+        "mutation": {name: i for i, name in enumerate(dataset["mutations"])},
+    }
+
+
+def _guide_params(guide):
+    # Yields ((kind, site name), unconstrained tensor) pairs for parameters of
+    # a Guide and of the model's reparametrizers, where tensors are views into
+    # parameters.
+    mvn_guide, normal_guide = guide
+    with guide._pyro_context:
+        loc = mvn_guide.loc.unconstrained()
+        scale = mvn_guide.scale.unconstrained()
+        cov_factor = mvn_guide.cov_factor.unconstrained()
+        pos = 0
+        for name, site in mvn_guide.prototype_trace.iter_stochastic_nodes():
+            shape = mvn_guide._unconstrained_shapes[name]
+            end = pos + shape.numel()
+            yield ("mvn.loc", name), loc[pos:end].view(shape)
+            yield ("mvn.scale", name), scale[pos:end].view(shape)
+            yield ("mvn.cov_factor", name), cov_factor[pos:end].view(shape + (-1,))
+            pos = end
+        for name, site in normal_guide.prototype_trace.iter_stochastic_nodes():
+            loc = getattr(normal_guide.locs, name)
+            scale = getattr(normal_guide.scales, name)
+            yield ("normal.loc", name), loc.unconstrained()
+            yield ("normal.scale", name), scale.unconstrained()
+    for name, value in pyro.get_param_store().named_parameters():
+        if "." not in name and (name == "local_time" or name.endswith("_centered")):
+            yield ("param", name), value
+
+
+def get_guide_state(guide, dataset) -> dict:
+    """
+    Extracts parameters of a :class:`Guide` and of the model's reparametrizers,
+    labeled by place, lineage and mutation names, so they can warm start a fit
+    to another dataset via :func:`warm_start_guide`.
+    """
+    return {
+        "names": _dim_names(dataset),
+        "params": {k: v.detach().clone() for k, v in _guide_params(guide)},
+    }
+
+
+@torch.no_grad()
+def warm_start_guide(guide, dataset, state):
+    """
+    Sets parameters of an initialized :class:`Guide` to those of a previous
+    fit, as returned by :func:`get_guide_state`. Entries are matched by place,
+    lineage and mutation name; unmatched entries keep their initial values,
+    e.g. from :class:`InitLocFn`.
+    """
+    old_names = state["names"]
+    new_names = _dim_names(dataset)
+    index = {}
+    for dim, names in new_names.items():
+        old_ids = old_names[dim]
+        pairs = [(i, old_ids[name]) for name, i in names.items() if name in old_ids]
+        index[dim] = torch.tensor(pairs, dtype=torch.long).reshape(-1, 2).T
+        logger.info(f"Warm starting {len(pairs)}/{len(names)} {dim}s")
+    for key, new in _guide_params(guide):
+        old = state["params"].get(key)
+        if old is None:
+            continue
+        dims = _SITE_DIMS.get(re.sub("_(de)?centered$", "", key[1]), ())
+        if old.dim() != new.dim() or old.shape[len(dims) :] != new.shape[len(dims) :]:
+            logger.info(f"Not warm starting {key} of mismatched shape")
+            continue
+        if new.dim() < len(dims):
+            # Params shared across names, e.g. scalar *_centered params of
+            # sites in plates, are copied as is.
+            new.copy_(old)
+            continue
+        new_index, old_index = [], []
+        for i, dim in enumerate(dims):
+            shape = (-1,) + (1,) * (len(dims) - i - 1)
+            new_index.append(index[dim][0].reshape(shape))
+            old_index.append(index[dim][1].reshape(shape))
+        new[tuple(new_index)] = old.to(new)[tuple(old_index)]
+
+
+def _decentered(fn, centered, decentered_value):
+    # Follows LocScaleReparam, returning (decentered_fn, value).
+    decentered_fn = type(fn)(fn.loc * centered, fn.scale.pow(centered))
+    delta = decentered_value - centered * fn.loc
+    value = fn.loc + fn.scale.pow(1 - centered) * delta
+    return decentered_fn, value
+
+
+# Parameters of the reparametrizers of the "sparse-skip-reparam" model.
+_FUSED_PARAMS = [
+    "coef_centered",
+    "init_loc_centered",
+    "rate_centered",
+    "init_centered",
+    "local_time",
+]
+
+
+def _fused_log_p(dataset, cells, values, params):
+    # Computes the log joint density of the "sparse-skip-reparam" model, as in
+    # model(), given values of latent variables and reparametrizer params,
+    # which may have a leading batch dim. Returns a tensor of batch shape.
+
+    # Score global random variables.
+    log_p = 0.0
+    for name, fn in [
+        ("coef_scale", dist.LogNormal(-4, 2)),
+        ("init_loc_scale", dist.LogNormal(0, 2)),
+        ("rate_scale", dist.LogNormal(-4, 2)),
+        ("init_scale", dist.LogNormal(0, 2)),
+    ]:
+        log_p = log_p + fn.log_prob(values[name])
+
+    # Params of sites in plates are scalar up to batch dims, so insert the
+    # site's dims to align batch dims.
+    local_time = params["local_time"]  # [P, S]
+    batch_shape = local_time.shape[:-2]
+
+    def centered(name, site_dim):
+        value = params[name]
+        if value.shape == batch_shape:
+            value = value.reshape(batch_shape + (1,) * site_dim)
+        return value
+
+    # Score decentered random variables, as in model().
+    features = dataset["features"]
+    S, F = features.shape
+    fn, coef = _decentered(
+        dist.Logistic(torch.zeros(F), values["coef_scale"][..., None]),
+        centered("coef_centered", 1),
+        values["coef_decentered"],
+    )  # [F]
+    log_p = log_p + sum_rightmost(fn.log_prob(values["coef_decentered"]), 1)
+    rate_loc = 0.01 * features_matmul(coef, features)  # [S]
+    fn, init_loc = _decentered(
+        dist.Normal(torch.zeros(S), values["init_loc_scale"][..., None]),
+        centered("init_loc_centered", 1),
+        values["init_loc_decentered"],
+    )  # [S]
+    log_p = log_p + sum_rightmost(fn.log_prob(values["init_loc_decentered"]), 1)
+    fn, rate = _decentered(
+        dist.Normal(rate_loc[..., None, :], values["rate_scale"][..., None, None]),
+        centered("rate_centered", 2),
+        values["rate_decentered"],
+    )  # [P, S]
+    log_p = log_p + sum_rightmost(fn.log_prob(values["rate_decentered"]), 2)
+    fn, init = _decentered(
+        dist.Normal(init_loc[..., None, :], values["init_scale"][..., None, None]),
+        centered("init_centered", 2),
+        values["init_decentered"],
+    )  # [P, S]
+    log_p = log_p + sum_rightmost(fn.log_prob(values["init_decentered"]), 2)
+
+    # Observe counts.
+    time = dataset["local_time"]  # [T, P]
+
+    def logits_fn(t, p):
+        return init[..., p, :] + rate[..., p, :] * (
+            time[t, p, None] + local_time[..., p, :]
+        )  # [U, S]
+
+    return log_p + sparse_multinomial_log_prob(cells, logits_fn)
+
+
+def fused_elbo_loss(model, guide, dataset, model_type, *, cond_data={}, **kwargs):
+    """
+    A hand-fused equivalent of ``Trace_ELBO().differentiable_loss`` for the
+    "sparse-skip-reparam" model and an initialized :class:`Guide`, avoiding
+    the overhead of Pyro's tracing, reparametrization and guide composition
+    at every step. This can be passed as the ``loss`` of
+    :class:`~pyro.infer.SVI`, after binding any ``cond_data`` that ``model``
+    is conditioned on.
+
+    This draws the same random numbers in the same order as the traced guide,
+    so that fits agree with ``Trace_ELBO`` fits of the same seed up to
+    floating point error. Subsampling is not supported.
+
+    :returns: A differentiable negative ELBO estimate.
+    :rtype: torch.Tensor
+    """
+    if model_type != "sparse-skip-reparam":
+        raise ValueError(f"fused_elbo_loss does not support model_type {model_type}")
+    if kwargs.get("place_subsample_size") is not None:
+        raise ValueError("fused_elbo_loss does not support subsampling")
+    if kwargs.get("place_subsample") is not None:
+        raise ValueError("fused_elbo_loss does not support subsampling")
+    mvn_guide, normal_guide = guide
+    values = {k: torch.as_tensor(v) for k, v in cond_data.items()}
+
+    # Sample from the guide. Its context makes parameters visible to pyro.param
+    # handlers, e.g. to SVI.
+    with guide._pyro_context:
+        posterior = mvn_guide.get_posterior()
+        latent = posterior.rsample()
+        log_q = posterior.log_prob(latent)
+        for site, unconstrained_value in mvn_guide._unpack_latent(latent):
+            transform = biject_to(site["fn"].support)
+            value = values[site["name"]] = transform(unconstrained_value)
+            log_density = transform.inv.log_abs_det_jacobian(value, unconstrained_value)
+            log_q = log_q + log_density.sum()
+        for name, site in normal_guide.prototype_trace.iter_stochastic_nodes():
+            fn = dist.Normal(*normal_guide._get_loc_and_scale(name))
+            values[name] = fn.rsample()
+            log_q = log_q + fn.log_prob(values[name]).sum()
+
+    cells = dataset.get("observed_cells")
+    if cells is None:
+        cells = observed_cells(dataset["weekly_strains"].to_sparse())
+    params = {name: pyro.param(name) for name in _FUSED_PARAMS}
+    log_p = _fused_log_p(dataset, cells, values, params)
+    return log_q - log_p
+
+
 class GaussianGuide(AutoGuideList):
     def __init__(self, model, init_loc_fn, init_scale):
         super().__init__(model)
@@ -716,6 +1355,116 @@ def predict(
     return dict(result)
 
 
+class EarlyStopping:
+    """
+    Convergence criteria for stopping SVI before its maximum number of steps.
+
+    SVI is considered converged once both the smoothed loss has not improved
+    by more than ``loss_tol`` in the last ``patience`` steps, and the relative
+    change of parameters over the last ``patience`` steps is less than
+    ``param_tol``. Losses are smoothed by an exponential moving average over
+    roughly ``smoothing`` steps.
+
+    :param params: An iterable of parameter tensors, updated in place by an
+        optimizer.
+    :param int patience: The number of steps over which to assess progress.
+    :param float loss_tol: Absolute tolerance of smoothed losses.
+    :param float param_tol: Relative tolerance of parameter changes.
+    :param int smoothing: The time constant of loss smoothing.
+    """
+
+    def __init__(self, params, *, patience, loss_tol, param_tol, smoothing=50):
+        assert patience > 0
+        self.params = list(params)
+        self.patience = patience
+        self.loss_tol = loss_tol
+        self.param_tol = param_tol
+        self.decay = 1 - 1 / smoothing
+        self.num_steps = 0
+        self.best_loss = math.inf
+        self.best_step = 0
+        self.param_change = math.inf
+        self._moving_loss = 0.0
+        self._moving_weight = 0.0
+        self._snapshot = self._flatten_params()
+
+    def _flatten_params(self):
+        return torch.cat([p.detach().reshape(-1) for p in self.params])
+
+    def __call__(self, loss):
+        """
+        Records the loss of an SVI step.
+
+        :returns: Whether SVI has converged.
+        :rtype: bool
+        """
+        self.num_steps += 1
+        self._moving_loss = self.decay * self._moving_loss + (1 - self.decay) * loss
+        self._moving_weight = self.decay * self._moving_weight + (1 - self.decay)
+        smoothed_loss = self._moving_loss / self._moving_weight
+        if smoothed_loss < self.best_loss - self.loss_tol:
+            self.best_loss = smoothed_loss
+            self.best_step = self.num_steps
+        if self.num_steps % self.patience:
+            return False
+        params = self._flatten_params()
+        scale = self._snapshot.norm().clamp(min=1e-8)
+        self.param_change = ((params - self._snapshot).norm() / scale).item()
+        self._snapshot = params
+        return (
+            self.num_steps - self.best_step >= self.patience
+            and self.param_change < self.param_tol
+        )
+
+    def get_state(self):
+        return {k: v for k, v in self.__dict__.items() if k != "params"}
+
+    def set_state(self, state):
+        self.__dict__.update(state)
+
+
+def save_checkpoint(filename, state):
+    """
+    Atomically saves a checkpoint of :func:`fit_svi`, so that a partially
+    written file is never loaded.
+    """
+    temp = filename + ".temp"
+    torch.save(state, temp)
+    os.replace(temp, filename)
+
+
+def load_checkpoint(filename, key=None):
+    """
+    Loads a checkpoint saved by :func:`fit_svi`, or returns None if there is
+    no checkpoint or if the checkpoint was saved with a different ``key``.
+    """
+    if not os.path.exists(filename):
+        return None
+    state = torch_load(filename, map_location=torch.empty(()).device)
+    if state["key"] != key:
+        logger.info(f"ignoring stale {filename}")
+        return None
+    return state
+
+
+def _all_reduce_step(svi, **kwargs):
+    # Like svi.step(), but sums losses and gradients over processes.
+    with poutine.trace(param_only=True) as param_capture:
+        loss = svi.loss_and_grads(svi.model, svi.guide, **kwargs)
+    params = [
+        site["value"].unconstrained()
+        for name, site in sorted(param_capture.trace.nodes.items())
+    ]
+    grads = [torch.zeros_like(p) if p.grad is None else p.grad for p in params]
+    flat = torch.cat([params[0].new_tensor([loss])] + [g.reshape(-1) for g in grads])
+    torch.distributed.all_reduce(flat)
+    for p, g in zip(params, flat[1:].split([p.numel() for p in params])):
+        p.grad = g.view_as(p)
+    svi.optim(params)
+    pyro.infer.util.zero_grads(params)
+    return flat[0].item()
+
+
 def fit_svi(
     dataset: dict,
     *,
@@ -733,26 +1482,138 @@ def fit_svi(
     log_every=50,
     seed=20210319,
     check_loss=False,
+    place_subsample_size=None,
+    fused=False,
+    patience=None,
+    loss_tol=1e-4,
+    param_tol=1e-3,
+    checkpoint_filename=None,
+    checkpoint_every=100,
+    checkpoint_key=None,
+    resume=False,
+    warm_start=None,
 ) -> dict:
     """
     Fits a variational posterior using stochastic variational inference (SVI).
+
+    If ``patience`` is given, SVI stops before ``num_steps`` once it has
+    converged according to :class:`EarlyStopping`, where ``loss_tol`` is
+    measured in loss per observation. The result records a ``"stop_reason"``
+    of either "converged" or "num_steps", and the ``"num_steps"`` taken.
+
+    If ``warm_start`` is given, the default custom guide is initialized from
+    the ``"guide_state"`` of a previous result via :func:`warm_start_guide`,
+    even if places, lineages or mutations differ. Results of the custom guide
+    include such a ``"guide_state"``.
+
+    If ``checkpoint_filename`` is given, the param store, optimizer state, RNG
+    state, step counter and loss history are saved every ``checkpoint_every``
+    steps. If ``resume`` is true, fitting continues from the checkpoint, if
+    any, producing the same result as an uninterrupted fit. Checkpoints saved
+    with a different ``checkpoint_key`` are ignored.
+
+    If ``fused`` is true, the ELBO of the "sparse-skip-reparam" model and the
+    default custom guide is computed by :func:`fused_elbo_loss`, which agrees with
+    the traced ELBO up to floating point error but is faster. This ignores
+    ``jit``.
+
+    If ``place_subsample_size`` is given, each step observes a random subset
+    of places, trading more steps for cheaper steps. This is supported only by
+    the "map", "normal" and default custom guides.
+
+    If a :mod:`torch.distributed` process group is initialized, e.g. by
+    :func:`fit_svi_distributed`, each process observes a fixed shard of
+    places and gradients are summed across processes, so that all processes
+    take identical steps. This supports the same guides as subsampling. Only
+    rank 0 returns a result; other ranks return None. MAP fits match
+    single-process fits up to floating point error, whereas stochastic guides
+    match only in distribution, since random numbers differ.
     """
     start_time = default_timer()
+    process_rank, num_processes = 0, 1
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        process_rank = torch.distributed.get_rank()
+        num_processes = torch.distributed.get_world_size()
 
     logger.info(f"Fitting {guide_type} guide via SVI")
     pyro.set_rng_seed(seed)
     pyro.clear_param_store()
     param_store = pyro.get_param_store()
 
+    if "cells" in dataset:
+        # Cells are not needed for fitting, and cannot be hashed by the jit.
+        dataset = dataset.copy()
+        del dataset["cells"]
+    if jit and dataset["features"].is_sparse:
+        # torch.jit cannot trace sparse constants.
+        dataset = dataset.copy()
+        dataset["features"] = dataset["features"].to_dense()
+    if dataset["weekly_strains"].is_sparse:
+        dataset = dataset.copy()
+        if "poisson" in model_type:
+            # The Poisson likelihood is dense.
+            dataset["weekly_strains"] = dataset["weekly_strains"].to_dense()
+        else:
+            dataset["observed_cells"] = observed_cells(dataset["weekly_strains"])
+    elif fused:
+        dataset = dataset.copy()
+        dataset["observed_cells"] = observed_cells(
+            dataset["weekly_strains"].to_sparse()
+        )
+
     # Initialize guide so we can count parameters and register hooks.
     cond_data = {k: torch.as_tensor(v) for k, v in cond_data.items()}
     model_ = poutine.condition(model, cond_data)
     init_loc_fn = InitLocFn(dataset)
     Elbo = JitTrace_ELBO if jit else Trace_ELBO
+    num_places = len(dataset["location_id"])
+    unsharded_guides = ("full", "structured", "gaussian", "regressive")
+    if place_subsample_size is not None:
+        if guide_type in unsharded_guides:
+            raise ValueError(f"guide_type {guide_type} does not support subsampling")
+        if place_subsample_size >= num_places:
+            place_subsample_size = None
+    shard = None
+    if num_processes > 1:
+        if guide_type in unsharded_guides:
+            raise ValueError(f"guide_type {guide_type} does not support sharding")
+        if place_subsample_size is not None:
+            raise ValueError("place_subsample_size does not support sharding")
+        if num_places < num_processes:
+            raise ValueError(f"Cannot shard {num_places} places over {num_processes}")
+        shard = torch.arange(process_rank, num_places, num_processes)
+    if fused:
+        if model_type != "sparse-skip-reparam":
+            raise ValueError(f"fused does not support model_type {model_type}")
+        if guide_type in ("map", "normal") + unsharded_guides:
+            raise ValueError(f"fused does not support guide_type {guide_type}")
+        if place_subsample_size is not None or shard is not None:
+            raise ValueError("fused does not support subsampling or sharding")
+    if warm_start is not None and guide_type in ("map", "normal") + unsharded_guides:
+        raise ValueError(f"warm_start does not support guide_type {guide_type}")
+    if checkpoint_filename is not None and shard is not None:
+        raise ValueError("checkpointing does not support sharding")
+
+    def create_plates(*args, place_subsample_size=None, place_subsample=None, **kwargs):
+        if place_subsample_size is None and place_subsample is None:
+            return []  # Use full plates, e.g. during initialization and predict().
+        return pyro.plate(
+            "place",
+            num_places,
+            dim=-2,
+            subsample_size=place_subsample_size,
+            subsample=place_subsample,
+        )
+
     if guide_type == "map":
-        guide = AutoDelta(model_, init_loc_fn=init_loc_fn)
+        guide = AutoDelta(model_, init_loc_fn=init_loc_fn, create_plates=create_plates)
     elif guide_type == "normal":
-        guide = AutoNormal(model_, init_loc_fn=init_loc_fn, init_scale=0.01)
+        guide = AutoNormal(
+            model_,
+            init_loc_fn=init_loc_fn,
+            init_scale=0.01,
+            create_plates=create_plates,
+        )
     elif guide_type == "full":
         guide = AutoLowRankMultivariateNormal(
             model_, init_loc_fn=init_loc_fn, init_scale=0.01, rank=rank
@@ -777,7 +1638,13 @@ def fit_svi(
         guide = RegressiveGuide(model_, init_loc_fn=init_loc_fn, init_scale=0.01)
         Elbo = Effect_ELBO
     else:
-        guide = Guide(model_, init_loc_fn=init_loc_fn, init_scale=0.01, rank=rank)
+        guide = Guide(
+            model_,
+            init_loc_fn=init_loc_fn,
+            init_scale=0.01,
+            rank=rank,
+            create_plates=create_plates,
+        )
     # This initializes the guide:
     latent_shapes = {k: v.shape for k, v in guide(dataset, model_type).items()}
     latent_numel = {k: v.numel() for k, v in latent_shapes.items()}
@@ -795,6 +1662,12 @@ def fit_svi(
             + [f" {k} {tuple(v)}" for k, v in param_shapes.items()]
         )
     )
+    if warm_start is not None:
+        warm_start_guide(guide, dataset, warm_start)
+    if num_processes > 1:
+        # Start all processes from identical parameters.
+        for name, value in sorted(param_store.named_parameters()):
+            torch.distributed.broadcast(value.data, 0)
 
     # Log gradient norms during inference.
     series: dict = defaultdict(list)
@@ -829,12 +1702,70 @@ def fit_svi(
         return config
 
     optim = ClippedAdam(optim_config)
-    elbo = Elbo(max_plate_nesting=3, ignore_jit_warnings=True)
-    svi = SVI(model_, guide, optim, elbo)
+    if fused:
+        elbo = functools.partial(fused_elbo_loss, cond_data=cond_data)
+    else:
+        elbo = Elbo(max_plate_nesting=3, ignore_jit_warnings=True)
+    if shard is None:
+        svi = SVI(model_, guide, optim, elbo)
+    else:
+        # Scale each shard so that summing over processes counts each place
+        # once and each global latent variable once.
+        scale = len(shard) / num_places
+        svi = SVI(
+            poutine.scale(model_, scale=scale),
+            poutine.scale(guide, scale=scale),
+            optim,
+            elbo,
+        )
     losses = []
-    num_obs = dataset["weekly_strains"].count_nonzero()
-    for step in range(num_steps):
-        loss = svi.step(dataset=dataset, model_type=model_type)
+    num_obs = dataset["weekly_strains"]
+    if num_obs.is_sparse:
+        num_obs = num_obs.coalesce().values()
+    num_obs = num_obs.count_nonzero()
+    early_stopping = None
+    if patience is not None:
+        early_stopping = EarlyStopping(
+            [v for _, v in param_store.named_parameters()],
+            patience=patience,
+            loss_tol=loss_tol,
+            param_tol=param_tol,
+        )
+    stop_reason = "num_steps"
+    start_step = 0
+    checkpoint = None
+    if resume and checkpoint_filename is not None:
+        checkpoint = load_checkpoint(checkpoint_filename, checkpoint_key)
+    if checkpoint is not None:
+        logger.info(f"Resuming from step {checkpoint['step']} of {checkpoint_filename}")
+        # Update parameters in place to preserve gradient hooks.
+        params = dict(param_store.named_parameters())
+        with torch.no_grad():
+            for name, value in checkpoint["params"].items():
+                params[name].copy_(value)
+        optim.set_state(checkpoint["optim"])
+        set_rng_state(checkpoint["rng"])
+        if checkpoint["cuda_rng"] is not None:
+            torch.cuda.set_rng_state_all(checkpoint["cuda_rng"])
+        losses.extend(checkpoint["losses"])
+        for name, values in checkpoint["series"].items():
+            series[name].extend(values)
+        if early_stopping is not None:
+            early_stopping.set_state(checkpoint["early_stopping"])
+        start_step = checkpoint["step"]
+        del checkpoint
+    for step in range(start_step, num_steps):
+        if shard is not None:
+            # Processes draw different numbers of local latent variables, so
+            # reseed them identically to draw identical global latent variables.
+            pyro.set_rng_seed(seed + step)
+        step_ = svi.step if shard is None else functools.partial(_all_reduce_step, svi)
+        loss = step_(
+            dataset=dataset,
+            model_type=model_type,
+            place_subsample_size=place_subsample_size,
+            place_subsample=shard,
+        )
         assert not math.isnan(loss)
         losses.append(loss)
         median = guide.median()
@@ -858,6 +1789,41 @@ def fit_svi(
             prev = torch.tensor(losses[-50:-25], device="cpu").median().item()
             curr = torch.tensor(losses[-25:], device="cpu").median().item()
             assert (curr - prev) < num_obs, "loss is increasing"
+        if early_stopping is not None and early_stopping(float(loss / num_obs)):
+            stop_reason = "converged"
+            logger.info(
+                f"Converged after {step + 1} steps with parameter change "
+                f"{early_stopping.param_change:0.3g}"
+            )
+            break
+        if checkpoint_filename is not None and (step + 1) % checkpoint_every == 0:
+            save_checkpoint(
+                checkpoint_filename,
+                {
+                    "key": checkpoint_key,
+                    "step": step + 1,
+                    "params": {
+                        k: v.detach().clone()
+                        for k, v in param_store.named_parameters()
+                    },
+                    "optim": optim.get_state(),
+                    "rng": get_rng_state(),
+                    "cuda_rng": (
+                        torch.cuda.get_rng_state_all()
+                        if torch.cuda.is_available()
+                        else None
+                    ),
+                    "losses": list(losses),
+                    "series": {k: list(v) for k, v in series.items()},
+                    "early_stopping": (
+                        None
+                        if early_stopping is None
+                        else early_stopping.get_state()
+                    ),
+                },
+            )
+    if process_rank:
+        return None
 
     result = predict(
         model_,
@@ -868,6 +1834,8 @@ def fit_svi(
         forecast_steps=forecast_steps,
     )
     result["losses"] = losses
+    result["stop_reason"] = stop_reason
+    result["num_steps"] = len(losses)
     series["loss"] = losses
     result["series"] = dict(series)
     result["params"] = {
@@ -875,10 +1843,274 @@ def fit_svi(
         for k, v in param_store.items()
         if v.numel() < 1e7
     }
+    if isinstance(guide, Guide):
+        result["guide_state"] = get_guide_state(guide, dataset)
     result["walltime"] = default_timer() - start_time
     return result
 
 
+def _fit_svi_worker(init_method, rank, world_size, num_threads, dtype, dataset, kwargs):
+    torch.set_default_dtype(dtype)
+    torch.set_num_threads(num_threads)
+    torch.distributed.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+    try:
+        fit_svi(dataset, **kwargs)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def fit_svi_distributed(dataset: dict, *, num_workers: int, **kwargs) -> dict:
+    """
+    Runs :func:`fit_svi` data-parallel over ``num_workers`` processes on a
+    single node, communicating via the gloo backend. The current process acts
+    as rank 0 and returns its result; CPU threads are divided among processes.
+
+    :param dict dataset: A dataset as returned by :func:`load_gisaid_data`.
+    :param int num_workers: The number of processes, including this one.
+    :param kwargs: Keyword arguments for :func:`fit_svi`.
+    """
+    if num_workers <= 1:
+        return fit_svi(dataset, **kwargs)
+    if "cells" in dataset:
+        dataset = dataset.copy()
+        del dataset["cells"]
+    old_num_threads = torch.get_num_threads()
+    num_threads = max(1, old_num_threads // num_workers)
+    context = torch.multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as dirname:
+        init_method = "file://" + os.path.join(dirname, "store")
+        workers = [
+            context.Process(
+                target=_fit_svi_worker,
+                args=(
+                    init_method,
+                    rank,
+                    num_workers,
+                    num_threads,
+                    torch.get_default_dtype(),
+                    dataset,
+                    kwargs,
+                ),
+            )
+            for rank in range(1, num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        torch.set_num_threads(num_threads)
+        torch.distributed.init_process_group(
+            "gloo", init_method=init_method, rank=0, world_size=num_workers
+        )
+        try:
+            result = fit_svi(dataset, **kwargs)
+        finally:
+            torch.distributed.destroy_process_group()
+            torch.set_num_threads(old_num_threads)
+            for worker in workers:
+                worker.join()
+    failed = [w.exitcode for w in workers if w.exitcode]
+    if failed:
+        raise RuntimeError(f"fit_svi workers failed with exit codes {failed}")
+    return result
+
+
+def fit_svi_loo(
+    dataset: dict,
+    masks: torch.Tensor,
+    *,
+    model_type: str,
+    cond_data={},
+    learning_rate=0.05,
+    learning_rate_decay=0.1,
+    num_steps=3001,
+    clip_norm=10.0,
+    rank=200,
+    log_every=50,
+    seed=20210319,
+    warm_start=None,
+) -> List[dict]:
+    """
+    Fits the default custom guide to a batch of leave-one-out variants of a
+    dataset at once, where the ``k``-th variant multiplies ``weekly_strains``
+    by ``masks[k]``.
+
+    Each variant has its own copy of guide parameters, initialized from its
+    masked counts and stacked along a leading batch dim, and the batch shares
+    the dataset and the per-step overhead of :func:`fused_elbo_loss`. Since
+    :class:`ClippedAdam` updates are elementwise, this is equivalent to
+    fitting each variant by :func:`fit_svi` with ``fused=True``, up to random
+    numbers.
+
+    :param dict dataset: A dataset as returned by :func:`load_gisaid_data`.
+    :param torch.Tensor masks: A ``[K, S]`` tensor of lineage masks.
+    :param dict warm_start: An optional ``"guide_state"`` of a result of
+        :func:`fit_svi`, e.g. of the full dataset, from which all variants
+        are initialized.
+    :returns: A list of ``K`` results, each including the ``"median"`` of
+        ``"coef"`` and ``"rate_loc"``, ``"losses"``, and a ``"guide_state"``.
+    :rtype: list
+    """
+    start_time = default_timer()
+    if model_type != "sparse-skip-reparam":
+        raise ValueError(f"fit_svi_loo does not support model_type {model_type}")
+    K = len(masks)
+    logger.info(f"Fitting {K} leave-one-out variants via SVI")
+    pyro.set_rng_seed(seed)
+    pyro.clear_param_store()
+    dataset = dataset.copy()
+    dataset.pop("cells", None)
+    counts = dataset["weekly_strains"]
+    cells = observed_cells(counts if counts.is_sparse else counts.to_sparse())
+    cells = mask_cells(cells, masks)
+    num_obs = (cells["count"] > 0).sum(-1)  # [K]
+
+    # Initialize a guide for each variant from its masked counts, as fit_svi()
+    # would, then stack their parameters.
+    cond_data = {k: torch.as_tensor(v) for k, v in cond_data.items()}
+    model_ = poutine.condition(model, cond_data)
+    if counts.is_sparse:
+        counts = counts.coalesce()
+    stacked_params = defaultdict(list)
+    for mask in masks:
+        pyro.set_rng_seed(seed)
+        pyro.clear_param_store()
+        if counts.is_sparse:
+            masked_values = counts.values() * mask[counts.indices()[-1]]
+            masked_counts = torch.sparse_coo_tensor(
+                counts.indices(), masked_values, counts.shape
+            ).coalesce()
+        else:
+            masked_counts = counts * mask
+        masked = dict(dataset, weekly_strains=masked_counts)
+        init_loc_fn = InitLocFn(masked)
+        guide = Guide(model_, init_loc_fn=init_loc_fn, init_scale=0.01, rank=rank)
+        guide(masked, model_type)
+        if warm_start is not None:
+            warm_start_guide(guide, masked, warm_start)
+        for key, value in _guide_params(guide):
+            stacked_params[key].append(value.detach().clone())
+        del masked, masked_counts
+    mvn_guide, normal_guide = guide
+    mvn_sites = {
+        name: site["fn"].support
+        for name, site in mvn_guide.prototype_trace.iter_stochastic_nodes()
+    }
+    normal_sites = [
+        name for name, _ in normal_guide.prototype_trace.iter_stochastic_nodes()
+    ]
+    pyro.clear_param_store()
+    param_constraints = {}
+    for (kind, name), values in stacked_params.items():
+        if kind == "mvn.scale":
+            constraint = mvn_guide.scale_constraint
+        elif kind == "normal.scale":
+            constraint = normal_guide.scale_constraint
+        elif name.endswith("_centered"):
+            constraint = constraints.unit_interval
+        else:
+            constraint = constraints.real
+        param_constraints[kind, name] = constraint
+        value = transform_to(constraint)(torch.stack(values))
+        pyro.param(f"loo.{kind}.{name}", value, constraint=constraint)
+    del stacked_params
+
+    def get_params():
+        return {
+            (kind, name): pyro.param(f"loo.{kind}.{name}")
+            for kind, name in param_constraints
+        }
+
+    batch_losses: List[torch.Tensor] = []
+
+    def elbo(model, guide):
+        # Like fused_elbo_loss(), but over a batch of variants.
+        params = get_params()
+        values = dict(cond_data)
+        loc = torch.cat([params["mvn.loc", n].reshape(K, -1) for n in mvn_sites], -1)
+        scale = torch.cat(
+            [params["mvn.scale", n].reshape(K, -1) for n in mvn_sites], -1
+        )
+        cov_factor = [params["mvn.cov_factor", n] for n in mvn_sites]
+        cov_factor = torch.cat([v.reshape(K, -1, v.size(-1)) for v in cov_factor], -2)
+        posterior = dist.LowRankMultivariateNormal(
+            loc, cov_factor * scale.unsqueeze(-1), scale * scale
+        )
+        latent = posterior.rsample()  # [K, D]
+        log_q = posterior.log_prob(latent)  # [K]
+        pos = 0
+        for name, support in mvn_sites.items():
+            shape = params["mvn.loc", name].shape
+            end = pos + shape[1:].numel()
+            unconstrained_value = latent[:, pos:end].reshape(shape)
+            transform = biject_to(support)
+            value = values[name] = transform(unconstrained_value)
+            log_density = transform.inv.log_abs_det_jacobian(value, unconstrained_value)
+            log_q = log_q + log_density.reshape(K, -1).sum(-1)
+            pos = end
+        for name in normal_sites:
+            fn = dist.Normal(params["normal.loc", name], params["normal.scale", name])
+            values[name] = fn.rsample()
+            log_q = log_q + fn.log_prob(values[name]).reshape(K, -1).sum(-1)
+        reparams = {name: params["param", name] for name in _FUSED_PARAMS}
+        loss = log_q - _fused_log_p(dataset, cells, values, reparams)  # [K]
+        batch_losses.append(loss.detach())
+        return loss.sum()
+
+    def optim_config(param_name):
+        config: dict = {
+            "lr": learning_rate,
+            "lrd": learning_rate_decay ** (1 / num_steps),
+            "clip_norm": clip_norm,
+        }
+        # Follow fit_svi(), which slows learning of these parameters.
+        if param_name.startswith("loo.normal.scale.") or "_centered" in param_name:
+            config["lr"] *= 0.1
+        return config
+
+    svi = SVI(model_, guide, ClippedAdam(optim_config), elbo)
+    for step in range(num_steps):
+        svi.step()
+        loss = batch_losses[-1]
+        assert not torch.isnan(loss).any()
+        if log_every and step % log_every == 0:
+            logger.info(f"step {step: >4d} L={(loss / num_obs).mean():0.6g}")
+    losses = torch.stack(batch_losses, -1).tolist()  # [K, num_steps]
+
+    # Compute median point estimates of each variant.
+    features = dataset["features"]
+    F = features.size(-1)
+    with torch.no_grad():
+        params = get_params()
+        median = dict(cond_data)
+        for name, support in mvn_sites.items():
+            median[name] = biject_to(support)(params["mvn.loc", name])
+        coef = _decentered(
+            dist.Logistic(torch.zeros(F), median["coef_scale"][..., None]),
+            params["param", "coef_centered"],
+            median["coef_decentered"],
+        )[1]
+        rate_loc = 0.01 * features_matmul(coef, features)
+    names = _dim_names(dataset)
+    unconstrained = {k: v.unconstrained().detach() for k, v in params.items()}
+    walltime = default_timer() - start_time
+    results = []
+    for k in range(K):
+        guide_state = {
+            "names": names,
+            "params": {key: value[k].clone() for key, value in unconstrained.items()},
+        }
+        results.append(
+            {
+                "median": {"coef": coef[k], "rate_loc": rate_loc[k]},
+                "losses": losses[k],
+                "guide_state": guide_state,
+                "walltime": walltime,
+            }
+        )
+    return results
+
+
 @torch.no_grad()
 def log_stats(dataset: dict, result: dict) -> dict:
     """
@@ -928,13 +2160,16 @@ def log_stats(dataset: dict, result: dict) -> dict:
         stats[f"R({s})/R(A)"] = R_RA
 
     # Accuracy of mutation-only model, ie without region-local effects.
-    true = dataset["weekly_strains"] + 1e-20  # avoid nans
+    true = dataset["weekly_strains"]
+    if true.is_sparse:
+        true = true.to_dense()
+    true = true + 1e-20  # avoid nans
     counts = true.sum(-1, True)
     true_probs = true / counts
     local_time = dataset["local_time"][..., None]
     if "local_time" in result["params"]:
         local_time = local_time + result["params"]["local_time"].to(local_time.device)
-    rate = 0.01 * result["median"]["coef"] @ dataset["features"].T
+    rate = 0.01 * features_matmul(result["median"]["coef"], dataset["features"])
     pred = result["median"]["init"] + rate * local_time
     pred -= pred.logsumexp(-1, True)  # apply log sigmoid function
     kl = true.mul(true_probs.log() - pred).sum(-1)
@@ -0,0 +1,241 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import functools
+import logging
+import pickle
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class _SparseCounts:
+    """
+    Sparse counts of int64 keys, buffered and periodically compacted.
+    """
+
+    def __init__(self, max_buffer_size=1 << 20):
+        self.max_buffer_size = max_buffer_size
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._buffer = []
+        self._buffer_size = 0
+
+    def add(self, keys):
+        self._buffer.append(keys)
+        self._buffer_size += len(keys)
+        if self._buffer_size >= self.max_buffer_size:
+            self.compact()
+
+    def compact(self):
+        """
+        :returns: a pair ``(keys, counts)`` of sorted unique keys and their
+            counts.
+        """
+        if self._buffer:
+            keys = np.concatenate([self._keys] + self._buffer)
+            counts = np.ones(len(keys), dtype=np.int64)
+            counts[: len(self._counts)] = self._counts
+            self._keys, inverse = np.unique(keys, return_inverse=True)
+            self._counts = np.bincount(
+                inverse.reshape(-1), weights=counts, minlength=len(self._keys)
+            ).astype(np.int64)
+            self._buffer = []
+            self._buffer_size = 0
+        return self._keys, self._counts
+
+
+class MutationCounter:
+    """
+    Accumulates per-lineage counts of amino acid mutations and of within-gene
+    pairs of mutations from nextclade rows. This is intended as a
+    :class:`~pyrocov.fasta.NextcladeDB` task, e.g.::
+
+        counter = MutationCounter()
+        db.schedule(sequence, counter.add_row, lineage)
+
+    Mutations are interned to integer ids. Each distinct mutation string of a
+    row is parsed once into an array of ids and an array of pair codes
+    ``lo << 32 | hi``, which are accumulated in sparse per-lineage counters.
+    Pairs are ordered by position only when converted back to strings.
+
+    :param int cache_size: The number of distinct mutation strings to cache.
+    """
+
+    def __init__(self, cache_size=1 << 16):
+        self.mutations = []
+        self.status_counts = defaultdict(Counter)
+        self._mutation_ids = {}
+        self._genes = []
+        self._gene_ids = []
+        self._gene_index = {}
+        self._names = []
+        self._sort_keys = []
+        self._singles = defaultdict(_SparseCounts)
+        self._pairs = defaultdict(_SparseCounts)
+        self._parse = functools.lru_cache(cache_size)(self._parse_mutations)
+
+    def _intern(self, mutation):
+        i = self._mutation_ids.get(mutation)
+        if i is None:
+            i = self._mutation_ids[mutation] = len(self.mutations)
+            g, m = mutation.split(":")
+            self.mutations.append(mutation)
+            self._genes.append(g)
+            self._gene_ids.append(self._gene_index.setdefault(g, len(self._gene_index)))
+            self._names.append(m)
+            self._sort_keys.append((int(re.search(r"\d+", m).group(0)), m))
+        return i
+
+    def _parse_mutations(self, ms):
+        ids = np.array([self._intern(m) for m in ms.split(",")], dtype=np.int64)
+        genes = np.array([self._gene_ids[i] for i in ids.tolist()])
+        i, j = np.triu_indices(len(ids), 1)
+        same_gene = genes[i] == genes[j]
+        i, j = ids[i[same_gene]], ids[j[same_gene]]
+        pairs = np.minimum(i, j) << 32 | np.maximum(i, j)
+        return ids, pairs
+
+    def add_row(self, lineage, row):
+        # Check whether row is valid
+        status = row["qc.overallStatus"]
+        self.status_counts[lineage][status] += 1
+        if status != "good":
+            return
+        singles = self._singles[lineage]
+        pairs = self._pairs[lineage]
+        for col in ["aaSubstitutions", "aaDeletions"]:
+            ms = row[col]
+            if ms:
+                ids, codes = self._parse(ms)
+                singles.add(ids)
+                pairs.add(codes)
+
+    def single_counts(self, lineage):
+        """
+        :returns: a pair ``(ids, counts)`` of mutation ids and their counts.
+        """
+        return self._singles[lineage].compact()
+
+    def pair_counts(self, lineage):
+        """
+        :returns: a pair ``(codes, counts)`` of pair codes and their counts.
+        """
+        return self._pairs[lineage].compact()
+
+    def pair_to_string(self, code):
+        """
+        Converts a pair code to a string like ``"S:N501Y,D614G"``.
+        """
+        code = int(code)
+        i, j = sorted([code >> 32, code & 0xFFFFFFFF], key=self._sort_keys.__getitem__)
+        return f"{self._genes[i]}:{self._names[i]},{self._names[j]}"
+
+
+def save_features(args, counter):
+    """
+    Converts per-lineage mutation counts accumulated by a
+    :class:`MutationCounter` to sparse COO features, saving aggregate counts to
+    ``args.counts_file_out`` and features to ``args.features_file_out``.
+    """
+    message = ["Total quality:"]
+    status_counts = Counter()
+    for c in counter.status_counts.values():
+        status_counts.update(c)
+    for s, c in status_counts.most_common():
+        message.append(f"{s}: {c}")
+    logger.info("\n\t".join(message))
+
+    message = ["Lineages with fewest good samples:"]
+    for c, l in sorted((c["good"], l) for l, c in counter.status_counts.items())[:20]:
+        message.append(f"{l}: {c}")
+    logger.info("\n\t".join(message))
+
+    # Collect a set of all single mutations observed in this subsample.
+    agg_counts = np.zeros(len(counter.mutations), dtype=np.int64)
+    for lineage in counter.status_counts:
+        ids, counts = counter.single_counts(lineage)
+        agg_counts[ids] += counts
+    agg_counts = dict(zip(counter.mutations, agg_counts.tolist()))
+    all_mutations = sorted(agg_counts)
+    logger.info(f"saving {args.counts_file_out}")
+    with open(args.counts_file_out, "wb") as f:
+        pickle.dump(agg_counts, f)
+
+    # Filter to lineages with at least a few good samples.
+    lineage_counts = {}
+    for lineage, status_counts in counter.status_counts.items():
+        if status_counts["good"] < args.min_good_samples:
+            logger.info(f"Dropping {lineage} with {status_counts}")
+        elif status_counts["good"]:
+            lineage_counts[lineage] = status_counts["good"]
+
+    # Filter to features that occur in the majority of at least one lineage.
+    single_ids = set()
+    pair_codes = set()
+    for lineage, denominator in lineage_counts.items():
+        ids, counts = counter.single_counts(lineage)
+        single_ids.update(ids[counts / denominator >= 0.5].tolist())
+        codes, counts = counter.pair_counts(lineage)
+        pair_codes.update(codes[counts / denominator >= 0.5].tolist())
+    logger.info(
+        "Keeping only ({} single + {} double) = {} of {} mutations".format(
+            len(single_ids),
+            len(pair_codes),
+            len(single_ids) + len(pair_codes),
+            len(all_mutations),
+        )
+    )
+
+    # Convert to sparse features.
+    lineages = sorted(lineage_counts)
+    singles = sorted((counter.mutations[i], i) for i in single_ids)
+    pairs = sorted((counter.pair_to_string(c), c) for c in pair_codes)
+    mutations = [m for m, _ in singles] + [m for m, _ in pairs]
+    # Map sorted selected keys to their feature columns.
+    selected = []
+    for begin, keys in [
+        (0, [i for _, i in singles]),
+        (len(singles), [c for _, c in pairs]),
+    ]:
+        keys = np.array(keys, dtype=np.int64)
+        columns = np.arange(begin, begin + len(keys))
+        order = keys.argsort()
+        selected.append((keys[order], columns[order]))
+    rows, cols, values = [], [], []
+    for i, lineage in enumerate(lineages):
+        denominator = lineage_counts[lineage]
+        for (keys, counts), (selected_keys, columns) in zip(
+            [counter.single_counts(lineage), counter.pair_counts(lineage)], selected
+        ):
+            if not len(selected_keys):
+                continue
+            pos = np.searchsorted(selected_keys, keys).clip(max=len(selected_keys) - 1)
+            hit = selected_keys[pos] == keys
+            rows.append(np.full(hit.sum(), i))
+            cols.append(columns[pos[hit]])
+            values.append(counts[hit] / denominator)
+    if values:
+        indices = torch.from_numpy(
+            np.stack([np.concatenate(rows), np.concatenate(cols)])
+        )
+        values = torch.from_numpy(np.concatenate(values)).float()
+    else:
+        indices = torch.zeros(2, 0, dtype=torch.long)
+        values = torch.zeros(0)
+    shape = (len(lineages), len(mutations))
+    features = torch.sparse_coo_tensor(indices, values, shape)
+    features = features.coalesce()
+
+    result = {
+        "lineages": lineages,
+        "mutations": mutations,
+        "features": features,
+        "all_mutations": all_mutations,
+    }
+    logger.info(f"saving {tuple(features.shape)}-features to {args.features_file_out}")
+    torch.save(result, args.features_file_out)
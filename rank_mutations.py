@@ -152,7 +152,7 @@ def fit_map(args, dataset, cond_data, guide=None, without_feature=None):
     if without_feature is not None:
         # Drop feature.
         dataset = dataset.copy()
-        dataset["features"] = dataset["features"].clone()
+        dataset["features"] = dataset["features"].to_dense().clone()
         dataset["features"][:, without_feature] = 0
 
     # Condition model.
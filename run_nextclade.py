@@ -2,13 +2,14 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
-import json
 import logging
 import os
 import pickle
 from collections import Counter
 
-from pyrocov.fasta import NextcladeDB
+from pyrocov import gisaid
+from pyrocov.fasta import DIGESTS, Minimap2Backend, NextcladeBackend, NextcladeDB
+from pyrocov.io import read_lines
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
@@ -32,21 +33,24 @@ def main(args):
         )
     os.makedirs("results", exist_ok=True)
 
-    db = NextcladeDB()
+    if args.aligner == "minimap2":
+        backend = Minimap2Backend(num_workers=args.nextclade_workers)
+    else:
+        backend = NextcladeBackend(args.nextclade)
+    db = NextcladeDB(
+        num_workers=args.nextclade_workers, backend=backend, digest=args.digest
+    )
     schedule = db.maybe_schedule if args.no_new else db.schedule
     mutation_counts = Counter()
-    with open(args.gisaid_file_in, "rt") as f:
-        for i, line in enumerate(f):
-            seq = json.loads(line)["sequence"]
 
-            # Filter by length.
-            nchars = sum(seq.count(b) for b in "ACGT")
-            if args.min_nchars <= nchars <= args.max_nchars:
-                seq = seq.replace("\n", "")
-                schedule(seq, count_mutations, mutation_counts)
+    # Filter by length, and hash in parallel.
+    lines = read_lines(args.gisaid_file_in)
+    sequences = gisaid.filter_sequences(args, lines, digest=db.digest)
+    for i, (_, key, seq) in enumerate(sequences):
+        schedule(seq, count_mutations, mutation_counts, key=key)
 
-            if i % args.log_every == 0:
-                print(".", end="", flush=True)
+        if i % args.log_every == 0:
+            print(".", end="", flush=True)
     db.wait(log_every=args.log_every)
 
     logger.info(f"saving {args.counts_file_out}")
@@ -57,12 +61,33 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run NextClade on all sequences")
     parser.add_argument(
-        "--gisaid-file-in", default=os.path.expanduser("results/gisaid.json")
+        "--gisaid-file-in", default=os.path.expanduser("results/gisaid.json.xz")
     )
     parser.add_argument("--counts-file-out", default="results/nextclade.counts.pkl")
     parser.add_argument("--min-nchars", default=29000, type=int)
     parser.add_argument("--max-nchars", default=31000, type=int)
     parser.add_argument("--no-new", action="store_true")
+    parser.add_argument(
+        "--aligner",
+        default="nextclade",
+        choices=["nextclade", "minimap2"],
+        help="alignment backend; minimap2 requires mappy but not nextclade",
+    )
+    parser.add_argument("--nextclade", default="./nextclade")
+    parser.add_argument(
+        "--nextclade-workers",
+        default=1,
+        type=int,
+        help="number of alignment batches to run concurrently",
+    )
+    parser.add_argument(
+        "--digest",
+        choices=sorted(DIGESTS),
+        help="sequence digest of a new database, defaults to sha1",
+    )
     parser.add_argument("-l", "--log-every", default=1000, type=int)
+    parser.add_argument(
+        "-j", "--num-workers", default=1, type=int, help="number of worker processes"
+    )
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,79 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import random
+
+import numpy as np
+import pytest
+
+from pyrocov.align import GENETIC_CODE, CodonTranslator, diff_to_aa_mutations
+
+
+def test_genetic_code():
+    assert len(GENETIC_CODE) == 64
+    assert GENETIC_CODE["ATG"] == "M"
+    assert GENETIC_CODE["TGG"] == "W"
+    assert {c for c, aa in GENETIC_CODE.items() if aa == "*"} == {"TAA", "TAG", "TGA"}
+
+
+def test_diff_to_aa_mutations():
+    ref = "NNN" + "ATG" + "GCT" + "TTT" + "AAA" + "NNN"
+    genes = {"G": (4, 15)}
+    diff = [
+        (6, "I", "AAA"),  # Ignored.
+        (7, "X", "A"),  # GCT -> GAT
+        (8, "X", "C"),  # Silent.
+        (9, "D", 3),
+        (12, "X", "G"),  # AAA -> GGA
+        (13, "X", "G"),
+        (16, "X", "A"),  # Outside of genes.
+    ]
+    subs, dels = diff_to_aa_mutations(ref, diff, genes)
+    assert subs == ["G:A2D", "G:K4G"]
+    assert dels == ["G:F3-"]
+
+
+def random_diff(ref):
+    diff = []
+    pos = random.randint(0, 100)
+    while pos < len(ref) - 20:
+        r = random.random()
+        if r < 0.7:
+            diff.append((pos, "X", random.choice("ACGTR".replace(ref[pos], ""))))
+        elif r < 0.9:
+            size = random.randint(1, 9)
+            diff.append((pos, "D", size))
+            pos += size
+        else:
+            diff.append((pos, "I", "AC"))
+        if random.random() < 0.3:  # Create multiple SNVs per codon.
+            pos += 1
+            diff.append((pos, "X", random.choice("ACGT".replace(ref[pos], ""))))
+        pos += random.randint(1, 100)
+    return diff
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_codon_translator(seed):
+    random.seed(seed)
+    ref = "".join(random.choice("ACGT") for _ in range(3000))
+    ref = ref[:1000] + "N" + ref[1001:]
+    # Include overlapping reading frames and a partial final codon.
+    genes = {"A": (11, 1510), "B": (1200, 1400), "C": (1600, 2901), "D": (1501, 1600)}
+    diffs = [random_diff(ref) for _ in range(20)] + [[], [(5, "I", "A")]]
+
+    translator = CodonTranslator(ref, genes)
+    rows, ids = translator(diffs)
+    assert rows.dtype == ids.dtype == np.int64
+    assert len(set(translator.mutations)) == len(translator.mutations)
+    for i, diff in enumerate(diffs):
+        subs, dels = diff_to_aa_mutations(ref, diff, genes)
+        actual = [translator.mutations[m] for m in ids[rows == i].tolist()]
+        assert [m for m in actual if not m.endswith("-")] == subs
+        assert [m for m in actual if m.endswith("-")] == dels
+
+    # Mutations are interned across batches.
+    num_mutations = len(translator.mutations)
+    rows2, ids2 = translator(diffs[:3])
+    assert len(translator.mutations) == num_mutations
+    assert ids2.tolist() == ids[rows < 3].tolist()
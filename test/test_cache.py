@@ -0,0 +1,86 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from pyrocov.cache import ArtifactCache, file_fingerprint, fingerprint
+
+
+def test_fingerprint():
+    x = torch.randn(3, 4)
+    data = {"x": x, "names": OrderedDict(a=0, b=1), "n": 1, "y": np.arange(3)}
+    key = fingerprint(data, (1, 2.0, None))
+    assert fingerprint(data, (1, 2.0, None)) == key
+    assert fingerprint(dict(data, x=x.clone()), (1, 2.0, None)) == key
+    assert fingerprint(dict(data, x=x + 1), (1, 2.0, None)) != key
+    assert fingerprint(dict(data, x=x.double()), (1, 2.0, None)) != key
+    assert fingerprint(data, (1, 2, None)) != key
+    assert fingerprint(data, [1, 2.0, None]) != key
+    assert fingerprint(x.to_sparse()) == fingerprint(x.to_sparse().coalesce())
+    assert fingerprint(x.to_sparse()) != fingerprint(x)
+
+
+def test_file_fingerprint(tmpdir):
+    dirname = os.path.join(tmpdir, "store")
+    os.makedirs(dirname)
+    filename = os.path.join(dirname, "a.npy")
+    np.save(filename, np.arange(10))
+    assert file_fingerprint(os.path.join(tmpdir, "missing")) is None
+    for size in [11, 12]:
+        before = {
+            content: file_fingerprint(dirname, content=content)
+            for content in [False, True]
+        }
+        assert file_fingerprint(dirname) == before[False]
+        np.save(filename, np.arange(size))
+        for content in [False, True]:
+            assert file_fingerprint(dirname, content=content) != before[content]
+
+
+def test_artifact_cache(tmpdir):
+    manifest = os.path.join(tmpdir, "cache.json")
+    filenames = [os.path.join(tmpdir, f"{i}.pt") for i in range(3)]
+    cache = ArtifactCache(manifest)
+    assert cache.get(filenames[0], "a") == (False, None)
+    cache.put(filenames[0], "a", torch.zeros(100))
+    found, value = cache.get(filenames[0], "a")
+    assert found and torch.equal(value, torch.zeros(100))
+    assert cache.get(filenames[0], "b") == (False, None)
+
+    # Unversioned files are ignored and never evicted.
+    torch.save(torch.ones(100), filenames[1])
+    cache = ArtifactCache(manifest)
+    assert cache.get(filenames[1], "a") == (False, None)
+
+    # Least recently used artifacts are evicted.
+    size = os.path.getsize(filenames[0])
+    cache = ArtifactCache(manifest, max_bytes=1.5 * size)
+    assert cache.get(filenames[0], "a")[0]
+    cache.put(filenames[2], "c", torch.zeros(100))
+    assert not os.path.exists(filenames[0])
+    assert os.path.exists(filenames[1])
+    assert os.path.exists(filenames[2])
+    cache = ArtifactCache(manifest)
+    assert cache.get(filenames[2], "c")[0]
+    assert cache.get(filenames[0], "a") == (False, None)
+
+
+def test_artifact_cache_flush(tmpdir):
+    manifest = os.path.join(tmpdir, "cache.json")
+    filename = os.path.join(tmpdir, "0.pt")
+    cache = ArtifactCache(manifest)
+    cache.put(filename, "a", torch.zeros(100))
+    with open(manifest) as f:
+        before = f.read()
+
+    # Hits do not rewrite the manifest until flushed.
+    assert cache.get(filename, "a")[0]
+    with open(manifest) as f:
+        assert f.read() == before
+    cache.flush()
+    with open(manifest) as f:
+        assert f.read() != before
@@ -0,0 +1,108 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from pyrocov.columnar import (
+    CategoricalColumn,
+    StringColumn,
+    convert_pickle,
+    count_cells,
+    export_pickle,
+    factorize,
+    load_columns,
+    load_cube,
+    save_columns,
+    save_cube,
+)
+
+COLUMNS = {
+    "virus_name": [f"hCoV-19/USA/CA-{i}/2021" for i in range(10)],
+    "location": ["Europe / France", "Asia / Japan", "Europe / France"] * 3 + ["ü"],
+    "lineage": ["B.1.1.7"] * 4 + ["B.1.617.2"] * 6,
+    "day": list(range(100, 110)),
+}
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_save_load(tmpdir, mmap):
+    dirname = os.path.join(tmpdir, "gisaid.columns")
+    save_columns(COLUMNS, dirname)
+    save_columns(COLUMNS, dirname)  # overwrite
+    assert os.listdir(tmpdir) == ["gisaid.columns"]
+    columns = load_columns(dirname, mmap=mmap)
+    assert set(columns) == set(COLUMNS)
+    assert isinstance(columns["virus_name"], StringColumn)
+    assert isinstance(columns["location"], CategoricalColumn)
+    assert isinstance(columns["lineage"], CategoricalColumn)
+    assert isinstance(columns["day"], np.ndarray)
+    assert columns["day"].dtype == np.int32
+    for name, expected in COLUMNS.items():
+        actual = columns[name]
+        assert len(actual) == len(expected)
+        assert actual.tolist() == expected
+        assert list(actual) == expected
+        assert actual[3] == expected[3]
+        assert actual[-1] == expected[-1]
+        assert list(actual[2:5]) == expected[2:5]
+
+
+def test_pickle_roundtrip(tmpdir):
+    pkl = os.path.join(tmpdir, "gisaid.columns.pkl")
+    dirname = os.path.join(tmpdir, "gisaid.columns")
+    with open(pkl, "wb") as f:
+        pickle.dump(COLUMNS, f)
+    convert_pickle(pkl, dirname)
+    os.remove(pkl)
+    export_pickle(dirname, pkl)
+    assert load_columns(pkl) == COLUMNS
+
+
+@pytest.mark.parametrize("name", ["location", "lineage", "virus_name"])
+def test_factorize(tmpdir, name):
+    dirname = os.path.join(tmpdir, "gisaid.columns")
+    save_columns(COLUMNS, dirname)
+    values = COLUMNS[name]
+    for column in [values, load_columns(dirname)[name]]:
+        codes, uniques = factorize(column)
+        assert codes.dtype == np.int64
+        assert [uniques[c] for c in codes.tolist()] == values
+        assert uniques == list(dict.fromkeys(values))
+
+
+def test_count_cells(tmpdir):
+    dirname = os.path.join(tmpdir, "gisaid.columns")
+    columns = dict(COLUMNS, day=[100, 101] * 5)
+    save_columns(columns, dirname)
+    cube = count_cells(load_columns(dirname))
+    expected = {}
+    for i, (day, location, lineage) in enumerate(
+        zip(columns["day"], columns["location"], columns["lineage"])
+    ):
+        count, first_row = expected.get((day, location, lineage), (0, i))
+        expected[day, location, lineage] = count + 1, first_row
+    actual = {
+        (day, cube["locations"][p], cube["lineages"][s]): (count, first_row)
+        for day, p, s, count, first_row in zip(
+            *(cube[k].tolist() for k in ["day", "location", "lineage"]),
+            cube["count"].tolist(),
+            cube["first_row"].tolist(),
+        )
+    }
+    assert actual == expected
+    assert cube["num_rows"] == 10
+    assert cube["day_counts"].tolist() == [0] * 100 + [5, 5]
+    assert cube["lineage_counts"].tolist() == [4, 6]
+    assert cube["location_counts"].sum() == 10
+
+    filename = os.path.join(tmpdir, "gisaid.cube.pkl")
+    save_cube(cube, filename, dirname)
+    loaded = load_cube(filename, dirname)
+    assert loaded.keys() == cube.keys()
+    save_columns(columns, dirname)
+    os.utime(dirname, ns=(0, 0))
+    assert load_cube(filename, dirname) is None
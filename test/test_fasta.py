@@ -0,0 +1,188 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import itertools
+import os
+import random
+import sys
+
+import pytest
+
+from pyrocov.fasta import NextcladeDB, count_nucleotides, hash_sequence
+
+HEADER = "seqName\tqc.overallStatus\taaSubstitutions\taaDeletions\tclade\n"
+SEQUENCES = ["ACGT" * 10, "TTGA" * 10, "GGCA" * 10]
+
+
+def test_hash_sequence():
+    seq = "ACGTN\nACGT-"
+    expected = hashlib.sha1(b"ACGTNACGT-").hexdigest()
+    assert hash_sequence(seq) == expected
+    assert hash_sequence(seq.encode()) == expected
+    assert hash_sequence(seq, "blake2b") == hash_sequence(seq.encode(), "blake2b")
+    assert hash_sequence(seq, "blake2b") != expected
+
+
+def test_count_nucleotides():
+    seq = "ACGTN\nRYacgt-TTT"
+    assert count_nucleotides(seq) == sum(seq.count(b) for b in "ACGT")
+    assert count_nucleotides(seq.encode()) == count_nucleotides(seq)
+
+
+def test_nextclade_db_legacy(tmpdir):
+    fileprefix = os.path.join(tmpdir, "nextcladedb")
+    with open(fileprefix + ".header.tsv", "w") as f:
+        f.write(HEADER)
+    with open(fileprefix + ".rows.tsv", "w") as f:
+        for i, seq in enumerate(SEQUENCES[:2]):
+            f.write(f"{hash_sequence(seq)}\tgood\tS:D614G\t\t{i}\n")
+
+    for _ in range(2):  # The second pass reads the sqlite database.
+        db = NextcladeDB(fileprefix)
+        rows = []
+        for seq in SEQUENCES:
+            db.maybe_schedule(seq, rows.append)
+        db.maybe_schedule(SEQUENCES[0], rows.append)
+        db.wait(log_every=0, batch_size=1)
+        db.close()
+
+        assert len(rows) == 3
+        assert [row["clade"] for row in rows] == ["0", "0", "1"]
+        assert rows[0]["seqName"] == hash_sequence(SEQUENCES[0])
+        assert rows[0]["aaSubstitutions"] == "S:D614G"
+        assert rows[0]["aaDeletions"] == ""
+
+
+STUB = """#!{python}
+import sys
+opts = dict(arg[2:].split("=", 1) for arg in sys.argv[1:])
+with open(opts["input-fasta"]) as f:
+    names = [line[1:].strip() for line in f if line.startswith(">")]
+with open(opts["output-tsv"], "w") as f:
+    f.write("seqName\\tqc.overallStatus\\taaSubstitutions\\taaDeletions\\tclade\\n")
+    for name in names:
+        f.write(f"{{name}}\\tgood\\tS:D614G\\t\\t20A\\n")
+with open("{log}", "a") as f:
+    f.write(f"{{len(names)}}\\n")
+"""
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_nextclade_db_workers(tmpdir, num_workers):
+    fileprefix = os.path.join(tmpdir, "nextcladedb")
+    log = os.path.join(tmpdir, "nextclade.log")
+    nextclade = os.path.join(tmpdir, "nextclade")
+    with open(nextclade, "w") as f:
+        f.write(STUB.format(python=sys.executable, log=log))
+    os.chmod(nextclade, 0o755)
+    sequences = ["".join(seq) for seq in itertools.product("ACGT", repeat=4)]
+
+    for _ in range(2):  # The second pass should not align anything.
+        db = NextcladeDB(fileprefix, 3, num_workers=num_workers, nextclade=nextclade)
+        rows = []
+        for seq in sequences + sequences[:5]:
+            db.schedule(seq, rows.append)
+        db.wait(log_every=0)
+        db.close()
+
+        assert len(rows) == len(sequences) + 5
+        assert all(row["aaSubstitutions"] == "S:D614G" for row in rows)
+        assert sorted(os.listdir(tmpdir)) == [
+            "nextclade",
+            "nextclade.log",
+            "nextcladedb.sqlite",
+        ]
+        with open(log) as f:
+            counts = list(map(int, f))
+        assert sum(counts) == len(sequences)
+        assert max(counts) == 3
+
+
+class FakeBackend:
+    name = "fake"
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, prefix, batch):
+        self.batches.append(batch)
+        header = ["seqName", "qc.overallStatus", "aaSubstitutions", "aaDeletions"]
+        return header, [[key, "good", seq[:2], ""] for key, seq in batch]
+
+    def close(self):
+        pass
+
+
+def test_nextclade_db_backend(tmpdir):
+    fileprefix = os.path.join(tmpdir, "fakedb")
+    backend = FakeBackend()
+    db = NextcladeDB(fileprefix, 2, backend=backend)
+    rows = []
+    for seq in SEQUENCES:
+        db.schedule(seq, rows.append)
+    db.wait(log_every=0)
+    db.close()
+    assert [len(batch) for batch in backend.batches] == [2, 1]
+    assert [row["aaSubstitutions"] for row in rows] == ["AC", "TT", "GG"]
+    assert [row["aaDeletions"] for row in rows] == ["", "", ""]
+    assert os.listdir(tmpdir) == ["fakedb.sqlite"]
+
+    with pytest.raises(ValueError):
+        NextcladeDB(fileprefix)
+
+
+def test_nextclade_db_interrupted(tmpdir):
+    fileprefix = os.path.join(tmpdir, "fakedb")
+    open(fileprefix + ".sqlite", "w").close()  # Left by an interrupted run.
+    db = NextcladeDB(fileprefix, backend=FakeBackend())
+    rows = []
+    db.schedule(SEQUENCES[0], rows.append)
+    db.wait(log_every=0)
+    db.close()
+    assert [row["aaSubstitutions"] for row in rows] == ["AC"]
+
+
+def test_minimap2_backend(tmpdir):
+    pytest.importorskip("mappy")
+    from pyrocov.align import diff_to_aa_mutations
+    from pyrocov.fasta import Minimap2Backend
+    from pyrocov.sarscov2 import GENE_TO_POSITION
+
+    random.seed(0)
+    ref = "".join(random.choice("ACGT") for _ in range(30000))
+    reference = os.path.join(tmpdir, "reference.fasta")
+    with open(reference, "w") as f:
+        f.write(f">reference\n{ref}\n")
+    pos = 23402
+    base = "G" if ref[pos] != "G" else "C"
+    seq = ref[:pos] + base + ref[pos + 1 :]
+    expected, _ = diff_to_aa_mutations(ref, [(pos, "X", base)], GENE_TO_POSITION)
+
+    backend = Minimap2Backend(reference, num_workers=2)
+    db = NextcladeDB(os.path.join(tmpdir, "minimap2db"), backend=backend)
+    rows = []
+    db.schedule(seq, rows.append)
+    db.schedule(ref, rows.append)
+    db.wait(log_every=0)
+    db.close()
+    assert [row["qc.overallStatus"] for row in rows] == ["good", "good"]
+    assert rows[0]["aaSubstitutions"] == ",".join(expected)
+    assert rows[1]["aaSubstitutions"] == ""
+
+
+def test_nextclade_db_digest(tmpdir):
+    fileprefix = os.path.join(tmpdir, "fakedb")
+    for digest in ["blake2b", None]:
+        db = NextcladeDB(fileprefix, backend=FakeBackend(), digest=digest)
+        assert db.digest == "blake2b"
+        rows = []
+        key = hash_sequence(SEQUENCES[1], "blake2b")
+        db.schedule(SEQUENCES[1], rows.append, key=key)
+        db.maybe_schedule(SEQUENCES[1], rows.append)
+        db.wait(log_every=0)
+        db.close()
+        assert [row["seqName"] for row in rows] == [key, key]
+
+    with pytest.raises(ValueError):
+        NextcladeDB(fileprefix, backend=FakeBackend(), digest="sha1")
@@ -2,13 +2,23 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import glob
+import gzip
+import lzma
 import os
+import shutil
+import subprocess
 
 import pytest
 import torch
 from Bio import Phylo
 
-from pyrocov.io import read_alignment, read_nexus_trees, stack_nexus_trees
+from pyrocov.io import (
+    DECOMPRESSORS,
+    read_alignment,
+    read_lines,
+    read_nexus_trees,
+    stack_nexus_trees,
+)
 
 ROOT = os.path.dirname(os.path.dirname(__file__))
 FILENAME = os.path.join(ROOT, "data", "GTR4G_posterior.trees")
@@ -44,3 +54,53 @@ def test_read_alignment(filename):
     probs = read_alignment(filename)
     assert probs.dim() == 3
     assert torch.isfinite(probs).all()
+
+
+LINES = [f'{{"id": {i}, "sequence": "{"ACGT" * i}"}}\n'.encode() for i in range(1000)]
+
+
+def _write_compressed(filename):
+    if filename.endswith(".xz"):
+        with lzma.open(filename, "wb") as f:
+            f.writelines(LINES)
+    elif filename.endswith(".gz"):
+        with gzip.open(filename, "wb") as f:
+            f.writelines(LINES)
+    elif filename.endswith(".zst"):
+        if not shutil.which("zstd"):
+            pytest.skip("zstd is not available")
+        with open(filename[: -len(".zst")], "wb") as f:
+            f.writelines(LINES)
+        subprocess.check_call(["zstd", "-q", "--rm", filename[: -len(".zst")]])
+    else:
+        with open(filename, "wb") as f:
+            f.writelines(LINES)
+
+
+@pytest.mark.parametrize("backend", [None, "process", "thread"])
+@pytest.mark.parametrize("ext", ["", ".xz", ".gz", ".zst"])
+def test_read_lines(tmpdir, ext, backend):
+    filename = os.path.join(tmpdir, "gisaid.json" + ext)
+    _write_compressed(filename)
+    if ext and backend == "process":
+        if not any(shutil.which(cmd[0]) for cmd in DECOMPRESSORS[ext][0]):
+            pytest.skip("command line tool is not available")
+    if ext == ".zst" and backend == "thread":
+        pytest.importorskip("zstandard")
+
+    actual = list(read_lines(filename, backend=backend, chunk_size=1000))
+    assert actual == LINES
+
+    # Check early termination.
+    for i, line in enumerate(read_lines(filename, backend=backend, chunk_size=10)):
+        assert line == LINES[i]
+        if i == 10:
+            break
+
+
+def test_read_lines_missing_tool(tmpdir, monkeypatch):
+    filename = os.path.join(tmpdir, "gisaid.json.xz")
+    _write_compressed(filename)
+    monkeypatch.setattr(shutil, "which", lambda name: None)
+    with pytest.raises(OSError, match="xz"):
+        list(read_lines(filename, backend="process"))
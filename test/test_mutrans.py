@@ -0,0 +1,404 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+
+import numpy as np
+import pyro
+import pyro.distributions as dist
+import pytest
+import torch
+from pyro import poutine
+from pyro.infer import SVI, Trace_ELBO
+from pyro.optim import ClippedAdam
+from pyro.poutine.util import site_is_subsample
+
+from pyrocov import mutrans
+from pyrocov.columnar import save_columns
+from pyrocov.mutrans import (
+    EarlyStopping,
+    Guide,
+    InitLocFn,
+    _subsample_cells,
+    fit_svi,
+    fit_svi_distributed,
+    fit_svi_loo,
+    fused_elbo_loss,
+    get_guide_state,
+    load_gisaid_data,
+    mask_cells,
+    model,
+    observed_cells,
+    slice_gisaid_data,
+    sparse_multinomial_log_prob,
+    warm_start_guide,
+)
+
+LINEAGES = ["B.1", "B.1.1.7", "B.1.617.2"]
+MUTATIONS = ["S:D614G", "S:N501Y", "S:L452R"]
+LOCATIONS = [
+    "Europe / France",
+    "Europe / France / Paris",
+    "Asia / Japan",
+    "North America / USA",
+]
+
+
+def make_dataset(places, lineages, mutations, num_weeks=4):
+    P, S, F = len(places), len(lineages), len(mutations)
+    local_time = torch.arange(float(num_weeks))[:, None] - num_weeks / 2
+    return {
+        "location_id": {name: i for i, name in enumerate(places)},
+        "lineage_id": {name: i for i, name in enumerate(lineages)},
+        "lineage_id_inv": list(lineages),
+        "mutations": list(mutations),
+        "features": torch.randn(S, F).gt(0).float().to_sparse(),
+        "weekly_strains": dist.Poisson(5.0).sample((num_weeks, P, S)),
+        "local_time": local_time.expand(num_weeks, P).contiguous(),
+    }
+
+
+@pytest.fixture
+def gisaid_files(tmpdir):
+    rng = np.random.default_rng(0)
+    num_rows = 300
+    columns = {
+        "day": rng.integers(0, 100, num_rows).tolist(),
+        "location": rng.choice(LOCATIONS, num_rows).tolist(),
+        "lineage": rng.choice(LINEAGES, num_rows).tolist(),
+    }
+    # A region observed in a single late week is filtered out.
+    columns["day"].append(95)
+    columns["location"].append("Africa / Kenya")
+    columns["lineage"].append("B.1")
+    columns_dir = os.path.join(tmpdir, "gisaid.columns")
+    save_columns(columns, columns_dir)
+
+    features_file = os.path.join(tmpdir, "nextclade.features.pt")
+    features = torch.tensor([[1.0, 0.0, 0.0], [1.0, 1.0, 0.0], [1.0, 0.0, 1.0]])
+    torch.save(
+        {"lineages": LINEAGES, "mutations": MUTATIONS, "features": features},
+        features_file,
+    )
+    return {
+        "gisaid_columns_filename": columns_dir,
+        "gisaid_cube_filename": None,
+        "nextclade_features_filename": features_file,
+    }
+
+
+@pytest.mark.parametrize("sparse_strains", [False, True])
+def test_slice_gisaid_data(gisaid_files, sparse_strains):
+    full = load_gisaid_data(
+        end_day=99, keep_cells=True, sparse_strains=sparse_strains, **gisaid_files
+    )
+    for end_day in [99, 70, 50, 29]:  # 50 and 29 are mid-week.
+        actual = slice_gisaid_data(full, end_day)
+        expected = load_gisaid_data(
+            end_day=end_day, sparse_strains=sparse_strains, **gisaid_files
+        )
+        assert actual["location_id"] == expected["location_id"]
+        assert actual["weekly_strains"].is_sparse == sparse_strains
+        assert torch.equal(
+            actual["weekly_strains"].to_dense(), expected["weekly_strains"].to_dense()
+        )
+        assert torch.allclose(actual["local_time"], expected["local_time"])
+
+    with pytest.raises(ValueError):
+        slice_gisaid_data(expected, 20)  # Loaded without keep_cells.
+    with pytest.raises(ValueError):
+        slice_gisaid_data(actual, 50)  # Later than the slice.
+
+
+def test_sparse_strains(gisaid_files):
+    dense = load_gisaid_data(end_day=99, **gisaid_files)
+    sparse = load_gisaid_data(end_day=99, sparse_strains=True, **gisaid_files)
+    assert "Africa / Kenya" not in dense["location_id"]
+    assert sparse["location_id"] == dense["location_id"]
+    assert sparse["weekly_strains"].is_sparse
+    assert torch.equal(sparse["weekly_strains"].to_dense(), dense["weekly_strains"])
+    assert torch.allclose(sparse["local_time"], dense["local_time"])
+
+
+def test_sparse_multinomial_log_prob():
+    T, P, S = 5, 4, 3
+    counts = dist.Poisson(torch.full((T, P, S), 0.5)).sample()
+    counts[2, 1] = 0  # An unobserved (t, p) pair.
+    logits = torch.randn(T, P, S)
+    expected = (
+        dist.Multinomial(logits=logits, validate_args=False).log_prob(counts).sum()
+    )
+
+    cells = observed_cells(counts.to_sparse())
+    assert not ((cells["t"] == 2) & (cells["p"] == 1)).any()
+    actual = sparse_multinomial_log_prob(cells, lambda t, p: logits[t, p])
+    assert torch.allclose(actual, expected)
+
+
+
+def test_subsample_cells():
+    T, P, S = 5, 6, 3
+    counts = dist.Poisson(torch.full((T, P, S), 0.5)).sample()
+    counts[2, 1] = 0  # An unobserved (t, p) pair.
+    logits = torch.randn(T, P, S)
+    cells = observed_cells(counts.to_sparse())
+    expected = sparse_multinomial_log_prob(cells, lambda t, p: logits[t, p])
+
+    halves = [torch.tensor([4, 1, 2]), torch.tensor([0, 3, 5])]
+    estimates = []
+    for places in halves + [torch.randperm(P)]:
+        # Subsampled cells match slicing the dense counts.
+        sub = _subsample_cells(cells, places, P)
+        actual = torch.zeros(T, len(places), S)
+        actual[sub["t"][sub["row"]], sub["p"][sub["row"]], sub["s"]] = sub["count"]
+        assert torch.equal(actual, counts[:, places])
+        assert torch.equal(sub["total"], actual.sum(-1)[sub["t"], sub["p"]])
+
+        sub_logits = logits[:, places]
+        log_prob = sparse_multinomial_log_prob(sub, lambda t, p: sub_logits[t, p])
+        estimates.append(P / len(places) * log_prob)
+
+    # Scaled likelihoods of a partition of places are unbiased, and a scaled
+    # likelihood over all places is exact.
+    assert torch.allclose(sum(estimates[:2]) / 2, expected)
+    assert torch.allclose(estimates[2], expected)
+
+
+def test_model_place_subsample():
+    model_type = "sparse-skip-reparam"
+    dataset = make_dataset(["A", "B", "C", "D"], LINEAGES, MUTATIONS)
+    dataset["weekly_strains"] = dataset["weekly_strains"].to_sparse()
+    P = len(dataset["location_id"])
+    trace = poutine.trace(model).get_trace(dataset, model_type)
+    expected = trace.log_prob_sum()
+    data = {
+        name: site["value"]
+        for name, site in trace.nodes.items()
+        if site["type"] == "sample"
+        and not site["is_observed"]
+        and not site_is_subsample(site)
+    }
+    conditioned_model = poutine.condition(model, data)
+    trace = poutine.trace(conditioned_model).get_trace(
+        dataset, model_type, place_subsample=torch.arange(P)
+    )
+    assert torch.allclose(trace.log_prob_sum(), expected)
+
+def test_early_stopping():
+    patience = 10
+    kwargs = dict(patience=patience, loss_tol=0.1, param_tol=0.01)
+
+    # A plateaued loss with constant params converges.
+    param = torch.ones(3)
+    stop = EarlyStopping([param], **kwargs)
+    converged = [stop(1.0) for _ in range(3 * patience)]
+    assert not any(converged[:patience])
+    assert converged.index(True) < 2 * patience
+
+    # A decreasing loss does not converge.
+    stop = EarlyStopping([param], **kwargs)
+    assert not any(stop(100.0 - step) for step in range(10 * patience))
+
+    # Moving params do not converge.
+    stop = EarlyStopping([param], **kwargs)
+    converged = []
+    for _ in range(10 * patience):
+        param.mul_(1.1)
+        converged.append(stop(1.0))
+    assert not any(converged)
+
+
+def test_warm_start_guide():
+    model_type = "sparse-skip-reparam"
+    old_dataset = make_dataset(["A", "B", "C"], LINEAGES[:2], MUTATIONS[:2])
+    guide = Guide(model, InitLocFn(old_dataset), init_scale=0.01, rank=2)
+    guide(old_dataset, model_type)
+    with torch.no_grad():
+        for value in pyro.get_param_store().values():
+            value.unconstrained().normal_()
+    state = get_guide_state(guide, old_dataset)
+    old = state["params"]
+
+    pyro.clear_param_store()
+    new_dataset = make_dataset(["D", "C", "B"], LINEAGES[::-1], MUTATIONS)
+    guide = Guide(model, InitLocFn(new_dataset), init_scale=0.01, rank=2)
+    guide(new_dataset, model_type)
+    warm_start_guide(guide, new_dataset, state)
+    new = get_guide_state(guide, new_dataset)["params"]
+
+    # Params shared across names are copied.
+    for name in ["init_loc_centered", "rate_centered", "init_centered"]:
+        assert old["param", name].dim() == 0
+        assert torch.equal(new["param", name], old["param", name])
+
+    # Params indexed by names are matched by name, as (old, new) ids.
+    places = [(1, 2), (2, 1)]  # B, C
+    lineages = [(0, 2), (1, 1)]  # B.1, B.1.1.7
+    for kind, name in [
+        ("normal.loc", "rate_decentered"),
+        ("normal.scale", "rate_decentered"),
+        ("normal.loc", "init_decentered"),
+        ("normal.scale", "init_decentered"),
+        ("param", "local_time"),
+    ]:
+        for p0, p1 in places:
+            for s0, s1 in lineages:
+                assert new[kind, name][p1, s1] == old[kind, name][p0, s0]
+    for kind in ["mvn.loc", "mvn.scale", "mvn.cov_factor"]:
+        for s0, s1 in lineages:
+            expected = old[kind, "init_loc_decentered"][s0]
+            assert torch.equal(new[kind, "init_loc_decentered"][s1], expected)
+        expected = old[kind, "coef_decentered"]
+        assert torch.equal(new[kind, "coef_decentered"][:2], expected)
+
+
+def test_mask_cells():
+    T, P, S = 5, 4, 3
+    counts = dist.Poisson(torch.full((T, P, S), 0.5)).sample()
+    logits = torch.randn(T, P, S)
+    masks = torch.tensor([[1.0, 0.0, 1.0], [0.0, 0.0, 0.0], [1.0, 1.0, 1.0]])
+    cells = mask_cells(observed_cells(counts.to_sparse()), masks)
+    actual = sparse_multinomial_log_prob(cells, lambda t, p: logits[t, p])
+    assert actual.shape == (3,)
+    for k, mask in enumerate(masks):
+        expected = observed_cells((counts * mask).to_sparse())
+        expected = sparse_multinomial_log_prob(expected, lambda t, p: logits[t, p])
+        assert torch.allclose(actual[k], expected)
+
+
+@pytest.mark.parametrize("warm_start", [False, True], ids=["cold", "warm"])
+def test_fit_svi_loo(monkeypatch, warm_start):
+    model_type = "sparse-skip-reparam"
+    dataset = make_dataset(["A", "B", "C", "D"], LINEAGES, MUTATIONS)
+    guide = Guide(model, InitLocFn(dataset), init_scale=0.01, rank=2)
+    guide(dataset, model_type)
+    with torch.no_grad():
+        for value in pyro.get_param_store().values():
+            value.unconstrained().add_(torch.randn(value.shape), alpha=0.1)
+    state = get_guide_state(guide, dataset) if warm_start else None
+
+    # Draw zero noise, so that batched and unbatched losses agree exactly.
+    def zeros(shape, dtype=None, device=None):
+        return torch.zeros(shape, dtype=dtype, device=device)
+
+    monkeypatch.setattr(torch.distributions.normal, "_standard_normal", zeros)
+    monkeypatch.setattr(
+        torch.distributions.lowrank_multivariate_normal, "_standard_normal", zeros
+    )
+
+    masks = torch.tensor([[1.0, 0.0, 1.0], [1.0, 1.0, 0.0]])
+    results = fit_svi_loo(
+        dataset,
+        masks,
+        model_type=model_type,
+        num_steps=1,
+        rank=2,
+        log_every=0,
+        seed=0,
+        warm_start=state,
+    )
+    assert len(results) == 2
+    for mask, result in zip(masks, results):
+        # Each variant is initialized as if fit alone.
+        pyro.set_rng_seed(0)
+        pyro.clear_param_store()
+        masked = dict(dataset, weekly_strains=dataset["weekly_strains"] * mask)
+        guide = Guide(model, InitLocFn(masked), init_scale=0.01, rank=2)
+        guide(masked, model_type)
+        if warm_start:
+            warm_start_guide(guide, masked, state)
+        expected = fused_elbo_loss(model, guide, masked, model_type).item()
+        assert result["losses"][0] == pytest.approx(expected, rel=1e-4)
+        assert result["median"]["coef"].shape == (len(MUTATIONS),)
+        assert result["median"]["rate_loc"].shape == (len(LINEAGES),)
+
+
+def test_fit_svi_distributed():
+    old_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(torch.double)
+    try:
+        dataset = make_dataset(["A", "B", "C", "D", "E"], LINEAGES, MUTATIONS)
+        dataset["features"] = dataset["features"].to_dense()
+        kwargs = dict(
+            model_type="sparse-skip-reparam",
+            guide_type="map",
+            num_steps=5,
+            num_samples=2,
+            jit=False,
+            log_every=0,
+        )
+        expected = fit_svi_distributed(dataset, num_workers=1, **kwargs)
+        actual = fit_svi_distributed(dataset, num_workers=2, **kwargs)
+    finally:
+        torch.set_default_dtype(old_dtype)
+
+    assert actual["losses"] == pytest.approx(expected["losses"], rel=1e-8)
+    assert set(actual["params"]) == set(expected["params"])
+    for name, value in expected["params"].items():
+        assert torch.allclose(actual["params"][name], value), name
+
+
+def test_fused_elbo_loss():
+    model_type = "sparse-skip-reparam"
+    old_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(torch.double)
+    try:
+        dataset = make_dataset(["A", "B", "C", "D"], LINEAGES, MUTATIONS)
+        losses = {}
+        for loss_type in ["trace", "fused"]:
+            pyro.set_rng_seed(0)
+            pyro.clear_param_store()
+            guide = Guide(model, InitLocFn(dataset), init_scale=0.01, rank=2)
+            guide(dataset, model_type)
+            if loss_type == "trace":
+                loss = Trace_ELBO(max_plate_nesting=3)
+            else:
+                loss = fused_elbo_loss
+            svi = SVI(model, guide, ClippedAdam({"lr": 0.01}), loss)
+            losses[loss_type] = [
+                svi.step(dataset=dataset, model_type=model_type) for _ in range(5)
+            ]
+    finally:
+        torch.set_default_dtype(old_dtype)
+
+    assert losses["fused"] == pytest.approx(losses["trace"], rel=1e-8)
+
+
+def test_fit_svi_resume(tmpdir, monkeypatch):
+    dataset = make_dataset(["A", "B", "C", "D"], LINEAGES, MUTATIONS)
+    kwargs = dict(
+        model_type="sparse-skip-reparam",
+        guide_type="custom",
+        num_steps=6,
+        num_samples=2,
+        rank=2,
+        jit=False,
+        log_every=0,
+        checkpoint_every=3,
+    )
+    expected = fit_svi(
+        dataset, checkpoint_filename=os.path.join(tmpdir, "expected.pt"), **kwargs
+    )
+
+    # Interrupt a fit right after its first checkpoint.
+    class Interrupt(Exception):
+        pass
+
+    save_checkpoint = mutrans.save_checkpoint
+
+    def save_checkpoint_and_interrupt(filename, state):
+        save_checkpoint(filename, state)
+        raise Interrupt
+
+    filename = os.path.join(tmpdir, "actual.pt")
+    monkeypatch.setattr(mutrans, "save_checkpoint", save_checkpoint_and_interrupt)
+    with pytest.raises(Interrupt):
+        fit_svi(dataset, checkpoint_filename=filename, **kwargs)
+    monkeypatch.setattr(mutrans, "save_checkpoint", save_checkpoint)
+    assert mutrans.load_checkpoint(filename)["step"] == 3
+
+    actual = fit_svi(dataset, checkpoint_filename=filename, resume=True, **kwargs)
+    assert actual["losses"] == expected["losses"]
+    assert set(actual["params"]) == set(expected["params"])
+    for name, value in expected["params"].items():
+        assert torch.equal(actual["params"][name], value), name
@@ -0,0 +1,109 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import pickle
+import random
+import re
+from argparse import Namespace
+from collections import Counter, defaultdict
+
+import pytest
+import torch
+
+from pyrocov.nextclade import MutationCounter, save_features
+
+
+def random_rows(num_rows):
+    subs = ["S:D614G", "S:N501Y", "S:E484K", "S:E484Q", "S:A1078*", "N:R203K"]
+    subs += ["N:G204R", "ORF1a:T3255I", "ORF1a:P314L", "ORF1a:S3675-"]
+    dels = ["S:H69-", "S:V70-", "S:Y144-", "N:E31-", "ORF1a:G3676-"]
+    for _ in range(num_rows):
+        lineage = random.choice("ABC")
+        # Bias mutations by lineage, so that some pairs are kept as features.
+        ms = set()
+        for m in subs + dels:
+            if random.random() < (0.8 if sum(map(ord, lineage + m)) % 3 else 0.1):
+                ms.add(m)
+        yield lineage, {
+            "qc.overallStatus": random.choice(["good", "good", "good", "bad"]),
+            "aaSubstitutions": ",".join(m for m in subs if m in ms),
+            "aaDeletions": ",".join(m for m in dels if m in ms),
+        }
+
+
+def expected_features(rows, min_good_samples):
+    # This is the original string-based implementation.
+    lineage_mutation_counts = defaultdict(Counter)
+    lineage_status_counts = defaultdict(Counter)
+    for lineage, row in rows:
+        lineage_status_counts[lineage][row["qc.overallStatus"]] += 1
+        if row["qc.overallStatus"] != "good":
+            continue
+        mutation_counts = lineage_mutation_counts[lineage]
+        mutation_counts[None] += 1
+        for col in ["aaSubstitutions", "aaDeletions"]:
+            if not row[col]:
+                continue
+            ms = row[col].split(",")
+            mutation_counts.update(ms)
+            by_gene = defaultdict(list)
+            for m in ms:
+                g, m = m.split(":")
+                by_gene[g].append(m)
+            for g, ms in by_gene.items():
+                ms.sort(key=lambda m: (int(re.search(r"\d+", m).group(0)), m))
+                for i, m1 in enumerate(ms):
+                    for m2 in ms[i + 1 :]:
+                        mutation_counts[f"{g}:{m1},{m2}"] += 1
+    agg_counts = Counter()
+    for ms in lineage_mutation_counts.values():
+        for m, count in ms.items():
+            if m is not None and "," not in m:
+                agg_counts[m] += count
+    for lineage, status_counts in lineage_status_counts.items():
+        if status_counts["good"] < min_good_samples:
+            lineage_mutation_counts.pop(lineage, None)
+    lineage_counts = {
+        k: v.pop(None) for k, v in lineage_mutation_counts.items() if None in v
+    }
+    mutations = set()
+    for lineage, mutation_counts in lineage_mutation_counts.items():
+        for m, count in mutation_counts.items():
+            if count / lineage_counts[lineage] >= 0.5:
+                mutations.add(m)
+    lineages = sorted(lineage_counts)
+    mutations = sorted(mutations, key=lambda m: (m.count(","), m))
+    features = torch.zeros(len(lineages), len(mutations))
+    for i, lineage in enumerate(lineages):
+        for j, m in enumerate(mutations):
+            count = lineage_mutation_counts[lineage][m]
+            features[i, j] = count / lineage_counts[lineage]
+    return dict(agg_counts), lineages, mutations, features
+
+
+@pytest.mark.parametrize("min_good_samples", [0, 5, 30])
+def test_mutation_counter(tmpdir, min_good_samples):
+    random.seed(min_good_samples)
+    rows = list(random_rows(100))
+    args = Namespace(
+        counts_file_out=os.path.join(tmpdir, "counts.pkl"),
+        features_file_out=os.path.join(tmpdir, "features.pt"),
+        min_good_samples=min_good_samples,
+    )
+    counter = MutationCounter(cache_size=4)
+    for lineage, row in rows:
+        counter.add_row(lineage, row)
+    save_features(args, counter)
+
+    agg_counts, lineages, mutations, features = expected_features(
+        rows, min_good_samples
+    )
+    with open(args.counts_file_out, "rb") as f:
+        assert pickle.load(f) == agg_counts
+    actual = torch.load(args.features_file_out)
+    assert actual["lineages"] == lineages
+    assert actual["mutations"] == mutations
+    assert actual["all_mutations"] == sorted(agg_counts)
+    assert actual["features"].is_sparse
+    assert torch.equal(actual["features"].to_dense(), features)